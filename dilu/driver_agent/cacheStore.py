@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class LRUCacheStore:
+    """Size-bounded key/value table in SQLite with least-recently-used eviction.
+
+    Every lookup refreshes the entry's access time; once the table grows past
+    `max_entries`, the entries that were used longest ago are deleted.
+    """
+
+    _opened: Dict[str, 'LRUCacheStore'] = {}
+
+    def __init__(self, path: str, table: str, max_entries: int = 10000) -> None:
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table}(
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                lastAccess REAL
+            );"""
+        )
+        self.conn.execute(
+            f"""CREATE INDEX IF NOT EXISTS {table}_lastAccess
+            ON {table}(lastAccess);"""
+        )
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, path: str, table: str, max_entries: int = 10000) -> 'LRUCacheStore':
+        # one connection per cache table and process, shared by every model
+        if (path, table) not in cls._opened:
+            cls._opened[(path, table)] = cls(path, table, max_entries)
+        return cls._opened[(path, table)]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ?;", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                f"UPDATE {self.table} SET lastAccess = ? WHERE key = ?;",
+                (time.time(), key)
+            )
+            self.conn.commit()
+        return row[0]
+
+    def getMany(self, keys: List[str]) -> Dict[str, bytes]:
+        # one query and one commit for a whole batch of lookups
+        with self.lock:
+            found = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                found.update(self.conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({','.join('?' * len(batch))});",
+                    batch
+                ).fetchall())
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    f"UPDATE {self.table} SET lastAccess = ? WHERE key = ?;",
+                    [(now, key) for key in found]
+                )
+                self.conn.commit()
+        return found
+
+    def put(self, key: str, value: bytes):
+        self.putMany({key: value})
+
+    def putMany(self, items: Dict[str, bytes]):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table}(key, value, lastAccess) VALUES(?,?,?);",
+                [(key, value, now) for key, value in items.items()]
+            )
+            overflow = self.conn.execute(
+                f"SELECT COUNT(*) FROM {self.table};"
+            ).fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self.conn.execute(
+                    f"""DELETE FROM {self.table} WHERE key IN (
+                        SELECT key FROM {self.table}
+                        ORDER BY lastAccess LIMIT ?
+                    );""",
+                    (overflow,)
+                )
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,257 @@
+"""Record/replay ("cassette") backend for the chat and embedding models.
+
+In `record` mode every chat completion and embedding request is forwarded to
+the real OpenAI/Azure backend and stored in a SQLite cassette file. In
+`replay` mode the stored answers are served straight from the cassette, with
+an optional synthetic latency, so whole episodes run offline and give
+repeatable timings for the non-LLM parts of the pipeline.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk
+
+from dilu.driver_agent.decisionStream import DECISION_PATTERN
+
+
+def normalizeText(text: str) -> str:
+    # Vehicle ids are `id(sv) % 1000` and change from one process to the
+    # next, and whitespace differs between prompt templates, so neither may
+    # take part in the key.
+    text = re.sub(r"`\d+`", "`#`", text)
+    return " ".join(text.split())
+
+
+def textHash(text: str) -> str:
+    return hashlib.sha256(normalizeText(text).encode('utf-8')).hexdigest()
+
+
+def promptHash(messages: List[BaseMessage], *extra: Any) -> str:
+    digest = hashlib.sha256()
+    for item in extra:
+        digest.update(f"{item}\x1f".encode('utf-8'))
+    for message in messages:
+        digest.update(f"{message.type}\x1f{normalizeText(message.content)}\x1e".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def splitChunks(text: str) -> List[str]:
+    return [piece for piece in re.findall(r"\S*\s*", text) if piece]
+
+
+class Cassette:
+    """SQLite file holding recorded chat responses and embeddings."""
+
+    _opened: Dict[str, 'Cassette'] = {}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS chat(
+                key TEXT PRIMARY KEY,
+                response TEXT
+            );"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS embedding(
+                key TEXT PRIMARY KEY,
+                vector TEXT
+            );"""
+        )
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, path: str) -> 'Cassette':
+        # chat and embedding models of one process share a single connection
+        if path not in cls._opened:
+            cls._opened[path] = cls(path)
+        return cls._opened[path]
+
+    def getChat(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM chat WHERE key = ?;", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def putChat(self, key: str, response: str):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chat(key, response) VALUES(?,?);",
+                (key, response)
+            )
+            self.conn.commit()
+
+    def getEmbedding(self, key: str) -> Optional[List[float]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT vector FROM embedding WHERE key = ?;", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def putEmbeddings(self, items: Dict[str, List[float]]):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embedding(key, vector) VALUES(?,?);",
+                [(key, json.dumps(vector)) for key, vector in items.items()]
+            )
+            self.conn.commit()
+
+
+class CassetteMissError(KeyError):
+    pass
+
+
+class CassetteChatModel(BaseChatModel):
+    """Chat model that records to or replays from a `Cassette`."""
+
+    cassette: Any
+    mode: str = 'replay'
+    inner: Optional[BaseChatModel] = None
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "dilu-cassette-chat"
+
+    def _key(self, messages: List[BaseMessage]) -> str:
+        return promptHash(messages)
+
+    def _replay(self, messages: List[BaseMessage]) -> str:
+        response = self.cassette.getChat(self._key(messages))
+        if response is None:
+            raise CassetteMissError(
+                f"No cassette entry for this prompt in {self.cassette.path}, record it first.")
+        return response
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.mode == 'record':
+            response = self.inner(messages, stop=stop, **kwargs).content
+            self.cassette.putChat(self._key(messages), response)
+        else:
+            response = self._replay(messages)
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.mode == 'record':
+            response = (await self.inner.ainvoke(messages, stop=stop, **kwargs)).content
+            self.cassette.putChat(self._key(messages), response)
+        else:
+            response = self._replay(messages)
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if self.mode == 'record':
+            response = ""
+            stream = self.inner.stream(messages, stop=stop, **kwargs)
+            try:
+                for chunk in stream:
+                    response += chunk.content
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+            except GeneratorExit:
+                # a stream closed after the decision is recorded as far as it went
+                if DECISION_PATTERN.search(response):
+                    self.cassette.putChat(self._key(messages), response)
+                raise
+            finally:
+                stream.close()
+            self.cassette.putChat(self._key(messages), response)
+        else:
+            chunks = splitChunks(self._replay(messages))
+            for piece in chunks:
+                time.sleep(self.latency / len(chunks))
+                yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if self.mode == 'record':
+            response = ""
+            stream = self.inner.astream(messages, stop=stop, **kwargs)
+            try:
+                async for chunk in stream:
+                    response += chunk.content
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+            except GeneratorExit:
+                if DECISION_PATTERN.search(response):
+                    self.cassette.putChat(self._key(messages), response)
+                raise
+            finally:
+                await stream.aclose()
+            self.cassette.putChat(self._key(messages), response)
+        else:
+            chunks = splitChunks(self._replay(messages))
+            for piece in chunks:
+                await asyncio.sleep(self.latency / len(chunks))
+                yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+class CassetteEmbeddings(Embeddings):
+    """Embeddings that record to or replay from a `Cassette`."""
+
+    def __init__(self, cassette: Cassette, mode: str = 'replay',
+                 inner: Optional[Embeddings] = None, latency: float = 0.0) -> None:
+        self.cassette = cassette
+        self.mode = mode
+        self.inner = inner
+        self.latency = latency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [textHash(text) for text in texts]
+        vectors = [self.cassette.getEmbedding(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing and self.mode == 'record':
+            recorded = self.inner.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, recorded):
+                vectors[i] = vector
+            self.cassette.putEmbeddings(
+                {keys[i]: vectors[i] for i in missing})
+        elif missing:
+            raise CassetteMissError(
+                f"No cassette entry for {len(missing)} embedding texts in {self.cassette.path}, record them first.")
+        else:
+            time.sleep(self.latency)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
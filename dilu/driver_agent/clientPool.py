@@ -0,0 +1,271 @@
+"""Process-wide HTTP connections and retries of the OpenAI clients.
+
+A new chat model is built for every episode and agent. The openai package
+opens a fresh `requests` session per thread, which it replaces every three
+minutes, and a fresh aiohttp session for every async request, so each of
+them pays for a new TCP and TLS handshake. `ClientPool` gives the openai
+package one kept-alive session per process instead: a `requests` session
+installed as `openai.requestssession`, and an aiohttp session entered with
+`aioSession` around a batch of async requests.
+
+`RetryingChatModel` retries requests that failed on a timeout, a dropped
+connection, a rate limit or a server error. The wait before retry n is
+drawn uniformly from [0, min(maxBackoff, backoff * 2**n)], so clients that
+failed together do not retry together. A stream is only retried while
+nothing has been yielded from it.
+
+The pool counts requests, new connections, retries, timeouts and requests
+that failed for good, see `ClientPool.stats`.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult, LLMResult
+from langchain.schema.messages import AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGenerationChunk
+from rich import print
+
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def isRetryable(error: Exception) -> bool:
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # other API errors are only worth retrying when the server failed
+    return isinstance(error, openai.error.APIError) \
+        and (error.http_status is None or error.http_status >= 500)
+
+
+class PooledSession(requests.Session):
+    """A `requests` session that outlives the openai package's closing it.
+
+    openai closes its thread's session every `MAX_SESSION_LIFETIME_SECS`,
+    which for a shared session would drop the connections of every thread.
+    """
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class ClientPool:
+    def __init__(self, poolSize: int = 16) -> None:
+        self.poolSize = poolSize
+        self.session = PooledSession()
+        # connection errors are retried by `RetryingChatModel` with backoff
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.counts = Counter()
+
+    def install(self):
+        openai.requestssession = self.session
+
+    @asynccontextmanager
+    async def aioSession(self) -> AsyncIterator[Optional[aiohttp.ClientSession]]:
+        """Share one aiohttp session among the async requests made inside.
+
+        `openai.aiosession` is a context variable, so the session reaches
+        the tasks created within this block.
+        """
+        if openai.aiosession.get() is not None:
+            yield openai.aiosession.get()
+            return
+
+        async def onRequest(session, context, params):
+            self.counts['aio_requests'] += 1
+
+        async def onConnection(session, context, params):
+            self.counts['aio_connections'] += 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(onRequest)
+        trace.on_connection_create_end.append(onConnection)
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.poolSize),
+            trace_configs=[trace]
+        ) as session:
+            token = openai.aiosession.set(session)
+            try:
+                yield session
+            finally:
+                openai.aiosession.reset(token)
+
+    def stats(self) -> Dict[str, int]:
+        requests_, connections = self.counts['aio_requests'], self.counts['aio_connections']
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_ += pool.num_requests
+                    connections += pool.num_connections
+        return {
+            'requests': requests_,
+            'connections': connections,
+            'reused': max(requests_ - connections, 0),
+            'retries': self.counts['retries'],
+            'timeouts': self.counts['timeouts'],
+            'failures': self.counts['failures'],
+        }
+
+
+@lru_cache(maxsize=None)
+def clientPool() -> ClientPool:
+    pool = ClientPool(int(os.getenv("LLM_POOL_SIZE", 16)))
+    pool.install()
+    return pool
+
+
+class RetryingChatModel(BaseChatModel):
+    """Chat model wrapper that retries transient failures of `inner`."""
+
+    inner: BaseChatModel
+    pool: Any
+    retries: int = 3
+    backoff: float = 1.0
+    maxBackoff: float = 30.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "dilu-retrying-chat"
+
+    # the response cache keys answers by the model of the client it wraps
+    @property
+    def deployment_name(self) -> Optional[str]:
+        return getattr(self.inner, "deployment_name", None)
+
+    @property
+    def model_name(self) -> Optional[str]:
+        return getattr(self.inner, "model_name", None)
+
+    @property
+    def temperature(self) -> Optional[float]:
+        return getattr(self.inner, "temperature", None)
+
+    def _retryDelay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying after `error`, None to give up."""
+        if isinstance(error, openai.error.Timeout):
+            self.pool.counts['timeouts'] += 1
+        if attempt >= self.retries or not isRetryable(error):
+            self.pool.counts['failures'] += 1
+            return None
+        self.pool.counts['retries'] += 1
+        delay = random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt))
+        print(f"[yellow]LLM request failed ({error!r}), retry {attempt + 1}/{self.retries} in {delay:.1f}s[/yellow]")
+        return delay
+
+    def _chatResult(self, result: LLMResult) -> ChatResult:
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        attempt = 0
+        while True:
+            try:
+                return self._chatResult(self.inner.generate([messages], stop=stop, **kwargs))
+            except Exception as e:
+                delay = self._retryDelay(e, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        attempt = 0
+        while True:
+            try:
+                return self._chatResult(await self.inner.agenerate([messages], stop=stop, **kwargs))
+            except Exception as e:
+                delay = self._retryDelay(e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        attempt = 0
+        while True:
+            started = False
+            stream = self.inner.stream(messages, stop=stop, **kwargs)
+            try:
+                for chunk in stream:
+                    started = True
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+                return
+            except Exception as e:
+                # a stream that already yielded text cannot be taken back
+                delay = self._retryDelay(e, attempt if not started else self.retries)
+                if delay is None:
+                    raise
+            finally:
+                stream.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        attempt = 0
+        while True:
+            started = False
+            stream = self.inner.astream(messages, stop=stop, **kwargs)
+            try:
+                async for chunk in stream:
+                    started = True
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+                return
+            except Exception as e:
+                # a stream that already yielded text cannot be taken back
+                delay = self._retryDelay(e, attempt if not started else self.retries)
+                if delay is None:
+                    raise
+            finally:
+                await stream.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
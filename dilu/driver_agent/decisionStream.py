@@ -0,0 +1,45 @@
+"""Incremental parser for the decision line of a streamed driver answer.
+
+The driver prompt asks for `Response to user:#### <Action_id>` once the
+reasoning is done, but models often keep writing afterwards. Feeding the
+streamed chunks to `DecisionStreamParser` tells the caller as soon as the
+decision line is complete, so the rest of the stream can be cancelled.
+"""
+import re
+from typing import Optional
+
+
+DECISION_PATTERN = re.compile(r"Response to user\s*:\s*####\s*`?(\d+)")
+# the id is complete once something other than a digit follows it
+DECISION_END = re.compile(r"\D")
+# a decision line split over chunks starts at most this far before the new text
+SCAN_OVERLAP = 64
+
+
+class DecisionStreamParser:
+    def __init__(self) -> None:
+        self.text = ""
+        self.decisionEnd: Optional[int] = None
+        self._scanFrom = 0
+
+    @property
+    def decided(self) -> bool:
+        return self.decisionEnd is not None
+
+    @property
+    def response(self) -> str:
+        """The streamed text, up to the decision once it is found."""
+        return self.text[:self.decisionEnd] if self.decided else self.text
+
+    def feed(self, piece: str) -> bool:
+        """Add a chunk; True once the decision line is complete."""
+        if self.decided:
+            return True
+        self.text += piece
+        # only the new text and a short overlap are searched again
+        for match in DECISION_PATTERN.finditer(self.text, max(0, self._scanFrom - SCAN_OVERLAP)):
+            if DECISION_END.match(self.text, match.end()):
+                self.decisionEnd = match.end()
+                return True
+        self._scanFrom = len(self.text)
+        return False
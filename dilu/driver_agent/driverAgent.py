@@ -1,14 +1,18 @@
+import asyncio
 import os
 import textwrap
 import time
 from rich import print
-from typing import List
+from typing import Dict, List
 
-from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
-from langchain.callbacks import get_openai_callback, OpenAICallbackHandler, StreamingStdOutCallbackHandler
+from langchain.callbacks import OpenAICallbackHandler, StreamingStdOutCallbackHandler
 
 from dilu.scenario.envScenario import EnvScenario
+from dilu.driver_agent.llmFactory import buildChatModel
+from dilu.driver_agent.promptBudget import PromptBudget, tokenCounter
+from dilu.driver_agent.decisionStream import DecisionStreamParser
+from dilu.driver_agent.outputAgent import OutputParser
 
 
 delimiter = "####"
@@ -47,36 +51,39 @@ example_answer = textwrap.dedent(f"""\
 class DriverAgent:
     def __init__(
         self, sce: EnvScenario,
-        temperature: float = 0, verbose: bool = False
+        temperature: float = 0, verbose: bool = False,
+        token_budget: int = None, budget_policy: str = 'truncate'
     ) -> None:
         self.sce = sce
+        model = os.getenv("OPENAI_CHAT_MODEL")
+        self.token_counter = tokenCounter(model)
+        # `token_budget` bounds the prompt, see promptBudget.py
+        self.budget = PromptBudget(
+            token_budget, budget_policy, model) if token_budget else None
+        self.budget_stats = None
+        # one entry per decision: prompt tokens, time to decision, completion
+        # tokens and a bound on the tokens saved by stopping the stream early
+        self.step_stats: List[Dict] = []
+        self.max_tokens = 2000
         oai_api_type = os.getenv("OPENAI_API_TYPE")
         if oai_api_type == "azure":
             print("Using Azure Chat API")
-            self.llm = AzureChatOpenAI(
-                callbacks=[
-                    OpenAICallbackHandler()
-                ],
-                deployment_name=os.getenv("AZURE_CHAT_DEPLOY_NAME"),
-                temperature=temperature,
-                max_tokens=2000,
-                request_timeout=60,
-                streaming=True,
-            )
         elif oai_api_type == "openai":
             print("Use OpenAI API")
-            self.llm = ChatOpenAI(
-                temperature=temperature,
-                callbacks=[
-                    OpenAICallbackHandler()
-                ],
-                model_name=os.getenv("OPENAI_CHAT_MODEL"),
-                max_tokens=2000,
-                request_timeout=60,
-                streaming=True,
-            )
+        elif oai_api_type == "cassette":
+            print("Use LLM cassette in", os.getenv("CASSETTE_MODE"), "mode")
+        self.llm = buildChatModel(
+            temperature=temperature,
+            max_tokens=self.max_tokens,
+            streaming=True,
+            callbacks=[
+                OpenAICallbackHandler()
+            ],
+        )
+        # the LLM is only asked when no local tier finds the action
+        self.output_parser = OutputParser(self.llm)
 
-    def few_shot_decision(self, scenario_description: str = "Not available", previous_decisions: str = "Not available", available_actions: str = "Not available", driving_intensions: str = "Not available", fewshot_messages: List[str] = None, fewshot_answers: List[str] = None):
+    def build_messages(self, scenario_description: str = "Not available", previous_decisions: str = "Not available", available_actions: str = "Not available", driving_intensions: str = "Not available", fewshot_messages: List[str] = None, fewshot_answers: List[str] = None):
         # for template usage refer to: https://python.langchain.com/docs/modules/model_io/prompts/prompt_templates/
 
         system_message = textwrap.dedent(f"""\
@@ -109,6 +116,12 @@ class DriverAgent:
 
         if fewshot_messages is None:
             raise ValueError("fewshot_message is None")
+        if self.budget is not None:
+            fixedTokens = self.token_counter.messages([
+                SystemMessage(content=system_message),
+                HumanMessage(content=human_message)])
+            fewshot_messages, fewshot_answers, self.budget_stats = self.budget.fit(
+                fixedTokens, fewshot_messages, fewshot_answers)
         messages = [
             SystemMessage(content=system_message),
             # HumanMessage(content=example_message),
@@ -125,52 +138,122 @@ class DriverAgent:
             HumanMessage(content=human_message)
         )
         # print("fewshot number:", (len(messages) - 2)/2)
+        self.step_stats.append(
+            {'promptTokens': self.token_counter.messages(messages)})
+        print("[cyan]Prompt tokens:[/cyan]", self.step_stats[-1]['promptTokens'], end="")
+        if self.budget is not None:
+            print(" (budget {}, {} few-shot answers cut, {} dropped)".format(
+                self.budget.budget, self.budget_stats['cut'], self.budget_stats['dropped']), end="")
+        print()
+        return messages, human_message
+
+    def record_decision(self, parser: DecisionStreamParser, start_time: float) -> str:
+        response_content = parser.response
+        completion_tokens = self.token_counter.count(response_content)
+        self.step_stats[-1].update(
+            decisionSource='llm',
+            decisionSeconds=time.time() - start_time,
+            completionTokens=completion_tokens,
+            # the model may have stopped on its own soon after, so the
+            # remaining max_tokens is only an upper bound
+            savedTokensBound=max(self.max_tokens - completion_tokens, 0) if parser.decided else 0,
+        )
+        print("[cyan]Time to decision:[/cyan] {:.2f} s{}".format(
+            self.step_stats[-1]['decisionSeconds'],
+            ", stream stopped early" if parser.decided else ""))
+        return response_content
+
+    @staticmethod
+    def store_fewshot_answers(fewshot_messages: List[str], fewshot_answers: List[str]) -> str:
+        few_shot_answers_store = ""
+        for i in range(len(fewshot_messages)):
+            few_shot_answers_store += fewshot_answers[i] + \
+                "\n---------------\n"
+        return few_shot_answers_store
+
+    def few_shot_decision(self, scenario_description: str = "Not available", previous_decisions: str = "Not available", available_actions: str = "Not available", driving_intensions: str = "Not available", fewshot_messages: List[str] = None, fewshot_answers: List[str] = None):
+        messages, human_message = self.build_messages(
+            scenario_description, previous_decisions, available_actions,
+            driving_intensions, fewshot_messages, fewshot_answers
+        )
         start_time = time.time()
         # with get_openai_callback() as cb:
         # response = self.llm(messages)
         # print(response.content)
         print("[cyan]Agent answer:[/cyan]")
-        response_content = ""
-        for chunk in self.llm.stream(messages):
-            response_content += chunk.content
-            print(chunk.content, end="", flush=True)
+        parser = DecisionStreamParser()
+        stream = self.llm.stream(messages)
+        try:
+            for chunk in stream:
+                print(chunk.content, end="", flush=True)
+                if parser.feed(chunk.content):
+                    break
+        finally:
+            # closing the generator cancels the rest of the completion
+            stream.close()
         print("\n")
-        decision_action = response_content.split(delimiter)[-1]
+        response_content = self.record_decision(parser, start_time)
+        result = self.output_parser.parse(response_content)
+
+        few_shot_answers_store = self.store_fewshot_answers(
+            fewshot_messages, fewshot_answers)
+        print("Result:", result)
+        return result, response_content, human_message, few_shot_answers_store
+
+    def consensus_decision(self, action: int, similarity: float, scenario_description: str = "Not available", previous_decisions: str = "Not available", available_actions: str = "Not available", driving_intensions: str = "Not available", fewshot_messages: List[str] = None, fewshot_answers: List[str] = None):
+        """Take the action all retrieved memories agree on without asking the LLM.
+
+        Returns the same values as `few_shot_decision`; the response says
+        where the decision came from, so the step can be audited.
+        """
+        start_time = time.time()
+        _, human_message = self.build_messages(
+            scenario_description, previous_decisions, available_actions,
+            driving_intensions, fewshot_messages, fewshot_answers
+        )
+        response_content = textwrap.dedent(f"""\
+            Memory consensus: all {len(fewshot_messages)} retrieved memories chose action {action}, with similarity at least {similarity:.3f}. The LLM was not called.
+            Response to user:{delimiter} {action}""")
+        # nothing was sent to the model
+        self.step_stats[-1] = {
+            'promptTokens': 0, 'decisionSource': 'consensus',
+            'decisionSeconds': time.time() - start_time,
+            'completionTokens': 0, 'savedTokensBound': 0,
+        }
+        few_shot_answers_store = self.store_fewshot_answers(
+            fewshot_messages, fewshot_answers)
+        print("[green]Memory consensus, skipping the LLM.[/green] Result:", action)
+        return action, response_content, human_message, few_shot_answers_store
+
+    async def afew_shot_decision(self, scenario_description: str = "Not available", previous_decisions: str = "Not available", available_actions: str = "Not available", driving_intensions: str = "Not available", fewshot_messages: List[str] = None, fewshot_answers: List[str] = None):
+        """Async counterpart of `few_shot_decision` with the same return values.
+
+        Streamed chunks are not echoed, since several episodes may be waiting
+        on the model at once; the full answer is printed when it is complete.
+        """
+        messages, human_message = self.build_messages(
+            scenario_description, previous_decisions, available_actions,
+            driving_intensions, fewshot_messages, fewshot_answers
+        )
+        start_time = time.time()
+        parser = DecisionStreamParser()
+        stream = self.llm.astream(messages)
         try:
-            result = int(decision_action)
-            if result < 0 or result > 4:
-                raise ValueError
-        except ValueError:
-            print("Output is not a int number, checking the output...")
-            check_message = f"""
-            You are a output checking assistant who is responsible for checking the output of another agent.
-            
-            The output you received is: {decision_action}
-
-            Your should just output the right int type of action_id, with no other characters or delimiters.
-            i.e. :
-            | Action_id | Action Description                                     |
-            |--------|--------------------------------------------------------|
-            | 0      | Turn-left: change lane to the left of the current lane |
-            | 1      | IDLE: remain in the current lane with current speed   |
-            | 2      | Turn-right: change lane to the right of the current lane|
-            | 3      | Acceleration: accelerate the vehicle                 |
-            | 4      | Deceleration: decelerate the vehicle                 |
-
-
-            You answer format would be:
-            {delimiter} <correct action_id within 0-4>
-            """
-            messages = [
-                HumanMessage(content=check_message),
-            ]
-            with get_openai_callback() as cb:
-                check_response = self.llm(messages)
-            result = int(check_response.content.split(delimiter)[-1])
+            async for chunk in stream:
+                if parser.feed(chunk.content):
+                    break
+        finally:
+            await stream.aclose()
+            # langchain leaves closing the model's own stream to the event
+            # loop's async generator finalizer, which schedules a task for
+            # it: one loop iteration creates the task and the next runs it
+            for _ in range(2):
+                await asyncio.sleep(0)
+        response_content = self.record_decision(parser, start_time)
+        print("[cyan]Agent answer:[/cyan]\n", response_content, "\n")
+        result = await self.output_parser.aparse(response_content)
 
-        few_shot_answers_store = ""
-        for i in range(len(fewshot_messages)):
-            few_shot_answers_store += fewshot_answers[i] + \
-                "\n---------------\n"
+        few_shot_answers_store = self.store_fewshot_answers(
+            fewshot_messages, fewshot_answers)
         print("Result:", result)
         return result, response_content, human_message, few_shot_answers_store
@@ -0,0 +1,64 @@
+"""On-disk cache in front of the embedding model.
+
+`DrivingMemory.retriveMemory` embeds the scenario description of every
+frame, and the same descriptions come back across frames, episodes and
+runs. The cache answers them from SQLite instead of a remote request. Keys
+combine the embedding model name and the normalized text hash of the
+cassette, so vehicle ids and whitespace do not split entries.
+"""
+from typing import List
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from dilu.driver_agent.cacheStore import LRUCacheStore
+from dilu.driver_agent.cassette import textHash
+
+
+def embeddingModelName(embedding: Embeddings) -> str:
+    inner = getattr(embedding, "inner", None)
+    if inner is not None:
+        return embeddingModelName(inner)
+    return getattr(embedding, "deployment", None) or \
+        getattr(embedding, "model", None) or type(embedding).__name__
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves known texts from a `LRUCacheStore`.
+
+    Vectors are stored as float32 bytes. Texts missing from the cache are
+    embedded with one `embed_documents` call on the inner model.
+    """
+
+    def __init__(self, inner: Embeddings, store: LRUCacheStore) -> None:
+        self.inner = inner
+        self.store = store
+        self.modelName = embeddingModelName(inner)
+
+    def _key(self, text: str) -> str:
+        return f"{self.modelName}:{textHash(text)}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self.store.getMany(keys)
+        vectors = [
+            np.frombuffer(cached[key], dtype=np.float32).tolist()
+            if key in cached else None for key in keys
+        ]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.inner.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+            self.warm([texts[i] for i in missing], embedded)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def warm(self, texts: List[str], vectors: List[List[float]]):
+        # store vectors that were computed elsewhere, e.g. by another memory
+        self.store.putMany({
+            self._key(text): np.asarray(vector, dtype=np.float32).tobytes()
+            for text, vector in zip(texts, vectors)
+        })
@@ -0,0 +1,85 @@
+from typing import Tuple
+
+import numpy as np
+
+
+class KDTree:
+    """Static k-d tree over a small point set for exact k-nearest-neighbour search.
+
+    Points are split at the median of the widest dimension until a node holds
+    at most `leafSize` points. Leaves are scanned with numpy. Distances are
+    squared L2, like the other memory backends.
+    """
+
+    def __init__(self, points: np.ndarray, leafSize: int = 32) -> None:
+        self.points = np.asarray(points, dtype=np.float64)
+        self.order = np.arange(len(self.points))
+        # node arrays: split dimension (-1 for a leaf), split value, children
+        # and the slice of `order` the node covers
+        self.splitDim, self.splitValue = [], []
+        self.left, self.right = [], []
+        self.start, self.end = [], []
+        if len(self.points):
+            self._build(0, len(self.points), leafSize)
+
+    def _newNode(self, start: int, end: int) -> int:
+        for field, value in ((self.splitDim, -1), (self.splitValue, 0.0),
+                             (self.left, -1), (self.right, -1),
+                             (self.start, start), (self.end, end)):
+            field.append(value)
+        return len(self.start) - 1
+
+    def _build(self, start: int, end: int, leafSize: int):
+        stack = [self._newNode(start, end)]
+        while stack:
+            node = stack.pop()
+            start, end = self.start[node], self.end[node]
+            if end - start <= leafSize:
+                continue
+            block = self.points[self.order[start:end]]
+            spread = block.max(axis=0) - block.min(axis=0)
+            dim = int(np.argmax(spread))
+            if spread[dim] == 0:
+                continue
+            middle = (end - start) // 2
+            part = np.argpartition(block[:, dim], middle)
+            self.order[start:end] = self.order[start:end][part]
+            self.splitDim[node] = dim
+            self.splitValue[node] = float(self.points[self.order[start + middle], dim])
+            self.left[node] = self._newNode(start, start + middle)
+            self.right[node] = self._newNode(start + middle, end)
+            stack.extend((self.left[node], self.right[node]))
+
+    def query(self, x: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.asarray(x, dtype=np.float64)
+        k = min(k, len(self.points))
+        # the best k so far, sorted by distance; `bound` is the k-th distance
+        bestIndex = np.zeros(0, dtype=np.int64)
+        bestDistance = np.zeros(0)
+        bound = np.inf
+        stack = [(0, 0.0)] if k else []
+        while stack:
+            node, planeDistance = stack.pop()
+            if planeDistance > bound:
+                continue
+            dim = self.splitDim[node]
+            if dim < 0:
+                rows = self.order[self.start[node]:self.end[node]]
+                diff = self.points[rows] - x
+                bestIndex = np.concatenate((bestIndex, rows))
+                bestDistance = np.concatenate(
+                    (bestDistance, np.einsum('ij,ij->i', diff, diff)))
+                # ties are broken by point index, like a stable brute-force sort
+                keep = np.lexsort((bestIndex, bestDistance))[:k]
+                bestIndex, bestDistance = bestIndex[keep], bestDistance[keep]
+                if len(bestIndex) == k:
+                    bound = bestDistance[-1]
+                continue
+            gap = x[dim] - self.splitValue[node]
+            near, far = (self.left[node], self.right[node]) if gap < 0 \
+                else (self.right[node], self.left[node])
+            # the far side is popped after the near one and skipped once it
+            # cannot hold a closer point
+            stack.append((far, gap * gap))
+            stack.append((near, 0.0))
+        return bestIndex, bestDistance
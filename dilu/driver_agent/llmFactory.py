@@ -0,0 +1,242 @@
+"""Chat and embedding model construction shared by the agents and memory.
+
+The backend is picked with the OPENAI_API_TYPE environment variable that
+`setup_env` in run_dilu.py exports: 'openai', 'azure' or 'cassette'.
+Embeddings can instead run locally, see EMBEDDING_BACKEND.
+"""
+import os
+from typing import List
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.schema.embeddings import Embeddings
+
+from dilu.driver_agent.cacheStore import LRUCacheStore
+from dilu.driver_agent.cassette import (
+    Cassette, CassetteChatModel, CassetteEmbeddings
+)
+from dilu.driver_agent.clientPool import RetryingChatModel, clientPool
+from dilu.driver_agent.embeddingCache import CachedEmbeddings
+from dilu.driver_agent.localEmbeddings import HashedNgramEmbeddings, OnnxEmbeddings
+from dilu.driver_agent.responseCache import CachedChatModel
+
+
+def setupLLMEnv(config: dict):
+    """Export the LLM settings of config.yaml as environment variables."""
+    oai_api_type = config['OPENAI_API_TYPE']
+    if oai_api_type == 'cassette':
+        os.environ["CASSETTE_MODE"] = config['CASSETTE_MODE']
+        os.environ["CASSETTE_PATH"] = config['CASSETTE_PATH']
+        os.environ["CASSETTE_LATENCY"] = str(config['CASSETTE_LATENCY'] or 0)
+        os.environ["CASSETTE_BACKEND"] = str(config['CASSETTE_BACKEND'])
+        # only recording talks to the real backend and needs its credentials
+        oai_api_type = config['CASSETTE_BACKEND'] if config['CASSETTE_MODE'] == 'record' else None
+    if oai_api_type == 'azure':
+        os.environ["OPENAI_API_VERSION"] = config['AZURE_API_VERSION']
+        os.environ["OPENAI_API_BASE"] = config['AZURE_API_BASE']
+        os.environ["OPENAI_API_KEY"] = config['AZURE_API_KEY']
+        os.environ["AZURE_CHAT_DEPLOY_NAME"] = config['AZURE_CHAT_DEPLOY_NAME']
+        os.environ["AZURE_EMBED_DEPLOY_NAME"] = config['AZURE_EMBED_DEPLOY_NAME']
+    elif oai_api_type == 'openai':
+        os.environ["OPENAI_API_KEY"] = config['OPENAI_KEY']
+        os.environ["OPENAI_CHAT_MODEL"] = config['OPENAI_CHAT_MODEL']
+    elif oai_api_type is not None:
+        raise ValueError(
+            "Unknown OPENAI_API_TYPE, should be azure, openai or cassette")
+    os.environ["OPENAI_API_TYPE"] = config['OPENAI_API_TYPE']
+    if config.get('LLM_CACHE_PATH'):
+        os.environ["LLM_CACHE_PATH"] = config['LLM_CACHE_PATH']
+        os.environ["LLM_CACHE_SIZE"] = str(config['LLM_CACHE_SIZE'])
+        os.environ["LLM_CACHE_BYPASS"] = str(config['LLM_CACHE_BYPASS'])
+    if config.get('EMBED_CACHE_PATH'):
+        os.environ["EMBED_CACHE_PATH"] = config['EMBED_CACHE_PATH']
+        os.environ["EMBED_CACHE_SIZE"] = str(config['EMBED_CACHE_SIZE'])
+    os.environ["LLM_REQUEST_TIMEOUT"] = str(config.get('LLM_REQUEST_TIMEOUT') or 60)
+    retries = config.get('LLM_MAX_RETRIES')
+    os.environ["LLM_MAX_RETRIES"] = str(3 if retries is None else retries)
+    os.environ["LLM_RETRY_BACKOFF"] = str(config.get('LLM_RETRY_BACKOFF') or 1.0)
+    os.environ["LLM_RETRY_MAX_BACKOFF"] = str(config.get('LLM_RETRY_MAX_BACKOFF') or 30.0)
+    os.environ["LLM_POOL_SIZE"] = str(config.get('LLM_POOL_SIZE') or 16)
+    os.environ["EMBEDDING_BACKEND"] = config.get('EMBEDDING_BACKEND') or 'openai'
+    os.environ["EMBEDDING_DIM"] = str(config.get('EMBEDDING_DIM') or 1024)
+    os.environ["EMBEDDING_MODEL_PATH"] = config.get('EMBEDDING_MODEL_PATH') or ''
+
+
+def _openCassette() -> Cassette:
+    path = os.getenv("CASSETTE_PATH")
+    if os.getenv("CASSETTE_MODE", "replay") == "replay" and not os.path.exists(path):
+        raise FileNotFoundError(
+            f"Cassette {path} does not exist, run with CASSETTE_MODE: 'record' first.")
+    return Cassette.open(path)
+
+
+def _openAIChat(
+    oai_api_type: str, temperature: float, max_tokens: int,
+    request_timeout: int, streaming: bool, model_name: str,
+    callbacks: List[BaseCallbackHandler], pin_api_type: bool, retries: int
+) -> BaseChatModel:
+    # When OPENAI_API_TYPE is 'cassette' the openai package cannot use it, so
+    # the recording clients pin their api type explicitly.
+    if oai_api_type == "azure":
+        extra = {"openai_api_type": "azure"} if pin_api_type else {}
+        llm = AzureChatOpenAI(
+            callbacks=callbacks,
+            deployment_name=os.getenv("AZURE_CHAT_DEPLOY_NAME"),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            request_timeout=request_timeout,
+            streaming=streaming,
+            # retries are left to RetryingChatModel
+            max_retries=0,
+            **extra
+        )
+    elif oai_api_type == "openai":
+        extra = {"model_kwargs": {"api_type": "open_ai"}} if pin_api_type else {}
+        llm = ChatOpenAI(
+            temperature=temperature,
+            callbacks=callbacks,
+            model_name=model_name or os.getenv("OPENAI_CHAT_MODEL"),
+            max_tokens=max_tokens,
+            request_timeout=request_timeout,
+            streaming=streaming,
+            max_retries=0,
+            **extra
+        )
+    else:
+        raise ValueError(
+            "Unknown OPENAI_API_TYPE: should be azure, openai or cassette")
+    return RetryingChatModel(
+        inner=llm, pool=clientPool(),
+        retries=retries,
+        backoff=float(os.getenv("LLM_RETRY_BACKOFF", 1.0)),
+        maxBackoff=float(os.getenv("LLM_RETRY_MAX_BACKOFF", 30.0)),
+    )
+
+
+def _openAIEmbeddings(oai_api_type: str, pin_api_type: bool) -> Embeddings:
+    clientPool()
+    # embeddings keep langchain's own retries, they are not streamed
+    settings = {
+        "request_timeout": float(os.getenv("LLM_REQUEST_TIMEOUT", 60)),
+        # langchain counts attempts, the first one included
+        "max_retries": int(os.getenv("LLM_MAX_RETRIES", 3)) + 1,
+    }
+    if oai_api_type == 'azure':
+        extra = {"openai_api_type": "azure"} if pin_api_type else {}
+        # Azure accepts at most 16 texts per embedding request
+        return OpenAIEmbeddings(
+            deployment=os.environ['AZURE_EMBED_DEPLOY_NAME'], chunk_size=16, **settings, **extra)
+    elif oai_api_type == 'openai':
+        extra = {"openai_api_type": "open_ai"} if pin_api_type else {}
+        return OpenAIEmbeddings(**settings, **extra)
+    else:
+        raise ValueError(
+            "Unknown OPENAI_API_TYPE: should be azure, openai or cassette")
+
+
+def _responseCache() -> LRUCacheStore:
+    return LRUCacheStore.open(
+        os.environ["LLM_CACHE_PATH"], "responses",
+        int(os.getenv("LLM_CACHE_SIZE", 10000))
+    )
+
+
+def buildChatModel(
+    temperature: float = 0.0, max_tokens: int = 2000,
+    request_timeout: float = None, streaming: bool = False,
+    model_name: str = None, callbacks: List[BaseCallbackHandler] = None,
+    retries: int = None
+) -> BaseChatModel:
+    oai_api_type = os.getenv("OPENAI_API_TYPE")
+    if request_timeout is None:
+        request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))
+    if retries is None:
+        retries = int(os.getenv("LLM_MAX_RETRIES", 3))
+    if oai_api_type == "cassette":
+        mode = os.getenv("CASSETTE_MODE", "replay")
+        inner = None
+        if mode == "record":
+            inner = _openAIChat(
+                os.getenv("CASSETTE_BACKEND"), temperature, max_tokens,
+                request_timeout, streaming, model_name, callbacks, True, retries
+            )
+        llm = CassetteChatModel(
+            cassette=_openCassette(),
+            mode=mode, inner=inner,
+            latency=float(os.getenv("CASSETTE_LATENCY", 0)),
+        )
+    else:
+        llm = _openAIChat(
+            oai_api_type, temperature, max_tokens,
+            request_timeout, streaming, model_name, callbacks, False, retries
+        )
+    if os.getenv("LLM_CACHE_PATH"):
+        llm = CachedChatModel(
+            inner=llm, store=_responseCache(),
+            bypass=os.getenv("LLM_CACHE_BYPASS") == "True",
+        )
+    return llm
+
+
+def clientStats() -> dict:
+    """Connection and retry counts of this process, None before any client was built."""
+    if clientPool.cache_info().currsize == 0:
+        return None
+    return clientPool().stats()
+
+
+def llmCacheStats() -> dict:
+    if not os.getenv("LLM_CACHE_PATH"):
+        return None
+    return _responseCache().stats()
+
+
+def _embeddingCache() -> LRUCacheStore:
+    return LRUCacheStore.open(
+        os.environ["EMBED_CACHE_PATH"], "embeddings",
+        int(os.getenv("EMBED_CACHE_SIZE", 50000))
+    )
+
+
+def embeddingCacheStats() -> dict:
+    if not os.getenv("EMBED_CACHE_PATH"):
+        return None
+    return _embeddingCache().stats()
+
+
+def buildLocalEmbeddings(backend: str, fitting: bool = False) -> Embeddings:
+    """`fitting` allows 'hashing' IDF weights that are about to be written."""
+    modelPath = os.getenv("EMBEDDING_MODEL_PATH") or None
+    if backend == 'hashing':
+        return HashedNgramEmbeddings(
+            int(os.getenv("EMBEDDING_DIM", 1024)), modelPath, fitting=fitting)
+    elif backend == 'onnx':
+        if modelPath is None:
+            raise ValueError("The 'onnx' embedding backend needs EMBEDDING_MODEL_PATH.")
+        return OnnxEmbeddings(modelPath)
+    else:
+        raise ValueError(
+            "Unknown EMBEDDING_BACKEND: should be openai, hashing or onnx")
+
+
+def buildEmbeddings() -> Embeddings:
+    oai_api_type = os.getenv("OPENAI_API_TYPE")
+    backend = os.getenv("EMBEDDING_BACKEND", "openai")
+    if backend != 'openai':
+        embedding = buildLocalEmbeddings(backend)
+    elif oai_api_type == "cassette":
+        mode = os.getenv("CASSETTE_MODE", "replay")
+        inner = None
+        if mode == "record":
+            inner = _openAIEmbeddings(os.getenv("CASSETTE_BACKEND"), True)
+        embedding = CassetteEmbeddings(
+            _openCassette(), mode=mode, inner=inner,
+            latency=float(os.getenv("CASSETTE_LATENCY", 0)),
+        )
+    else:
+        embedding = _openAIEmbeddings(oai_api_type, False)
+    if os.getenv("EMBED_CACHE_PATH"):
+        embedding = CachedEmbeddings(embedding, _embeddingCache())
+    return embedding
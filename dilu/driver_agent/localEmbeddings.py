@@ -0,0 +1,194 @@
+"""Embedding models that run on the local CPU, without a remote service.
+
+`HashedNgramEmbeddings` hashes the character n-grams of a text into a fixed
+number of buckets and weights them with TF-IDF. A whole batch is hashed
+with numpy at once: the n-grams of all texts come from one rolling hash over
+the concatenated bytes, and `np.bincount` counts them per text and bucket.
+The IDF weights are fitted on a memory's documents with `fit` and saved next
+to it, see `manage_memory.py reembed`. Without an IDF path every bucket
+weighs the same; a configured path that does not exist is an error.
+
+`OnnxEmbeddings` runs a sentence-embedding model exported to ONNX, with the
+`tokenizer.json` of the model next to the model file. It needs the optional
+`onnxruntime` and `tokenizers` packages.
+
+Both return L2-normalized vectors, so squared L2 distances lie in [0, 4]
+like those of the OpenAI embeddings.
+"""
+import hashlib
+import os
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from dilu.driver_agent.cassette import normalizeText
+
+
+HASH_PRIME = 1099511628211  # odd, so it has an inverse modulo 2**64
+HASH_PRIME_INVERSE = pow(HASH_PRIME, -1, 2 ** 64)
+
+
+def idfFile(idfPath: str) -> str:
+    # `np.save` appends the suffix, so loading has to look for it too
+    return idfPath if idfPath.endswith('.npy') else idfPath + '.npy'
+
+
+def _normalizeRows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def hashedNgramCounts(texts: List[str], dim: int, ngrams: Tuple[int, ...] = (3, 4, 5)) -> np.ndarray:
+    """Count the character n-grams of every text per hash bucket.
+
+    Returns a `(len(texts), dim)` matrix. Texts are normalized like cache
+    keys first, so vehicle ids and whitespace do not change the counts.
+    """
+    encoded = [normalizeText(text).lower().encode('utf-8') for text in texts]
+    lengths = np.array([len(data) for data in encoded], dtype=np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+    counts = np.zeros(len(texts) * dim)
+    if not len(data):
+        return counts.reshape(len(texts), dim)
+    owner = np.repeat(np.arange(len(texts)), lengths)
+    # prefix[i] = sum of data[k] * P**k for k < i, so the hash of the window
+    # data[i:i + n] is (prefix[i + n] - prefix[i]) * P**-i, all modulo 2**64
+    powers = np.full(len(data), HASH_PRIME, dtype=np.uint64)
+    powers[0] = 1
+    powers = np.cumprod(powers, dtype=np.uint64)
+    inverses = np.full(len(data), HASH_PRIME_INVERSE, dtype=np.uint64)
+    inverses[0] = 1
+    inverses = np.cumprod(inverses, dtype=np.uint64)
+    prefix = np.zeros(len(data) + 1, dtype=np.uint64)
+    np.cumsum(data * powers, dtype=np.uint64, out=prefix[1:])
+    for n in ngrams:
+        windows = len(data) - n + 1
+        if windows <= 0:
+            continue
+        start = owner[:windows]
+        # windows that run into the next text are dropped
+        inside = start == owner[n - 1:]
+        hashes = (prefix[n:] - prefix[:windows]) * inverses[:windows]
+        # mix the high bits in and keep n-grams of different sizes apart
+        hashes ^= np.uint64(n * 0x9E3779B97F4A7C15 % 2 ** 64)
+        hashes ^= hashes >> np.uint64(33)
+        hashes *= np.uint64(0xFF51AFD7ED558CCD)
+        hashes ^= hashes >> np.uint64(29)
+        buckets = (hashes % np.uint64(dim)).astype(np.int64)
+        counts += np.bincount(
+            start[inside] * dim + buckets[inside], minlength=len(counts))
+    return counts.reshape(len(texts), dim)
+
+
+class HashedNgramEmbeddings(Embeddings):
+    """TF-IDF weighted character n-grams hashed to `dim` buckets."""
+
+    def __init__(self, dim: int = 1024, idfPath: str = None,
+                 ngrams: Tuple[int, ...] = (3, 4, 5), batchSize: int = 256,
+                 fitting: bool = False) -> None:
+        self.dim = dim
+        self.ngrams = tuple(ngrams)
+        self.batchSize = batchSize
+        self.idf = np.ones(dim, dtype=np.float32)
+        if idfPath and not os.path.exists(idfFile(idfPath)) and not fitting:
+            # equal weights would embed queries unlike the stored vectors
+            raise FileNotFoundError(
+                f"IDF weights {idfFile(idfPath)} do not exist, write them with `manage_memory.py reembed --fit`.")
+        if idfPath and os.path.exists(idfFile(idfPath)):
+            idf = np.load(idfFile(idfPath))
+            if idf.shape != (dim,):
+                raise ValueError(
+                    f"IDF weights in {idfPath} have {idf.shape[0]} buckets, EMBEDDING_DIM is {dim}.")
+            self.idf = idf.astype(np.float32)
+        self._updateName()
+
+    def _updateName(self):
+        # the name keys the embedding cache, so it changes with the weights
+        self.model = f"hashing-{self.dim}"
+        if not np.all(self.idf == 1):
+            self.model += "-" + hashlib.sha256(self.idf.tobytes()).hexdigest()[:8]
+
+    def _batches(self, texts: List[str]) -> Iterable[np.ndarray]:
+        for start in range(0, len(texts), self.batchSize):
+            yield hashedNgramCounts(
+                texts[start:start + self.batchSize], self.dim, self.ngrams)
+
+    def fit(self, texts: List[str]) -> "HashedNgramEmbeddings":
+        """Set the IDF weights from the document frequency of each bucket."""
+        documentFrequency = np.zeros(self.dim)
+        for counts in self._batches(texts):
+            documentFrequency += (counts > 0).sum(axis=0)
+        self.idf = (np.log((1 + len(texts)) / (1 + documentFrequency)) + 1).astype(np.float32)
+        self._updateName()
+        return self
+
+    def save(self, idfPath: str):
+        np.save(idfFile(idfPath), self.idf)
+
+    def embedMatrix(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate([
+            _normalizeRows((np.log1p(counts) * self.idf).astype(np.float32))
+            for counts in self._batches(texts)
+        ])
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedMatrix(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedMatrix([text])[0].tolist()
+
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings from a local ONNX model.
+
+    Token embeddings are mean-pooled over the attention mask when the model
+    does not pool them itself.
+    """
+
+    def __init__(self, modelPath: str, batchSize: int = 64, maxLength: int = 256) -> None:
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError(
+                "The 'onnx' embedding backend needs onnxruntime and tokenizers, "
+                "install them with `pip install onnxruntime tokenizers`.") from e
+        self.session = onnxruntime.InferenceSession(
+            modelPath, providers=['CPUExecutionProvider'])
+        self.tokenizer = Tokenizer.from_file(
+            os.path.join(os.path.dirname(modelPath), 'tokenizer.json'))
+        self.tokenizer.enable_truncation(maxLength)
+        self.tokenizer.enable_padding()
+        self.inputNames = {node.name for node in self.session.get_inputs()}
+        self.batchSize = batchSize
+        self.model = "onnx-" + os.path.basename(os.path.dirname(os.path.abspath(modelPath))) \
+            + "-" + os.path.splitext(os.path.basename(modelPath))[0]
+
+    def embedMatrix(self, texts: List[str]) -> np.ndarray:
+        blocks = []
+        for start in range(0, len(texts), self.batchSize):
+            encodings = self.tokenizer.encode_batch(
+                [normalizeText(text) for text in texts[start:start + self.batchSize]])
+            inputs = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            output = self.session.run(None, {
+                name: value for name, value in inputs.items() if name in self.inputNames})[0]
+            if output.ndim == 3:
+                mask = inputs['attention_mask'][:, :, None].astype(np.float32)
+                output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+            blocks.append(_normalizeRows(output.astype(np.float32)))
+        if not blocks:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(blocks)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedMatrix(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedMatrix([text])[0].tolist()
@@ -0,0 +1,350 @@
+"""In-process memory backend with a memory-mapped embedding matrix.
+
+A store is a directory with three files:
+
+- `embeddings.f32`: the raw float32 matrix, one row per item, appended in
+  place and memory-mapped for search.
+- `items.jsonl`: one `[id, document, metadata]` line per row, in row order.
+- `store.json`: format version, embedding dimension and row count. It is
+  written last, so rows past the count from an interrupted write are ignored.
+
+`LocalMemoryStore` follows the Chroma collection API used by
+`DrivingMemory` (`add`, `get`, `update`, `delete`, `count`, `query`). Queries
+are an exact squared-L2 search over the whole matrix. Once the store has
+`annThreshold` rows and `hnswlib` is installed, an HNSW index is built on
+first use instead. Stores of low-dimensional scenario vectors (`sce_encode`)
+use a `KDTree` with `index='kdtree'` once they reach `KDTREE_MIN_ITEMS`
+rows. Below that, the exact numpy scan is faster than walking the tree.
+"""
+import json
+import os
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from dilu.driver_agent.kdTree import KDTree
+
+FORMAT_VERSION = 1
+KDTREE_MIN_ITEMS = 4096
+
+
+def _matchValue(value: Any, condition: Any) -> bool:
+    if not isinstance(condition, dict):
+        return value == condition
+    op, operand = next(iter(condition.items()))
+    if op == '$eq':
+        return value == operand
+    elif op == '$ne':
+        return value != operand
+    elif op == '$in':
+        return value in operand
+    elif op == '$nin':
+        return value not in operand
+    elif op in ('$gt', '$gte', '$lt', '$lte'):
+        if value is None:
+            return False
+        return {
+            '$gt': value > operand, '$gte': value >= operand,
+            '$lt': value < operand, '$lte': value <= operand,
+        }[op]
+    raise ValueError(f"Unsupported where operator: {op}")
+
+
+def whereMatcher(where: Optional[Dict]) -> Callable[[Dict], bool]:
+    """Turn a Chroma `where` filter into a predicate on metadata dicts."""
+    if not where:
+        return lambda metadata: True
+    if '$and' in where:
+        matchers = [whereMatcher(w) for w in where['$and']]
+        return lambda metadata: all(m(metadata) for m in matchers)
+    if '$or' in where:
+        matchers = [whereMatcher(w) for w in where['$or']]
+        return lambda metadata: any(m(metadata) for m in matchers)
+    return lambda metadata: all(
+        _matchValue(metadata.get(key), condition)
+        for key, condition in where.items()
+    )
+
+
+def _documentMatcher(whereDocument: Optional[Dict]) -> Callable[[str], bool]:
+    if not whereDocument:
+        return lambda document: True
+    if '$contains' in whereDocument:
+        needle = whereDocument['$contains']
+        return lambda document: needle in document
+    raise ValueError(f"Unsupported where_document filter: {whereDocument}")
+
+
+class LocalMemoryStore:
+    _opened: Dict[str, 'LocalMemoryStore'] = {}
+
+    def __init__(self, path: str, annThreshold: int = 20000, index: str = 'auto') -> None:
+        if index not in ('auto', 'kdtree'):
+            raise ValueError("Unknown memory index: should be auto or kdtree")
+        self.path = path
+        self.annThreshold = annThreshold
+        self.index = index
+        self.annIndex = None
+        os.makedirs(path, exist_ok=True)
+        self.headerPath = os.path.join(path, 'store.json')
+        self.matrixPath = os.path.join(path, 'embeddings.f32')
+        self.itemsPath = os.path.join(path, 'items.jsonl')
+        self.dim = 0
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        if os.path.exists(self.headerPath):
+            with open(self.headerPath) as f:
+                header = json.load(f)
+            if header['version'] > FORMAT_VERSION:
+                raise ValueError(
+                    f"Memory store version {header['version']} is newer than supported {FORMAT_VERSION}.")
+            self.dim = header['dim']
+            with open(self.itemsPath, 'r+b') as f:
+                for _ in range(header['count']):
+                    id, document, metadata = json.loads(f.readline())
+                    self.ids.append(id)
+                    self.documents.append(document)
+                    self.metadatas.append(metadata)
+                # drop lines of an add that did not reach the header
+                f.truncate()
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self._mapMatrix()
+
+    @classmethod
+    def open(cls, path: str, annThreshold: int = 20000, index: str = 'auto') -> 'LocalMemoryStore':
+        # one store object per directory and process
+        path = os.path.abspath(path)
+        if path not in cls._opened:
+            cls._opened[path] = cls(path, annThreshold, index)
+        return cls._opened[path]
+
+    def _mapMatrix(self):
+        if self.ids:
+            self.matrix = np.memmap(
+                self.matrixPath, dtype=np.float32, mode='r',
+                shape=(len(self.ids), self.dim)
+            )
+        else:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        # squared norms are computed on the first query, not at startup
+        self.norms = None
+        self.annIndex = None
+        self._clearFilters()
+
+    def _clearFilters(self):
+        # rows and k-d trees per query filter (e.g. one memory partition),
+        # built on first use and dropped whenever the store changes
+        self.filterRows: Dict[str, np.ndarray] = {}
+        self.kdTrees: Dict[str, KDTree] = {}
+
+    def _writeHeader(self):
+        self._clearFilters()
+        tmpPath = self.headerPath + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'dim': self.dim,
+                'count': len(self.ids),
+            }, f)
+        os.replace(tmpPath, self.headerPath)
+
+    def _writeItems(self):
+        with open(self.itemsPath + '.tmp', 'w') as f:
+            for item in zip(self.ids, self.documents, self.metadatas):
+                f.write(json.dumps(item) + '\n')
+        os.replace(self.itemsPath + '.tmp', self.itemsPath)
+        self._writeHeader()
+
+    def _rewrite(self, keep: np.ndarray):
+        # deletes rewrite both files, metadata updates only the sidecar
+        matrix = np.array(self.matrix[keep], dtype=np.float32)
+        self.ids = [self.ids[i] for i in keep]
+        self.documents = [self.documents[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self.matrix = None
+        with open(self.matrixPath + '.tmp', 'wb') as f:
+            f.write(matrix.tobytes())
+        os.replace(self.matrixPath + '.tmp', self.matrixPath)
+        self._writeItems()
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self._mapMatrix()
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids=None, embeddings=None, metadatas=None, documents=None):
+        if isinstance(ids, str):
+            ids, embeddings, metadatas, documents = [
+                ids], [embeddings], [metadatas], [documents]
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in range(len(embeddings))]
+        if not len(ids):
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        if self.dim and vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"Embedding dimension {vectors.shape[1]} does not match the store dimension {self.dim}.")
+        duplicated = [id for id in ids if id in self.positions]
+        if duplicated:
+            raise ValueError(f"IDs already exist in the memory store: {duplicated}")
+        self.dim = vectors.shape[1]
+        metadatas = metadatas or [{} for _ in ids]
+        documents = documents or ['' for _ in ids]
+        with open(self.matrixPath, 'ab') as f:
+            f.seek(len(self.ids) * self.dim * 4)
+            f.truncate()
+            f.write(vectors.tobytes())
+        with open(self.itemsPath, 'a') as f:
+            for item in zip(ids, documents, metadatas):
+                f.write(json.dumps(item) + '\n')
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.positions.update({id: start + i for i, id in enumerate(ids)})
+        self._writeHeader()
+        self._mapMatrix()
+
+    def _select(self, ids=None, where=None, where_document=None) -> List[int]:
+        if ids is not None:
+            ids = [ids] if isinstance(ids, str) else ids
+            rows = [self.positions[id] for id in ids if id in self.positions]
+        else:
+            rows = range(len(self.ids))
+        matchMetadata = whereMatcher(where)
+        matchDocument = _documentMatcher(where_document)
+        return [
+            i for i in rows
+            if matchMetadata(self.metadatas[i]) and matchDocument(self.documents[i])
+        ]
+
+    def _result(self, rows: List[int], include: List[str]) -> Dict[str, Any]:
+        result = {'ids': [self.ids[i] for i in rows]}
+        for field in ('embeddings', 'documents', 'metadatas'):
+            result[field] = None
+        if 'embeddings' in include:
+            result['embeddings'] = self.matrix[rows].tolist()
+        if 'documents' in include:
+            result['documents'] = [self.documents[i] for i in rows]
+        if 'metadatas' in include:
+            result['metadatas'] = [self.metadatas[i] for i in rows]
+        return result
+
+    def get(self, ids=None, where=None, limit=None, offset=None,
+            where_document=None, include=('metadatas', 'documents')):
+        rows = self._select(ids, where, where_document)
+        rows = rows[offset or 0:]
+        if limit is not None:
+            rows = rows[:limit]
+        return self._result(rows, include)
+
+    def update(self, ids, embeddings=None, metadatas=None, documents=None):
+        ids = [ids] if isinstance(ids, str) else ids
+        if isinstance(metadatas, dict):
+            metadatas = [metadatas]
+        if isinstance(documents, str):
+            documents = [documents]
+        if embeddings is not None:
+            vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+            rows = [self.positions[id] for id in ids]
+            matrix = np.memmap(
+                self.matrixPath, dtype=np.float32, mode='r+',
+                shape=(len(self.ids), self.dim)
+            )
+            matrix[rows] = vectors
+            matrix.flush()
+            del matrix
+            self._mapMatrix()
+        for i, id in enumerate(ids):
+            row = self.positions[id]
+            if metadatas is not None:
+                self.metadatas[row] = metadatas[i]
+            if documents is not None:
+                self.documents[row] = documents[i]
+        if metadatas is not None or documents is not None:
+            self._writeItems()
+
+    def delete(self, ids=None, where=None, where_document=None):
+        removed = set(self._select(ids, where, where_document))
+        if removed:
+            self._rewrite(np.array(
+                [i for i in range(len(self.ids)) if i not in removed], dtype=np.int64))
+
+    def _annSearch(self, vector: np.ndarray, k: int):
+        import hnswlib
+        if self.annIndex is None:
+            self.annIndex = hnswlib.Index(space='l2', dim=self.dim)
+            self.annIndex.init_index(max_elements=len(self.ids), ef_construction=200, M=16)
+            self.annIndex.add_items(np.asarray(self.matrix), np.arange(len(self.ids)))
+            self.annIndex.set_ef(max(64, 2 * k))
+        labels, distances = self.annIndex.knn_query(vector, k=k)
+        return labels[0], distances[0]
+
+    def _exactSearch(self, vector: np.ndarray, k: int, rows: Optional[np.ndarray]):
+        if self.norms is None:
+            self.norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        matrix, norms = self.matrix, self.norms
+        if rows is not None:
+            matrix, norms = matrix[rows], norms[rows]
+        # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, same distance as Chroma's l2
+        distances = norms - 2 * (matrix @ vector) + float(vector @ vector)
+        np.maximum(distances, 0, out=distances)
+        if k < len(distances):
+            top = np.argpartition(distances, k)[:k]
+        else:
+            top = np.arange(len(distances))
+        top = top[np.argsort(distances[top], kind='stable')]
+        labels = top if rows is None else rows[top]
+        return labels, distances[top]
+
+    def _useAnn(self) -> bool:
+        if len(self.ids) < self.annThreshold:
+            return False
+        try:
+            import hnswlib  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              where_document=None, include=('metadatas', 'documents', 'distances')):
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim or 1)
+        rows = None
+        filterKey = ''
+        if where or where_document:
+            filterKey = json.dumps([where, where_document], sort_keys=True)
+            if filterKey not in self.filterRows:
+                self.filterRows[filterKey] = np.array(
+                    self._select(None, where, where_document), dtype=np.int64)
+            rows = self.filterRows[filterKey]
+        result = {'ids': [], 'embeddings': None, 'documents': None,
+                  'metadatas': None, 'distances': None}
+        for field in ('embeddings', 'documents', 'metadatas', 'distances'):
+            if field in include:
+                result[field] = []
+        for vector in queries:
+            total = len(self.ids) if rows is None else len(rows)
+            k = min(n_results, total)
+            if k == 0:
+                labels, distances = np.zeros(0, dtype=np.int64), np.zeros(0)
+            elif self.index == 'kdtree' and total >= KDTREE_MIN_ITEMS:
+                if filterKey not in self.kdTrees:
+                    self.kdTrees[filterKey] = KDTree(
+                        self.matrix if rows is None else self.matrix[rows])
+                labels, distances = self.kdTrees[filterKey].query(vector, k)
+                if rows is not None:
+                    labels = rows[labels]
+            elif rows is None and self._useAnn():
+                labels, distances = self._annSearch(vector, k)
+            else:
+                labels, distances = self._exactSearch(vector, k, rows)
+            found = self._result([int(i) for i in labels], include)
+            result['ids'].append(found['ids'])
+            for field in ('embeddings', 'documents', 'metadatas'):
+                if field in include:
+                    result[field].append(found[field])
+            if 'distances' in include:
+                result['distances'].append([float(d) for d in distances])
+        return result
@@ -0,0 +1,130 @@
+"""Portable, versioned snapshots of a `DrivingMemory`.
+
+A snapshot is a directory that does not depend on Chroma or any other
+vector database version:
+
+- `manifest.json`: format name and version, encode type, embedding model,
+  item count and dimension, and a SHA-256 checksum of every other file.
+- `embeddings.npy`: the float32 embedding matrix, memory-mapped on load.
+- `metadata.jsonl.gz`: one `[id, document, metadata]` line per row.
+
+Snapshots are an exchange format and are never queried directly: they
+are imported into a Chroma or local memory with `manage_memory.py import`.
+For fast loading, import into the local backend. `MemorySnapshot` only
+offers the paged reads (`count`, `get` with `limit`/`offset`) that
+`DrivingMemory.combineMemory` needs to import it. Duplicates are matched by
+content hash, as in any other merge.
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Dict
+
+import numpy as np
+
+
+SNAPSHOT_FORMAT = 'dilu-memory-snapshot'
+SNAPSHOT_VERSION = 1
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def exportSnapshot(memory, path: str, batch_size: int = 5000) -> Dict:
+    """Write every item of `memory` to a snapshot directory at `path`."""
+    os.makedirs(path, exist_ok=True)
+    count = memory.collection.count()
+    embeddings = None
+    with gzip.open(os.path.join(path, 'metadata.jsonl.gz'), 'wt', encoding='utf-8') as f:
+        for offset in range(0, count, batch_size):
+            page = memory.collection.get(
+                limit=batch_size, offset=offset,
+                include=['documents', 'metadatas', 'embeddings'])
+            vectors = np.asarray(page['embeddings'], dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    os.path.join(path, 'embeddings.npy'), mode='w+',
+                    dtype=np.float32, shape=(count, vectors.shape[1]))
+            embeddings[offset:offset + len(vectors)] = vectors
+            for id, document, metadata in zip(
+                    page['ids'], page['documents'], page['metadatas']):
+                f.write(json.dumps([id, document, metadata or {}]) + '\n')
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(path, 'embeddings.npy'), embeddings)
+    else:
+        embeddings.flush()
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created_at': time.time(),
+        'encode_type': memory.encode_type,
+        'embedding_model': memory.embedding_model,
+        'count': count,
+        'dim': int(embeddings.shape[1]),
+        'files': {
+            name: _sha256(os.path.join(path, name))
+            for name in ('embeddings.npy', 'metadata.jsonl.gz')
+        },
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class MemorySnapshot:
+    """Read-only, import-only view of a snapshot directory.
+
+    Opening reads only the manifest and memory-maps the matrix; metadata
+    is decompressed the first time it is needed.
+    """
+
+    def __init__(self, path: str, verify: bool = True) -> None:
+        startTime = time.perf_counter()
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} is not a DiLu memory snapshot.")
+        if self.manifest['version'] > SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Memory snapshot version {self.manifest['version']} is newer than supported {SNAPSHOT_VERSION}.")
+        if verify:
+            for name, checksum in self.manifest['files'].items():
+                if _sha256(os.path.join(path, name)) != checksum:
+                    raise ValueError(f"Checksum mismatch for {name} in memory snapshot {path}.")
+        self.encode_type = self.manifest['encode_type']
+        self.embedding_model = self.manifest['embedding_model']
+        self.embedding = None
+        self.collection = self
+        self.embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r')
+        self.items = None
+        self.load_seconds = time.perf_counter() - startTime
+
+    def _loadItems(self):
+        if self.items is None:
+            with gzip.open(os.path.join(self.path, 'metadata.jsonl.gz'), 'rt', encoding='utf-8') as f:
+                self.items = [json.loads(line) for line in f]
+        return self.items
+
+    def count(self) -> int:
+        return self.manifest['count']
+
+    def get(self, limit=None, offset=None, include=('metadatas', 'documents')):
+        start = offset or 0
+        stop = self.count() if limit is None else min(self.count(), start + limit)
+        items = self._loadItems()[start:stop]
+        return {
+            'ids': [item[0] for item in items],
+            'documents': [item[1] for item in items] if 'documents' in include else None,
+            'metadatas': [item[2] for item in items] if 'metadatas' in include else None,
+            'embeddings': np.asarray(self.embeddings[start:stop]).tolist()
+            if 'embeddings' in include else None,
+        }
@@ -1,68 +1,168 @@
-import base64
-import json
+"""Action extraction from the driver agent's answer.
+
+The answer should end with `Response to user:#### <Action_id>`, but models
+sometimes write the action name, add backticks or explanations, or forget
+the delimiter. `OutputParser` tries cheap local tiers in order and only asks
+the LLM when all of them fail:
+
+1. 'delimiter': the text after the last `####` is an action id.
+2. 'regex': an `Action_id` or `Response to user` marker followed by an id.
+3. 'name': exactly one action is named in the decision part of the answer,
+   i.e. after the last `####` or on the `Final Answer:` line. Names are
+   those of `ACTIONS_ALL`/`ACTIONS_DESCRIPTION` plus common synonyms.
+4. 'last_mentioned': the action named last anywhere in the answer.
+5. 'llm': a checking prompt asks the model for the id.
+
+`counts` records which tier resolved each answer.
+"""
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
 from rich import print
-import sqlite3
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, HumanMessage
+
+from dilu.scenario.envScenario import ACTIONS_ALL, ACTIONS_DESCRIPTION
+
+
+delimiter = "####"
+PARSE_TIERS = ('delimiter', 'regex', 'name', 'last_mentioned', 'llm', 'failed')
+EXTRA_SYNONYMS = {
+    0: ('turn left', 'change lane to the left', 'change lanes to the left',
+        'change to the left lane', 'left lane change'),
+    1: ('keep speed', 'keep the current speed', 'maintain the current speed',
+        'maintain my current speed', 'remain in the current lane'),
+    2: ('turn right', 'change lane to the right', 'change lanes to the right',
+        'change to the right lane', 'right lane change'),
+    3: ('accelerate', 'speed up'),
+    4: ('decelerate', 'slow down', 'brake'),
+}
+ACTION_ID_PATTERN = re.compile(
+    r"(?:action[_ ]?id|response to user)\W{0,12}(\d)\b", re.IGNORECASE)
+
+
+def actionSynonyms() -> Dict[str, int]:
+    # the upper-case ACTIONS_ALL names match as written, since 'faster' and
+    # 'slower' also compare speeds in the reasoning; other names match in
+    # any case and are stored lower-cased
+    synonyms = {}
+    for action, name in ACTIONS_ALL.items():
+        synonyms[name] = action
+        synonyms[ACTIONS_DESCRIPTION[action].split(' - ')[0].lower()] = action
+        for synonym in EXTRA_SYNONYMS.get(action, ()):
+            synonyms[synonym] = action
+    return synonyms
+
+
+ACTION_SYNONYMS = actionSynonyms()
+# longest names first, so 'turn left' wins over a shorter overlapping name
+ACTION_NAME_PATTERN = re.compile(
+    r"(?<![\w-])(" + "|".join(
+        re.escape(name) if name in ACTIONS_ALL.values() else f"(?i:{re.escape(name)})"
+        for name in sorted(ACTION_SYNONYMS, key=len, reverse=True)
+    ) + r")(?![\w-])")
+
+
+def checkMessages(decision_action: str) -> List[BaseMessage]:
+    check_message = f"""
+        You are a output checking assistant who is responsible for checking the output of another agent.
+
+        The output you received is: {decision_action}
 
-from langchain.chat_models import AzureChatOpenAI
-from langchain.callbacks import get_openai_callback
-from langchain.output_parsers import ResponseSchema
-from langchain.output_parsers import StructuredOutputParser
-from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+        Your should just output the right int type of action_id, with no other characters or delimiters.
+        i.e. :
+        | Action_id | Action Description                                     |
+        |--------|--------------------------------------------------------|
+        | 0      | Turn-left: change lane to the left of the current lane |
+        | 1      | IDLE: remain in the current lane with current speed   |
+        | 2      | Turn-right: change lane to the right of the current lane|
+        | 3      | Acceleration: accelerate the vehicle                 |
+        | 4      | Deceleration: decelerate the vehicle                 |
 
-from scenario.scenario import Scenario
+
+        You answer format would be:
+        {delimiter} <correct action_id within 0-4>
+        """
+    return [
+        HumanMessage(content=check_message),
+    ]
+
+
+def _validAction(text: str) -> Optional[int]:
+    try:
+        action = int(text)
+    except ValueError:
+        return None
+    return action if action in ACTIONS_ALL else None
+
+
+def decisionPart(response: str) -> str:
+    if delimiter in response:
+        return response.split(delimiter)[-1]
+    match = re.search(r"Final Answer\s*:(.*)", response, re.IGNORECASE)
+    if match:
+        return match.group(1)
+    lines = [line for line in response.splitlines() if line.strip()]
+    return lines[-1] if lines else ""
+
+
+def namedActions(text: str) -> List[int]:
+    names = [match.group(1) for match in ACTION_NAME_PATTERN.finditer(text)]
+    return [ACTION_SYNONYMS[name] if name in ACTION_SYNONYMS else ACTION_SYNONYMS[name.lower()]
+            for name in names]
+
+
+def parseLocally(response: str) -> Tuple[Optional[int], str]:
+    """The action id of `response` and the tier that found it, or
+    `(None, 'failed')` when no local tier can tell."""
+    action = _validAction(response.split(delimiter)[-1].strip().strip('`'))
+    if action is not None:
+        return action, 'delimiter'
+    matches = [_validAction(match.group(1)) for match in ACTION_ID_PATTERN.finditer(response)]
+    matches = [action for action in matches if action is not None]
+    if matches:
+        return matches[-1], 'regex'
+    named = set(namedActions(decisionPart(response)))
+    if len(named) == 1:
+        return named.pop(), 'name'
+    mentioned = namedActions(response)
+    if mentioned:
+        return mentioned[-1], 'last_mentioned'
+    return None, 'failed'
 
 
 class OutputParser:
-    def __init__(self, sce: Scenario, temperature: float = 0.0) -> None:
-        self.sce = sce
-        self.temperature = temperature
-        self.llm = AzureChatOpenAI(
-            deployment_name="GPT35",
-            temperature=temperature,
-        )
-        # todo: put into a yaml file
-        self.response_schemas = [
-            ResponseSchema(
-                name="action_id", description=f"output the id(int) of the decision. The comparative table is:  {{ 0: 'change_lane_left', 1: 'keep_speed or idle', 2: 'change_lane_right', 3: 'accelerate or faster',4: 'decelerate or slower'}} . For example, if the ego car wants to keep speed, please output 1 as a int."),
-            ResponseSchema(
-                name="action_name", description=f"output the name(str) of the decision. MUST consist with previous \"action_id\". The comparative table is:  {{ 0: 'change_lane_left', 1: 'keep_speed', 2: 'change_lane_right', 3: 'accelerate',4: 'decelerate'}} . For example, if the action_id is 3, please output 'Accelerate' as a str."),
-            ResponseSchema(
-                name="explanation", description=f"Explain for the driver why you make such decision in 40 words.")
-        ]
-        self.output_parser = StructuredOutputParser.from_response_schemas(
-            self.response_schemas)
-        self.format_instructions = self.output_parser.get_format_instructions()
-
-    def agentRun(self, final_results: dict) -> str:
-        print('[green]Output parser is running...[/green]')
-        prompt_template = ChatPromptTemplate(
-            messages=[
-                HumanMessagePromptTemplate.from_template(
-                    "parse the problem response follow the format instruction.\nformat_instructions:{format_instructions}\n response: {answer}")
-            ],
-            input_variables=["answer"],
-            partial_variables={"format_instructions": self.format_instructions}
-        )
-        input = prompt_template.format_prompt(
-            answer=final_results['answer']+final_results['thoughts'])
-        with get_openai_callback() as cb:
-            output = self.llm(input.to_messages())
-
-        self.parseredOutput = self.output_parser.parse(output.content)
-        self.dataCommit()
-        print("Finish output agent:\n", cb)
-        return self.parseredOutput
-
-    def dataCommit(self):
-        conn = sqlite3.connect(self.sce.database)
-        cur = conn.cursor()
-        parseredOutput = json.dumps(self.parseredOutput)
-        base64Output = base64.b64encode(
-            parseredOutput.encode('utf-8')).decode('utf-8')
-        cur.execute(
-            """UPDATE decisionINFO SET outputParser ='{}' WHERE frame ={};""".format(
-                base64Output, self.sce.frame
-            )
-        )
-        conn.commit()
-        conn.close()
+    """Local parser chain with an optional LLM fallback and tier counters."""
+
+    def __init__(self, llm: BaseChatModel = None) -> None:
+        self.llm = llm
+        self.counts = Counter()
+
+    def _resolve(self, action: Optional[int], tier: str, response: str) -> int:
+        self.counts[tier] += 1
+        if action is None:
+            raise ValueError(
+                f"Cannot find an action id in the driver answer: {response[-200:]!r}")
+        return action
+
+    def parse(self, response: str) -> int:
+        action, tier = parseLocally(response)
+        if action is None and self.llm is not None:
+            print("Output is not a int number, checking the output...")
+            check_response = self.llm(checkMessages(decisionPart(response)))
+            action, _ = parseLocally(check_response.content)
+            tier = 'llm' if action is not None else 'failed'
+        return self._resolve(action, tier, response)
+
+    async def aparse(self, response: str) -> int:
+        action, tier = parseLocally(response)
+        if action is None and self.llm is not None:
+            print("Output is not a int number, checking the output...")
+            check_response = await self.llm.ainvoke(checkMessages(decisionPart(response)))
+            action, _ = parseLocally(check_response.content)
+            tier = 'llm' if action is not None else 'failed'
+        return self._resolve(action, tier, response)
+
+    def stats(self) -> Dict[str, int]:
+        return {tier: self.counts[tier] for tier in PARSE_TIERS}
@@ -0,0 +1,165 @@
+"""Token budget for the few-shot part of the driver prompt.
+
+The system message and the current scenario are always sent whole. When the
+prompt would exceed the budget, the few-shot examples give way according to
+the policy:
+
+- 'truncate': keep the start of each answer's reasoning and its final
+  `Response to user:#### <id>` line, cutting the middle.
+- 'summarize': keep only the conclusion of every reasoning step, i.e. the
+  last sentence of each `- ` line, plus the final answer and decision. Too
+  long summaries are then truncated.
+- 'drop': drop whole examples, least similar (last retrieved) first.
+
+Answer lengths are shared out so that short answers stay whole and long ones
+are cut to the same size. Whatever policy is used, examples are dropped as a
+last resort when their questions alone do not fit.
+
+Tokens are counted with tiktoken. If its encoding cannot be loaded, e.g. on
+an offline machine, a four-characters-per-token estimate is used instead.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain.schema import BaseMessage
+from rich import print
+
+
+BUDGET_POLICIES = ('truncate', 'summarize', 'drop')
+MESSAGE_OVERHEAD = 3  # role and separator tokens of every chat message
+REPLY_OVERHEAD = 3  # tokens that prime the assistant reply
+CUT_MARKER = "\n...\n"
+
+
+def _loadEncoding(model: Optional[str]):
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print("[yellow]tiktoken encoding unavailable, estimating prompt tokens from characters:[/yellow]", repr(e))
+        return None
+
+
+@lru_cache(maxsize=None)
+def tokenCounter(model: Optional[str] = None) -> "TokenCounter":
+    # loading an encoding parses its whole BPE table, share one per model
+    return TokenCounter(_loadEncoding(model))
+
+
+class TokenCounter:
+    def __init__(self, encoding) -> None:
+        self.encoding = encoding
+        # few-shot answers come back frame after frame
+        self.count = lru_cache(maxsize=4096)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def head(self, text: str, tokens: int) -> str:
+        """The longest start of `text` with at most `tokens` tokens."""
+        if tokens <= 0:
+            return ""
+        if self.encoding is None:
+            return text[:tokens * 4]
+        return self.encoding.decode(
+            self.encoding.encode(text, disallowed_special=())[:tokens])
+
+    def messages(self, messages: Sequence[BaseMessage]) -> int:
+        return sum(self.count(message.content) + MESSAGE_OVERHEAD
+                   for message in messages) + REPLY_OVERHEAD
+
+
+def splitDecision(answer: str) -> Tuple[str, str]:
+    """Split an answer into its reasoning and the final decision line."""
+    index = answer.rfind("Response to user")
+    if index < 0:
+        index = answer.rstrip().rfind("\n") + 1
+    return answer[:index], answer[index:]
+
+
+def truncateAnswer(counter: TokenCounter, answer: str, tokens: int) -> str:
+    reasoning, decision = splitDecision(answer)
+    keep = tokens - counter.count(decision) - counter.count(CUT_MARKER)
+    if keep <= 0:
+        return decision
+    return counter.head(reasoning, keep).rstrip() + CUT_MARKER + decision
+
+
+def summarizeAnswer(answer: str) -> str:
+    reasoning, decision = splitDecision(answer)
+    lines = []
+    for line in reasoning.splitlines():
+        line = line.strip()
+        if line.startswith("- "):
+            sentences = [s for s in re.split(r"(?<=[.!?])\s+", line[2:]) if s]
+            if sentences:
+                lines.append("- " + sentences[-1])
+        elif line.startswith("Final Answer"):
+            lines.append(line)
+    return "\n".join(lines + [decision])
+
+
+def shareBudget(lengths: List[int], budget: int) -> List[int]:
+    """Split `budget` so that short items keep their length and the long
+    ones all get the same share of the rest."""
+    shares = list(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for k, i in enumerate(order):
+        share = remaining // (len(order) - k)
+        if lengths[i] > share:
+            for j in order[k:]:
+                shares[j] = share
+            break
+        remaining -= lengths[i]
+    return shares
+
+
+class PromptBudget:
+    def __init__(self, budget: int, policy: str = 'truncate', model: str = None) -> None:
+        if policy not in BUDGET_POLICIES:
+            raise ValueError(
+                f"Unknown prompt budget policy: should be one of {', '.join(BUDGET_POLICIES)}")
+        self.budget = budget
+        self.policy = policy
+        self.counter = tokenCounter(model)
+
+    def fit(self, fixedTokens: int, questions: List[str], answers: List[str]) -> Tuple[List[str], List[str], Dict]:
+        """Shrink the few-shot examples so that the prompt fits the budget.
+
+        `fixedTokens` counts the messages that are always sent. Returns the
+        examples to send and how many were cut and dropped.
+        """
+        count = self.counter.count
+        questions, answers = list(questions), list(answers)
+        stats = {'cut': 0, 'dropped': 0}
+
+        def total() -> int:
+            return fixedTokens + sum(
+                count(q) + count(a) + 2 * MESSAGE_OVERHEAD for q, a in zip(questions, answers))
+
+        if total() <= self.budget:
+            return questions, answers, stats
+        if self.policy != 'drop':
+            questionTokens = sum(count(q) + 2 * MESSAGE_OVERHEAD for q in questions)
+            shares = shareBudget(
+                [count(a) for a in answers], self.budget - fixedTokens - questionTokens)
+            for i, share in enumerate(shares):
+                if count(answers[i]) <= share:
+                    continue
+                answer = summarizeAnswer(answers[i]) if self.policy == 'summarize' else answers[i]
+                if count(answer) > share:
+                    answer = truncateAnswer(self.counter, answer, share)
+                answers[i] = answer
+                stats['cut'] += 1
+        while questions and total() > self.budget:
+            questions.pop()
+            answers.pop()
+            stats['dropped'] += 1
+        return questions, answers, stats
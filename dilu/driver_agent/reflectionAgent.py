@@ -1,36 +1,48 @@
 import os
 import textwrap
 import time
-from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 
 from rich import print
 
+from dilu.driver_agent.llmFactory import buildChatModel
+
+
+delimiter = "####"
+# 'interactive' asks before adding each memory, 'accept' adds mistake
+# corrections and collision-free frames, 'corrections' only adds mistake
+# corrections and 'reject' adds nothing
+REFLECTION_POLICIES = ('interactive', 'accept', 'corrections', 'reject')
+
+
+def acceptsMemory(policy: str, comments: str) -> bool:
+    """Whether a non-interactive `policy` adds a memory item with `comments`."""
+    if policy not in REFLECTION_POLICIES:
+        raise ValueError(
+            f"Unknown reflection policy: should be one of {', '.join(REFLECTION_POLICIES)}")
+    if policy == 'accept':
+        return True
+    return policy == 'corrections' and comments == 'mistake-correction'
+
 
 class ReflectionAgent:
     def __init__(
-        self, temperature: float = 0.0, verbose: bool = False
+        self, temperature: float = 0.0, verbose: bool = False, retries: int = None
     ) -> None:
         oai_api_type = os.getenv("OPENAI_API_TYPE")
         if oai_api_type == "azure":
             print("Using Azure Chat API")
-            self.llm = AzureChatOpenAI(
-                deployment_name=os.getenv("AZURE_CHAT_DEPLOY_NAME"),
-                temperature=temperature,
-                max_tokens=1000,
-                request_timeout=60,
-            )
         elif oai_api_type == "openai":
             print("[red]Cautious: Reflection mode uses OpenAI GPT-4, may cost a lot of money![/red]")
-            self.llm = ChatOpenAI(
-                temperature=temperature,
-                model_name='gpt-4-1106-preview',
-                max_tokens=1000,
-                request_timeout=60,
-            )
+        self.llm = buildChatModel(
+            temperature=temperature,
+            model_name='gpt-4-1106-preview',
+            max_tokens=1000,
+            # None keeps LLM_MAX_RETRIES
+            retries=retries,
+        )
 
-    def reflection(self, human_message: str, llm_response: str) -> str:
-        delimiter = "####"
+    def reflection_messages(self, human_message: str, llm_response: str):
         system_message = textwrap.dedent(f"""\
         You are ChatGPT, a large language model trained by OpenAI. Now you act as a mature driving assistant, who can give accurate and correct advice for human driver in complex urban driving scenarios.
         You will be given a detailed description of the driving scenario of current frame along with the available actions allowed to take. 
@@ -60,19 +72,30 @@ class ReflectionAgent:
             <Your corrected version of ChatGPT response>
         """)
 
-        print("Self-reflection is running, make take time...")
-        start_time = time.time()
-        messages = [
+        return [
             SystemMessage(content=system_message),
             HumanMessage(content=human_message),
         ]
-        response = self.llm(messages)
+
+    def corrected_memory(self, response_content: str) -> str:
         target_phrase = f"{delimiter} What should ChatGPT do to avoid such errors in the future:"
-        substring = response.content[response.content.find(
+        substring = response_content[response_content.find(
             target_phrase)+len(target_phrase):].strip()
-        corrected_memory = f"{delimiter} I have made a misake before and below is my self-reflection:\n{substring}"
+        return f"{delimiter} I have made a misake before and below is my self-reflection:\n{substring}"
+
+    def reflection(self, human_message: str, llm_response: str) -> str:
+        print("Self-reflection is running, make take time...")
+        start_time = time.time()
+        response = self.llm(self.reflection_messages(human_message, llm_response))
+        corrected_memory = self.corrected_memory(response.content)
         print("Reflection done. Time taken: {:.2f}s".format(
             time.time() - start_time))
         print("corrected_memory:", corrected_memory)
 
         return corrected_memory
+
+    async def areflection(self, human_message: str, llm_response: str) -> str:
+        """Async counterpart of `reflection`, for reflecting on many frames at once."""
+        response = await self.llm.ainvoke(
+            self.reflection_messages(human_message, llm_response))
+        return self.corrected_memory(response.content)
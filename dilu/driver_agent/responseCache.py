@@ -0,0 +1,144 @@
+"""On-disk response cache in front of the chat model.
+
+With temperature 0 and only a handful of test seeds, the same
+`few_shot_decision` message lists come back across episodes and runs. The
+cache answers them from SQLite instead of a new LLM call. Keys combine the
+model name, the temperature and a normalized hash of the messages.
+
+A stream that the caller closes early, once the decision is parsed, is
+stored up to that point if it already holds the decision line.
+"""
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk
+
+from dilu.driver_agent.cacheStore import LRUCacheStore
+from dilu.driver_agent.cassette import promptHash, splitChunks
+from dilu.driver_agent.decisionStream import DECISION_PATTERN
+
+
+def modelName(llm: BaseChatModel) -> str:
+    return getattr(llm, "deployment_name", None) or \
+        getattr(llm, "model_name", None) or llm._llm_type
+
+
+class CachedChatModel(BaseChatModel):
+    """Chat model wrapper that serves repeated prompts from a `LRUCacheStore`.
+
+    With `bypass` set, lookups are skipped but fresh answers are still
+    written, which refreshes the cache without reading stale entries.
+    """
+
+    inner: BaseChatModel
+    store: Any
+    bypass: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "dilu-cached-chat"
+
+    def _key(self, messages: List[BaseMessage]) -> str:
+        return promptHash(
+            messages, modelName(self.inner),
+            getattr(self.inner, "temperature", None)
+        )
+
+    def _lookup(self, key: str) -> Optional[str]:
+        if self.bypass:
+            return None
+        response = self.store.get(key)
+        return response.decode('utf-8') if response is not None else None
+
+    def _store(self, key: str, response: str):
+        self.store.put(key, response.encode('utf-8'))
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages)
+        response = self._lookup(key)
+        if response is None:
+            response = self.inner(messages, stop=stop, **kwargs).content
+            self._store(key, response)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages)
+        response = self._lookup(key)
+        if response is None:
+            response = (await self.inner.ainvoke(messages, stop=stop, **kwargs)).content
+            self._store(key, response)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        key = self._key(messages)
+        response = self._lookup(key)
+        if response is not None:
+            for piece in splitChunks(response):
+                yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            return
+        response = ""
+        stream = self.inner.stream(messages, stop=stop, **kwargs)
+        try:
+            for chunk in stream:
+                response += chunk.content
+                yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+        except GeneratorExit:
+            # the consumer stopped once it had the decision, which is all a
+            # later lookup needs, so the partial answer is kept
+            if DECISION_PATTERN.search(response):
+                self._store(key, response)
+            raise
+        finally:
+            stream.close()
+        self._store(key, response)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._key(messages)
+        response = self._lookup(key)
+        if response is not None:
+            for piece in splitChunks(response):
+                yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            return
+        response = ""
+        stream = self.inner.astream(messages, stop=stop, **kwargs)
+        try:
+            async for chunk in stream:
+                response += chunk.content
+                yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.content))
+        except GeneratorExit:
+            if DECISION_PATTERN.search(response):
+                self._store(key, response)
+            raise
+        finally:
+            await stream.aclose()
+        self._store(key, response)
@@ -1,107 +1,642 @@
+import json
 import os
+import time
 import textwrap
+import uuid
+import weakref
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 from langchain.vectorstores import Chroma
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.docstore.document import Document
 
-from dilu.scenario.envScenario import EnvScenario
+from dilu.scenario.envScenario import EnvScenario, roadContextFromDescription
+from dilu.scenario.frameRecord import FrameRecord
+from dilu.scenario.scenarioVector import encodeScenario
+from dilu.driver_agent.llmFactory import buildEmbeddings
+from dilu.driver_agent.cassette import CassetteEmbeddings, textHash
+from dilu.driver_agent.embeddingCache import CachedEmbeddings, embeddingModelName
+from dilu.driver_agent.localMemory import LocalMemoryStore
+
+
+class MemoryItem(NamedTuple):
+    sce_descrip: str
+    human_question: str
+    response: str
+    action: int
+    comments: str = ""
+    # only used by `sce_encode` memories
+    sce_vector: Optional[List[float]] = None
+
+
+def contentHash(sce_descrip: str) -> str:
+    return textHash(sce_descrip.replace("'", ''))
+
+
+MERGE_POLICIES = ('skip', 'newest', 'mistake-correction')
+HIT_FLUSH_EVERY = 50  # retrievals between writes of the hit counters
+# default squared L2 radius of duplicates per encode type: text embeddings are
+# unit vectors, scenario vectors count about 5 m/s or 10 m per unit
+DEDUP_RADIUS = {'sce_language': 0.02, 'sce_encode': 0.25}
+COMPACT_HEADROOM = 0.9  # compaction shrinks a full memory to this share of its capacity
+REUSE_POOL_FACTOR = 3  # candidates kept per result for re-ranking reused retrievals
+EMBEDDING_MARKER = 'embedding_model.json'  # records which model embedded a sce_language store
+
+
+def itemValue(metadata: Dict) -> Tuple:
+    # mistake corrections encode what the agent got wrong, keep them longest
+    return (
+        metadata.get('comments') == 'mistake-correction',
+        metadata.get('hits', 0),
+        metadata.get('last_hit', 0) or metadata.get('created_at', 0),
+    )
+
+
+def preferIncoming(policy: str, current: Dict, incoming: Dict) -> bool:
+    if policy == 'newest':
+        return incoming.get('created_at', 0) > current.get('created_at', 0)
+    elif policy == 'mistake-correction':
+        return incoming.get('comments') == 'mistake-correction' \
+            and current.get('comments') != 'mistake-correction'
+    return False
+
+
+def squaredDistances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    distances = np.einsum('ij,ij->i', a, a)[:, None] \
+        + np.einsum('ij,ij->i', b, b)[None, :] - 2 * (a @ b.T)
+    return np.maximum(distances, 0, out=distances)
+
+
+def leaderClusters(vectors: np.ndarray, order: List[int], radius: float,
+                   blockSize: int = 1024) -> Tuple[List[int], np.ndarray]:
+    """Greedy leader clustering of `vectors`, visited in `order`.
+
+    An item within `radius` (squared L2) of an earlier leader joins the
+    nearest one, otherwise it becomes a leader itself. Blocks of items are
+    compared with the leaders so far in one matrix product. Returns the
+    leaders in visiting order and, for every item, the index of its leader.
+    """
+    owner = np.arange(len(vectors))
+    leaders: List[int] = []
+    for start in range(0, len(order), blockSize):
+        block = order[start:start + blockSize]
+        blockVectors = vectors[block]
+        if leaders:
+            toLeaders = squaredDistances(blockVectors, vectors[leaders])
+            nearestOld = toLeaders.argmin(axis=1)
+            nearestOldDistance = toLeaders[np.arange(len(block)), nearestOld]
+        else:
+            nearestOld = np.zeros(len(block), dtype=np.int64)
+            nearestOldDistance = np.full(len(block), np.inf)
+        inBlock = squaredDistances(blockVectors, blockVectors)
+        blockLeaders: List[int] = []
+        for j, item in enumerate(block):
+            distance, leader = nearestOldDistance[j], leaders[nearestOld[j]] if leaders else -1
+            if blockLeaders:
+                k = int(np.argmin(inBlock[j, blockLeaders]))
+                if inBlock[j, blockLeaders[k]] < distance:
+                    distance, leader = inBlock[j, blockLeaders[k]], block[blockLeaders[k]]
+            if distance <= radius:
+                owner[item] = leader
+            else:
+                blockLeaders.append(j)
+        leaders.extend(block[j] for j in blockLeaders)
+    return leaders, owner
+
+
+@dataclass
+class RetrievalReuse:
+    """The last full retrieval of one scenario and how often it was reused.
+
+    `pool` holds the ids, metadatas and embeddings of the `REUSE_POOL_FACTOR`
+    times `top_k` nearest items to `query`. A later query close to `query`
+    re-ranks the pool instead of searching the whole memory.
+    """
+    query: Optional[np.ndarray] = None
+    where: Optional[Dict] = None
+    top_k: int = 0
+    generation: int = -1
+    poolIds: List[str] = field(default_factory=list)
+    poolMetadatas: List[Dict] = field(default_factory=list)
+    poolEmbeddings: Optional[np.ndarray] = None
+    lookups: int = 0
+    reused: int = 0
+    # distance to the previous query of every retrieval that searched again
+    refreshDistances: List[float] = field(default_factory=list)
+
+    def stats(self) -> Dict:
+        return {
+            'lookups': self.lookups,
+            'reused': self.reused,
+            'reuse_rate': self.reused / self.lookups if self.lookups else 0.0,
+            'refresh_distances': list(self.refreshDistances),
+        }
+
+
+def partitionOf(sce_descrip: str) -> str:
+    context = roadContextFromDescription(sce_descrip)
+    return context.partitionKey() if context is not None else 'unknown'
+
+
+def partitionDistance(key: str, other: str) -> float:
+    # same lane count and neighbouring lanes first, then other lane counts;
+    # junctions and unparsed items only when nothing closer is left
+    if key == other:
+        return 0
+    if 'junction' in (key, other) or 'unknown' in (key, other):
+        return 100
+    lanes, rank = map(int, key.split('-'))
+    otherLanes, otherRank = map(int, other.split('-'))
+    return 2 * abs(lanes - otherLanes) + abs(rank - otherRank)
+
+
+def partitionFilter(partitions: List[str]) -> Dict:
+    if len(partitions) == 1:
+        return {'partition': partitions[0]}
+    return {'$or': [{'partition': key} for key in partitions]}
 
 
 class DrivingMemory:
 
-    def __init__(self, encode_type='sce_language', db_path=None) -> None:
+    def __init__(self, encode_type='sce_language', db_path=None, backend='chroma',
+                 capacity: int = None, dedup_radius: float = None, track_hits: bool = False,
+                 hit_flush_every: Optional[int] = HIT_FLUSH_EVERY,
+                 partitioned: bool = False, partition_min: int = 20,
+                 reuse_radius: float = None, embedding=None,
+                 check_embedding: bool = True) -> None:
+        startTime = time.perf_counter()
         self.encode_type = encode_type
+        self.backend = backend
+        self._contentIndex = None
+        # `capacity` bounds the number of items, see `compact`
+        self.capacity = capacity
+        self.dedup_radius = DEDUP_RADIUS.get(encode_type) if dedup_radius is None else dedup_radius
+        # with `track_hits`, retrievals are counted in the `hits`/`last_hit`
+        # metadata, which writes to the store being read; with
+        # `hit_flush_every` None the counts stay in `pendingHits` until
+        # `takeHits` hands them to the process that writes them
+        self.track_hits = track_hits
+        self.hit_flush_every = hit_flush_every
+        self.pendingHits: Dict[str, int] = {}
+        self.pendingRetrievals = 0
+        # with `partitioned`, queries only search the items of the same road
+        # context, widened to neighbouring contexts below `partition_min` items
+        self.partitioned = partitioned
+        self.partition_min = partition_min
+        self._partitionCounts = None
+        self._untagged = 0
+        # with `reuse_radius`, a query within this squared L2 distance of the
+        # same scenario's previous query re-ranks the previous candidates
+        self.reuse_radius = reuse_radius
+        self.reuseStates = weakref.WeakKeyDictionary()
+        # bumped on every write, reused candidates are only valid within one
+        self.generation = 0
         if encode_type == 'sce_encode':
-            # 'sce_encode' is deprecated for now.
-            raise ValueError("encode_type sce_encode is deprecated for now.")
+            # numeric scenario vectors are few-dimensional, so they always
+            # live in a local store searched with a k-d tree
+            self.embedding = None
+            db_path = os.path.join(
+                './db', 'sce_encode_mem/') if db_path is None else db_path
+            self.collection = LocalMemoryStore.open(db_path, index='kdtree')
         elif encode_type == 'sce_language':
-            if os.environ["OPENAI_API_TYPE"] == 'azure':
-                self.embedding = OpenAIEmbeddings(
-                    deployment=os.environ['AZURE_EMBED_DEPLOY_NAME'], chunk_size=1)
-            elif os.environ["OPENAI_API_TYPE"] == 'openai':
-                self.embedding = OpenAIEmbeddings()
-            else:
-                raise ValueError(
-                    "Unknown OPENAI_API_TYPE: should be azure or openai")
+            # `embedding` overrides the model configured by EMBEDDING_BACKEND
+            self.embedding = embedding if embedding is not None else buildEmbeddings()
             db_path = os.path.join(
                 './db', 'chroma_5_shot_20_mem/') if db_path is None else db_path
-            self.scenario_memory = Chroma(
-                embedding_function=self.embedding,
-                persist_directory=db_path
-            )
+            if backend == 'chroma':
+                self.scenario_memory = Chroma(
+                    embedding_function=self.embedding,
+                    persist_directory=db_path
+                )
+                self.collection = self.scenario_memory._collection
+            elif backend == 'local':
+                self.collection = LocalMemoryStore.open(db_path)
+            else:
+                raise ValueError(
+                    "Unknown memory backend: should be chroma or local")
         else:
             raise ValueError(
                 "Unknown ENCODE_TYPE: should be sce_encode or sce_language")
-        print("==========Loaded ",db_path," Memory, Now the database has ", len(
-            self.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.==========")
+        self.db_path = db_path
+        if check_embedding:
+            self.checkEmbeddingModel()
+        self.load_seconds = time.perf_counter() - startTime
+        print("==========Loaded ", db_path, " Memory, Now the database has ",
+              self.collection.count(), " items. Load time: {:.1f} ms.==========".format(
+                  self.load_seconds * 1000))
+
+    @property
+    def embedding_model(self) -> str:
+        if self.embedding is None:
+            return self.encode_type
+        return embeddingModelName(self.embedding)
 
-    def retriveMemory(self, driving_scenario: EnvScenario, frame_id: int, top_k: int = 5):
+    def _replaying(self) -> bool:
+        # replayed vectors were recorded from a model the cassette does not name
+        embedding = self.embedding
+        while isinstance(embedding, CachedEmbeddings):
+            embedding = embedding.inner
+        return isinstance(embedding, CassetteEmbeddings) and embedding.mode == 'replay'
+
+    def checkEmbeddingModel(self):
+        """Refuse a store that was embedded by another model than the configured one."""
+        marker = os.path.join(self.db_path, EMBEDDING_MARKER)
+        if self.embedding is None or self._replaying() or not os.path.exists(marker):
+            return
+        with open(marker) as f:
+            stored = json.load(f)['embedding_model']
+        if stored != self.embedding_model:
+            raise ValueError(
+                f"Memory {self.db_path} was embedded with {stored}, but the configured embedding model is "
+                f"{self.embedding_model}. Check EMBEDDING_BACKEND or re-embed it with `manage_memory.py reembed`.")
+
+    def markEmbeddingModel(self):
+        """Record the embedding model of a store that is about to get its first items."""
+        if self.embedding is None or self._replaying():
+            return
+        os.makedirs(self.db_path, exist_ok=True)
+        with open(os.path.join(self.db_path, EMBEDDING_MARKER), 'w') as f:
+            json.dump({'embedding_model': self.embedding_model}, f)
+
+    def retriveMemory(self, driving_scenario: EnvScenario, frame_id: int, top_k: int = 5,
+                      with_scores: bool = False):
+        """The metadata of the `top_k` memories closest to the scenario.
+
+        With `with_scores`, `(metadata, similarity)` pairs are returned
+        instead, where similarity is `1 - d / 2` for the squared L2 distance
+        `d`: the cosine similarity for the normalized text embeddings.
+        """
+        where = None
+        if self.partitioned and self.partitionsTagged():
+            partitions = self.routePartitions(
+                driving_scenario.roadContext(frame_id).partitionKey(), top_k)
+            available = sum(self.partitionCounts()[key] for key in partitions)
+            where = partitionFilter(partitions)
+        else:
+            available = self.collection.count()
+        top_k = min(top_k, available)
+        if top_k == 0:
+            return []
         if self.encode_type == 'sce_encode':
-            pass
+            query_embedding = encodeScenario(driving_scenario, frame_id)
         elif self.encode_type == 'sce_language':
             query_scenario = driving_scenario.describe(frame_id)
-            similarity_results = self.scenario_memory.similarity_search_with_score(
-                query_scenario, k=top_k)
+            query_embedding = self.embedding.embed_query(query_scenario)
+        if self.reuse_radius:
+            ids, fewshot_results, distances = self._reuseOrQuery(
+                driving_scenario, np.asarray(query_embedding, dtype=np.float32), where, top_k, available)
+        else:
+            similarity_results = self.collection.query(
+                query_embeddings=[query_embedding], where=where,
+                n_results=top_k, include=['metadatas', 'distances'])
+            ids = similarity_results['ids'][0]
+            distances = similarity_results['distances'][0]
             fewshot_results = []
-            for idx in range(0, len(similarity_results)):
-                # print(f"similarity score: {similarity_results[idx][1]}")
-                fewshot_results.append(similarity_results[idx][0].metadata)
+            for idx in range(0, len(ids)):
+                # print(f"similarity score: {similarity_results['distances'][0][idx]}")
+                fewshot_results.append(similarity_results['metadatas'][0][idx])
+        if self.track_hits:
+            self.recordHits(ids)
+        if with_scores:
+            return [(metadata, 1 - float(distance) / 2)
+                    for metadata, distance in zip(fewshot_results, distances)]
         return fewshot_results
 
-    def addMemory(self, sce_descrip: str, human_question: str, response: str, action: int, sce: EnvScenario = None, comments: str = ""):
-        if self.encode_type == 'sce_encode':
-            pass
-        elif self.encode_type == 'sce_language':
-            sce_descrip = sce_descrip.replace("'", '')
-        # https://docs.trychroma.com/usage-guide#using-where-filters
-        get_results = self.scenario_memory._collection.get(
-            where_document={
-                "$contains": sce_descrip
-            }
-        )
-        # print("get_results: ", get_results)
-
-        if len(get_results['ids']) > 0:
-            # already have one
-            id = get_results['ids'][0]
-            self.scenario_memory._collection.update(
-                ids=id, metadatas={"human_question": human_question,
-                                   'LLM_response': response, 'action': action, 'comments': comments}
+    def _reuseOrQuery(self, driving_scenario: EnvScenario, query: np.ndarray,
+                      where: Optional[Dict], top_k: int, available: int) -> Tuple[List[str], List[Dict], List[float]]:
+        state = self.reuseStates.setdefault(driving_scenario, RetrievalReuse())
+        state.lookups += 1
+        if state.query is not None and state.where == where and state.top_k == top_k \
+                and state.generation == self.generation:
+            diff = query - state.query
+            distance = float(diff @ diff)
+            if distance <= self.reuse_radius:
+                state.reused += 1
+                distances = squaredDistances(query[None, :], state.poolEmbeddings)[0]
+                order = np.argsort(distances, kind='stable')[:top_k]
+                return [state.poolIds[i] for i in order], [state.poolMetadatas[i] for i in order], \
+                    distances[order].tolist()
+            state.refreshDistances.append(distance)
+        similarity_results = self.collection.query(
+            query_embeddings=[query.tolist()], where=where,
+            n_results=min(top_k * REUSE_POOL_FACTOR, available),
+            include=['metadatas', 'embeddings', 'distances'])
+        # the anchor stays at this query, so reused results never drift more
+        # than `reuse_radius` away from the search that produced the pool
+        state.query, state.where, state.top_k = query, where, top_k
+        state.generation = self.generation
+        state.poolIds = similarity_results['ids'][0]
+        state.poolMetadatas = similarity_results['metadatas'][0]
+        state.poolEmbeddings = np.asarray(
+            similarity_results['embeddings'][0], dtype=np.float32)
+        return state.poolIds[:top_k], state.poolMetadatas[:top_k], \
+            similarity_results['distances'][0][:top_k]
+
+    def reuseStats(self, driving_scenario: EnvScenario) -> Optional[Dict]:
+        """Reuse counters of one scenario, None if it never retrieved with reuse."""
+        state = self.reuseStates.get(driving_scenario)
+        return state.stats() if state is not None else None
+
+    def partitionCounts(self) -> Counter:
+        # items per partition, built once; items stored before partitioning
+        # are counted from their description, but never written back here,
+        # since several processes may be reading the same store
+        if self._partitionCounts is None:
+            items = self.collection.get(include=['documents', 'metadatas'])
+            self._partitionCounts = Counter()
+            self._untagged = 0
+            for document, metadata in zip(items['documents'], items['metadatas']):
+                partition = (metadata or {}).get('partition')
+                if partition is None:
+                    partition = partitionOf(document)
+                    self._untagged += 1
+                self._partitionCounts[partition] += 1
+            if self._untagged:
+                print(self._untagged, "memory items have no road-context partition, searching the whole memory.",
+                      "Run `python manage_memory.py partition -m <memory path>` to tag them.")
+        return self._partitionCounts
+
+    def partitionsTagged(self) -> bool:
+        """Whether every item carries the `partition` metadata a filtered query needs."""
+        self.partitionCounts()
+        return self._untagged == 0
+
+    def tagPartitions(self) -> int:
+        """Write the `partition` metadata of items stored before partitioning."""
+        items = self.collection.get(include=['documents', 'metadatas'])
+        missing = {
+            id: dict(metadata or {}, partition=partitionOf(document))
+            for id, document, metadata in zip(items['ids'], items['documents'], items['metadatas'])
+            if 'partition' not in (metadata or {})
+        }
+        if missing:
+            self.collection.update(
+                ids=list(missing), metadatas=list(missing.values()))
+            self.generation += 1
+        self._partitionCounts = None
+        print("Assigned road-context partitions to", len(missing), "memory items.")
+        return len(missing)
+
+    def routePartitions(self, key: str, top_k: int) -> List[str]:
+        """The partition of `key` plus its nearest neighbours, until they hold
+        at least `partition_min` (and `top_k`) items."""
+        counts = self.partitionCounts()
+        wanted = max(self.partition_min, top_k)
+        partitions, total = [], 0
+        for candidate in sorted(counts, key=lambda other: (partitionDistance(key, other), other)):
+            if total >= wanted:
+                break
+            partitions.append(candidate)
+            total += counts[candidate]
+        return partitions
+
+    def recordHits(self, ids: List[str]):
+        for id in ids:
+            self.pendingHits[id] = self.pendingHits.get(id, 0) + 1
+        self.pendingRetrievals += 1
+        if self.hit_flush_every is not None and self.pendingRetrievals >= self.hit_flush_every:
+            self.flushHits()
+
+    def takeHits(self) -> Dict[str, int]:
+        """Hand over the pending retrieval counts without writing them."""
+        hits, self.pendingHits = self.pendingHits, {}
+        self.pendingRetrievals = 0
+        return hits
+
+    def addHits(self, hits: Dict[str, int]):
+        """Add retrieval counts taken from another process's memory."""
+        for id, count in hits.items():
+            self.pendingHits[id] = self.pendingHits.get(id, 0) + count
+
+    def flushHits(self):
+        """Write the pending retrieval counts to the `hits`/`last_hit` metadata."""
+        if not self.pendingHits:
+            return
+        items = self.collection.get(
+            ids=list(self.pendingHits), include=['metadatas'])
+        now = time.time()
+        metadatas = []
+        for id, metadata in zip(items['ids'], items['metadatas']):
+            metadata = dict(metadata or {})
+            metadata['hits'] = metadata.get('hits', 0) + self.pendingHits[id]
+            metadata['last_hit'] = now
+            metadatas.append(metadata)
+        if items['ids']:
+            self.collection.update(ids=items['ids'], metadatas=metadatas)
+        self.pendingHits = {}
+        self.pendingRetrievals = 0
+
+    def compact(self, capacity: int = None, dedup_radius: float = None) -> Dict[str, int]:
+        """Consolidate near-duplicate items and evict cold ones.
+
+        Items are visited from most to least valuable: mistake corrections
+        first, then by retrieval hits and recency. An item closer than
+        `dedup_radius` (squared L2) to an already kept item is merged into it
+        and its hits are added to the kept item's. If more than `capacity`
+        items remain, the least valuable ones are evicted.
+        """
+        capacity = self.capacity if capacity is None else capacity
+        dedup_radius = self.dedup_radius if dedup_radius is None else dedup_radius
+        self.flushHits()
+        items = self.collection.get(include=['metadatas', 'embeddings'])
+        if not items['ids']:
+            return {'merged': 0, 'evicted': 0}
+        metadatas = [metadata or {} for metadata in items['metadatas']]
+        vectors = np.asarray(items['embeddings'], dtype=np.float32)
+        order = sorted(range(len(metadatas)), key=lambda i: itemValue(metadatas[i]), reverse=True)
+
+        leaders, owner = leaderClusters(vectors, order, dedup_radius)
+        absorbed: Dict[int, int] = {}
+        for i, leader in enumerate(owner):
+            if leader != i:
+                absorbed[leader] = absorbed.get(leader, 0) + metadatas[i].get('hits', 0)
+        merged = len(order) - len(leaders)
+        # leaders are already in value order, so the tail is the coldest
+        evicted = leaders[capacity:] if capacity is not None else []
+        kept = leaders[:capacity] if capacity is not None else leaders
+
+        updates = [i for i in kept if absorbed.get(i)]
+        if updates:
+            self.collection.update(
+                ids=[items['ids'][i] for i in updates],
+                metadatas=[dict(metadatas[i], hits=metadatas[i].get('hits', 0) + absorbed[i])
+                           for i in updates]
             )
-            print("Modify a memory item. Now the database has ", len(
-                self.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
-        else:
-            doc = Document(
-                page_content=sce_descrip,
-                metadata={"human_question": human_question,
-                          'LLM_response': response, 'action': action, 'comments': comments}
+        keptSet = set(kept)
+        removed = [items['ids'][i] for i in range(len(order)) if i not in keptSet]
+        if removed:
+            self.deleteMemory(removed)
+        print("Compaction complete. Merged", merged, "near-duplicates and evicted",
+              len(evicted), "cold items. Now the database has ", self.collection.count(), " items.")
+        return {'merged': merged, 'evicted': len(evicted)}
+
+    def contentIndex(self) -> Dict[str, str]:
+        # content hash -> memory id, built once from the stored documents;
+        # items written before the hash was kept in metadata are hashed here
+        if self._contentIndex is None:
+            items = self.collection.get(include=['documents', 'metadatas'])
+            self._contentIndex = {}
+            for id, document, metadata in zip(items['ids'], items['documents'], items['metadatas']):
+                key = (metadata or {}).get('content_hash') or contentHash(document)
+                self._contentIndex.setdefault(key, id)
+        return self._contentIndex
+
+    def addMemories(self, items: List[MemoryItem]) -> Dict[str, int]:
+        """Add or update many memory items with one embedding batch and one write.
+
+        Items are deduplicated by the hash of their scenario description.
+        Known descriptions update the stored item, and within `items` the
+        last one with a given description wins.
+        """
+        index = self.contentIndex()
+        if not index:
+            self.markEmbeddingModel()
+        latest: Dict[str, MemoryItem] = {}
+        for item in items:
+            item = item._replace(sce_descrip=item.sce_descrip.replace("'", ''))
+            if self.encode_type == 'sce_encode' and item.sce_vector is None:
+                raise ValueError(
+                    "sce_encode memories need the frame's scenario vector, pass a FrameRecord with sce_vector.")
+            latest[contentHash(item.sce_descrip)] = item
+
+        created_at = time.time()
+
+        def metadata(key: str, item: MemoryItem) -> Dict:
+            return {"human_question": item.human_question,
+                    'LLM_response': item.response, 'action': item.action,
+                    'comments': item.comments, 'content_hash': key,
+                    'created_at': created_at,
+                    'partition': partitionOf(item.sce_descrip)}
+
+        updates = [(key, item) for key, item in latest.items() if key in index]
+        additions = [(key, item) for key, item in latest.items() if key not in index]
+        self.generation += 1
+        if updates:
+            self.collection.update(
+                ids=[index[key] for key, _ in updates],
+                metadatas=[metadata(key, item) for key, item in updates]
             )
-            id = self.scenario_memory.add_documents([doc])
-            print("Add a memory item. Now the database has ", len(
-                self.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
+        if additions:
+            documents = [item.sce_descrip for _, item in additions]
+            if self.encode_type == 'sce_encode':
+                embeddings = [list(item.sce_vector) for _, item in additions]
+            else:
+                embeddings = self.embedding.embed_documents(documents)
+            ids = [str(uuid.uuid1()) for _ in additions]
+            self.collection.add(
+                ids=ids,
+                embeddings=embeddings,
+                metadatas=[metadata(key, item) for key, item in additions],
+                documents=documents
+            )
+            index.update((key, id) for (key, _), id in zip(additions, ids))
+            if self._partitionCounts is not None:
+                self._partitionCounts.update(
+                    partitionOf(item.sce_descrip) for _, item in additions)
+        print("Add", len(additions), "and modify", len(updates),
+              "memory items. Now the database has ", self.collection.count(), " items.")
+        if self.capacity is not None and self.collection.count() > self.capacity:
+            # leave some headroom so that the next few adds do not compact again
+            self.compact(int(self.capacity * COMPACT_HEADROOM))
+        return {'added': len(additions), 'updated': len(updates)}
+
+    def addMemory(self, sce_descrip: str, human_question: str, response: str, action: int, sce: FrameRecord = None, comments: str = ""):
+        self.addMemories([MemoryItem(
+            sce_descrip, human_question, response, action, comments,
+            sce.sce_vector if sce is not None else None
+        )])
 
     def deleteMemory(self, ids):
-        self.scenario_memory._collection.delete(ids=ids)
-        print("Delete", len(ids), "memory items. Now the database has ", len(
-            self.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
-
-    def combineMemory(self, other_memory):
-        other_documents = other_memory.scenario_memory._collection.get(
-            include=['documents', 'metadatas', 'embeddings'])
-        current_documents = self.scenario_memory._collection.get(
-            include=['documents', 'metadatas', 'embeddings'])
-        for i in range(0, len(other_documents['embeddings'])):
-            if other_documents['embeddings'][i] in current_documents['embeddings']:
-                print("Already have one memory item, skip.")
-            else:
-                self.scenario_memory._collection.add(
-                    embeddings=other_documents['embeddings'][i],
-                    metadatas=other_documents['metadatas'][i],
-                    documents=other_documents['documents'][i],
-                    ids=other_documents['ids'][i]
-                )
-        print("Merge complete. Now the database has ", len(
-            self.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
+        self.collection.delete(ids=ids)
+        self.generation += 1
+        if self._contentIndex is not None:
+            removed = set(ids)
+            self._contentIndex = {
+                key: id for key, id in self._contentIndex.items() if id not in removed}
+        self._partitionCounts = None
+        print("Delete", len(ids), "memory items. Now the database has ",
+              self.collection.count(), " items.")
+
+    def combineMemory(self, other_memory, policy: str = 'skip', batch_size: int = 5000):
+        """Merge another memory into this one.
+
+        Items are matched by id or by the hash of their scenario description.
+        `policy` settles matches: 'skip' keeps the current item, 'newest'
+        keeps the one with the later `created_at`, and 'mistake-correction'
+        prefers reflection corrections over direct memories. Items are read
+        and written in pages of `batch_size`.
+        """
+        if other_memory.encode_type != self.encode_type:
+            raise ValueError(
+                f"Cannot merge a {other_memory.encode_type} memory into a {self.encode_type} memory.")
+        if policy not in MERGE_POLICIES:
+            raise ValueError(
+                f"Unknown merge policy: should be one of {', '.join(MERGE_POLICIES)}")
+        index = self.contentIndex()
+        if not index:
+            self.markEmbeddingModel()
+        knownIds = set(index.values())
+        warmCache = isinstance(self.embedding, CachedEmbeddings) and \
+            other_memory.embedding_model == self.embedding.modelName
+        added = skipped = 0
+        # updates are applied once at the end, a rewrite per page would cost
+        # the local backend a full pass over its sidecar each time
+        updates: Dict[str, Dict] = {}
+        total = other_memory.collection.count()
+        for offset in range(0, total, batch_size):
+            page = other_memory.collection.get(
+                limit=batch_size, offset=offset,
+                include=['documents', 'metadatas', 'embeddings'])
+            if warmCache:
+                # later retrievals of the merged scenarios are served from the cache
+                self.embedding.warm(page['documents'], page['embeddings'])
+            additions = {'ids': [], 'embeddings': [], 'metadatas': [], 'documents': []}
+            current = {}
+            matched = []
+            for i, (id, document, metadata) in enumerate(zip(
+                    page['ids'], page['documents'], page['metadatas'])):
+                key = (metadata or {}).get('content_hash') or contentHash(document)
+                if 'partition' not in (metadata or {}):
+                    page['metadatas'][i] = dict(metadata or {}, partition=partitionOf(document))
+                matched.append(
+                    (i, index.get(key, id if id in knownIds else None), key))
+            if policy != 'skip':
+                # several items may match one target, and the store neither
+                # keeps the order of `ids` nor repeats them in its result
+                existing = list(dict.fromkeys(
+                    target for _, target, _ in matched if target is not None))
+                if existing:
+                    stored = self.collection.get(ids=existing, include=['metadatas'])
+                    current = dict(zip(stored['ids'], stored['metadatas']))
+            for i, target, key in matched:
+                metadata = dict(page['metadatas'][i] or {}, content_hash=key)
+                # an earlier item of this page may have added the same scenario
+                target = index.get(key, target)
+                if target is None:
+                    id = page['ids'][i]
+                    additions['ids'].append(id)
+                    additions['embeddings'].append(page['embeddings'][i])
+                    additions['metadatas'].append(metadata)
+                    additions['documents'].append(page['documents'][i])
+                    index[key] = id
+                    knownIds.add(id)
+                    current[id] = metadata
+                    added += 1
+                elif policy != 'skip' and preferIncoming(
+                        policy, updates.get(target, current.get(target) or {}), metadata):
+                    updates[target] = metadata
+                else:
+                    skipped += 1
+            if additions['ids']:
+                self.collection.add(**additions)
+        if updates:
+            self.collection.update(
+                ids=list(updates), metadatas=list(updates.values()))
+        self._partitionCounts = None
+        self.generation += 1
+        print("Merge complete. Added", added, "replaced", len(updates), "skipped", skipped,
+              "items. Now the database has ", self.collection.count(), " items.")
 
 
 if __name__ == "__main__":
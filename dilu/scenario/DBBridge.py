@@ -1,23 +1,123 @@
+import queue
 import sqlite3
+import threading
 import numpy as np
-from typing import List
+from typing import List, Tuple
 from highway_env.envs import AbstractEnv
 from highway_env.road.road import RoadNetwork, LaneIndex
 from highway_env.road.lane import StraightLane, CircularLane
 from highway_env.vehicle.controller import MDPVehicle
 from highway_env.vehicle.behavior import IDMVehicle
 
+from dilu.scenario.trajectoryStore import TrajectoryWriter, trajectoryPath
+
+
+class DBWriter(threading.Thread):
+    """Background thread that owns all writes to a DBBridge connection.
+
+    Writes are handed over through a bounded queue, so the decision loop only
+    blocks when the writer falls `queueSize` batches behind. An error raised
+    by the writer is kept and re-raised by the next `flush`.
+    """
+
+    COMMIT = object()
+    STOP = object()
+
+    def __init__(self, conn: sqlite3.Connection, queueSize: int = 256) -> None:
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self.STOP:
+                    return
+                elif item is self.COMMIT:
+                    self.conn.commit()
+                elif self.error is None:
+                    sql, rows = item
+                    self.conn.executemany(sql, rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def flush(self):
+        self.queue.put(self.COMMIT)
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def stop(self):
+        self.queue.put(self.STOP)
+        self.join()
+
 
 class DBBridge:
-    def __init__(self, database: str, env: AbstractEnv) -> None:
+    def __init__(
+            self, database: str, env: AbstractEnv,
+            asyncWrites: bool = False, queueSize: int = 256,
+            trajectoryFormat: str = None
+    ) -> None:
         self.database = database
         self.env = env
         self.ego: MDPVehicle = env.vehicle
         self.network: RoadNetwork = env.road.network
+        # one connection for the whole episode, handed to the writer thread
+        # when writes are asynchronous
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        # optional columnar copy of vehINFO, written when the bridge closes
+        self.trajectory = TrajectoryWriter(
+            trajectoryPath(database, trajectoryFormat), trajectoryFormat
+        ) if trajectoryFormat else None
+        self.writer = None
+        if asyncWrites:
+            self.writer = DBWriter(self.conn, queueSize)
+            self.writer.start()
+
+    def execute(self, sql: str, rows: List[Tuple]):
+        if self.writer is not None:
+            self.writer.put((sql, rows))
+        else:
+            self.conn.executemany(sql, rows)
+
+    def commit(self):
+        if self.writer is not None:
+            self.writer.put(DBWriter.COMMIT)
+        else:
+            self.conn.commit()
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+        else:
+            self.conn.commit()
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self.writer is not None:
+                self.writer.stop()
+                self.writer = None
+            self.conn.close()
+            self.conn = None
+            if self.trajectory is not None:
+                self.trajectory.write()
 
     def createTable(self):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(
             """CREATE TABLE IF NOT EXISTS simINFO(
                 envType TEXT,
@@ -62,21 +162,21 @@ class DBBridge:
                 fewshots TEXT,
                 thoughtsAndAction TEXT,
                 editedTA TEXT,
-                editTimes INT
+                editTimes INT,
+                promptTokens INT,
+                decisionSeconds REAL,
+                completionTokens INT,
+                savedTokensBound INT,
+                decisionSource TEXT
             );"""
         )
-        conn.commit()
-        conn.close()
+        self.conn.commit()
 
     def insertSimINFO(self, envType: str, seed: int):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
-        cur.execute(
+        self.execute(
             """INSERT INTO simINFO(envType, seed) VALUES(?,?);""",
-            (envType, seed),
+            [(envType, seed)],
         )
-        conn.commit()
-        conn.close()
 
     def getCicularLaneWayPoint(self, cl: CircularLane):
         if cl.direction == 1:
@@ -89,95 +189,82 @@ class DBBridge:
         return ' '.join([f'{x[i]},{y[i]}' for i in range(len(x))])
 
     def insertNetwork(self):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
+        rows = []
         for k1, v1 in self.network.graph.items():
             for k2, v2 in v1.items():
                 for k3, lane in enumerate(v2):
                     if isinstance(lane, StraightLane):
                         wayPoint = f'{lane.start[0]},{lane.start[1]} {lane.end[0]},{lane.end[1]}'
-                        cur.execute(
-                            """INSERT INTO networkINFO (
-                                laneIndexO, laneIndexD, laneIndexI, laneType, 
-                                wayPoint, width, speedLimit
-                                ) VALUES (?,?,?,?,?,?,?);""",
-                            (
-                                k1, k2, k3,
-                                "StraightLane",
-                                wayPoint, lane.width, lane.speed_limit
-                            )
-                        )
+                        rows.append((
+                            k1, k2, k3,
+                            "StraightLane",
+                            wayPoint, lane.width, lane.speed_limit
+                        ))
                     elif isinstance(lane, CircularLane):
                         wayPoint = self.getCicularLaneWayPoint(lane)
-                        cur.execute(
-                            """INSERT INTO networkINFO(
-                                laneIndexO, laneIndexD, laneIndexI, laneType, 
-                                wayPoint, width, speedLimit
-                                ) VALUES (?,?,?,?,?,?,?);""",
-                            (
-                                k1, k2, k3, "CircularLane",
-                                wayPoint, lane.width, lane.speed_limit
-                            )
-                        )
+                        rows.append((
+                            k1, k2, k3, "CircularLane",
+                            wayPoint, lane.width, lane.speed_limit
+                        ))
                     else:
                         raise NotImplementedError('Lane type not implemented')
-        conn.commit()
-        conn.close()
+        self.execute(
+            """INSERT INTO networkINFO (
+                laneIndexO, laneIndexD, laneIndexI, laneType, 
+                wayPoint, width, speedLimit
+                ) VALUES (?,?,?,?,?,?,?);""",
+            rows
+        )
 
     def insertVehicle(self, decisionFrame: int, SVs: List[IDMVehicle]):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
         ek1, ek2, ek3 = self.ego.lane_index
-        cur.execute(
+        rows = [(
+            decisionFrame, 'ego',
+            self.ego.LENGTH, self.ego.WIDTH,
+            self.ego.position[0], self.ego.position[1],
+            self.ego.speed, self.ego.action['acceleration'],
+            self.ego.heading, self.ego.action['steering'],
+            ek1, ek2, ek3
+        )]
+        for sv in SVs:
+            k1, k2, k3 = sv.lane_index
+            rows.append((
+                decisionFrame, id(sv) % 1000,
+                sv.LENGTH, sv.WIDTH,
+                sv.position[0], sv.position[1],
+                sv.speed, sv.action['acceleration'],
+                sv.heading, sv.action['steering'],
+                k1, k2, k3
+            ))
+        if self.trajectory is not None:
+            self.trajectory.append(rows)
+        self.execute(
             """INSERT INTO vehINFO (
                 decisionFrame, vehicleID, length, width, posx, posy, speed, 
                 acceleration, heading, steering, 
                 laneIndexO, laneIndexD, laneIndexI
                 ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);""",
-            (
-                decisionFrame, 'ego',
-                self.ego.LENGTH, self.ego.WIDTH,
-                self.ego.position[0], self.ego.position[1],
-                self.ego.speed, self.ego.action['acceleration'],
-                self.ego.heading, self.ego.action['steering'],
-                ek1, ek2, ek3
-            )
+            rows
         )
-        for sv in SVs:
-            k1, k2, k3 = sv.lane_index
-            cur.execute(
-                """INSERT INTO vehINFO (
-                    decisionFrame, vehicleID, length, width, posx, posy, speed, 
-                    acceleration, heading, steering, 
-                    laneIndexO, laneIndexD, laneIndexI
-                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);""",
-                (
-                    decisionFrame, id(sv) % 1000,
-                    sv.LENGTH, sv.WIDTH,
-                    sv.position[0], sv.position[1],
-                    sv.speed, sv.action['acceleration'],
-                    sv.heading, sv.action['steering'],
-                    k1, k2, k3
-                )
-            )
-        conn.commit()
-        conn.close()
 
     def insertPrompts(
             self, decisionFrame: int, vectorID: str, done: bool,
-            description: str, fewshots: str, thoughtsAndAction: str
+            description: str, fewshots: str, thoughtsAndAction: str,
+            stepStats: dict = None
     ):
-        conn = sqlite3.connect(self.database)
-        cur = conn.cursor()
-        cur.execute(
+        stepStats = stepStats or {}
+        self.execute(
             """INSERT INTO promptsINFO (
                 decisionFrame, vectorID, done, description, fewshots, 
-                thoughtsAndAction, editedTA, editTimes
-                ) VALUES (?,?,?,?,?,?,?,?);""",
-            (
+                thoughtsAndAction, editedTA, editTimes, promptTokens,
+                decisionSeconds, completionTokens, savedTokensBound,
+                decisionSource
+                ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);""",
+            [(
                 decisionFrame, vectorID, done, description,
-                fewshots, thoughtsAndAction, None, 0
-            )
+                fewshots, thoughtsAndAction, None, 0,
+                stepStats.get('promptTokens'), stepStats.get('decisionSeconds'),
+                stepStats.get('completionTokens'), stepStats.get('savedTokensBound'),
+                stepStats.get('decisionSource')
+            )]
         )
-        conn.commit()
-        conn.close()
@@ -1,7 +1,9 @@
-from typing import List, Tuple, Optional, Union, Dict
+from typing import List, Tuple, Optional, Union, Dict, NamedTuple
+from dataclasses import dataclass
 from datetime import datetime
 import math
 import os
+import re
 
 from highway_env.road.road import Road, RoadNetwork, LaneIndex
 from highway_env.road.lane import (
@@ -33,10 +35,123 @@ ACTIONS_DESCRIPTION = {
 }
 
 
+# 车辆相对 ego 的车道关系，数组中用下标表示，-1 表示不需要考虑的车辆
+SV_LANE_RELATIONS = ('current lane', 'left lane', 'right lane', 'target lane')
+SV_LANE_PHRASES = (
+    'is driving on the same lane as you',
+    'is driving on the lane to your left',
+    'is driving on the lane to your right',
+    'is driving on your target lane',
+)
+
+
+class SVState(NamedTuple):
+    relation: np.ndarray
+    ahead: np.ndarray
+    distance: np.ndarray
+    closest: np.ndarray
+
+
+def svPositions(SVs: List[IDMVehicle]) -> np.ndarray:
+    return np.array([sv.position for sv in SVs], dtype=float).reshape(-1, 2)
+
+
+def svAheadMask(relPositions: np.ndarray, egoHeading: float) -> np.ndarray:
+    # 向量只用来判断车辆在 ego 的前方还是后方，见 getSVRelativeState
+    return relPositions[:, 0] * math.cos(egoHeading) + \
+        relPositions[:, 1] * math.sin(egoHeading) >= 0
+
+
+def svLaneRelations(
+        svRoads: np.ndarray, svLanes: np.ndarray,
+        egoRoad: int, egoLane: int, numSideLanes: int,
+        nextRoad: int = -1, nextLane: int = -1
+) -> np.ndarray:
+    # 同一条 road 上的车道就是 all_side_lanes 返回的车道
+    inSide = (svRoads == egoRoad) & (svLanes >= 0) & (svLanes < numSideLanes)
+    offset = svLanes - egoLane
+    relation = np.full(len(svRoads), -1, dtype=np.int64)
+    relation[inSide & (offset == 0)] = 0
+    relation[inSide & (offset == -1)] = 1
+    relation[inSide & (offset == 1)] = 2
+    relation[~inSide & (svRoads == nextRoad) & (svLanes == nextLane)] = 3
+    return relation
+
+
+def closestSVsPerLane(
+        relPositions: np.ndarray, egoHeading: float, relation: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # 每条车道的前方和后方各为一组，按 (组, 距离) 做一次稳定排序，取每组第一个；
+    # 距离相同时保留原顺序中靠前的车辆，与逐个比较的结果一致
+    ahead = svAheadMask(relPositions, egoHeading)
+    distance = np.sqrt(np.einsum('ij,ij->i', relPositions, relPositions))
+    group = np.where(relation >= 0, relation * 2 + ~ahead, -1)
+    closest = np.zeros(len(relation), dtype=bool)
+    candidates = np.flatnonzero(group >= 0)
+    if len(candidates):
+        order = candidates[np.lexsort(
+            (distance[candidates], group[candidates]))]
+        _, first = np.unique(group[order], return_index=True)
+        closest[order[first]] = True
+    return ahead, distance, closest
+
+
+class RoadContext(NamedTuple):
+    # 路段的结构信息：车道数、ego 所在车道（从左往右，0 开始）和是否在路口中，
+    # 用来给 memory 分区。路口中车道数和车道编号都记为 0
+    lanes: int
+    laneRank: int
+    inJunction: bool
+
+    def partitionKey(self) -> str:
+        if self.inJunction:
+            return 'junction'
+        return f'{self.lanes}-{self.laneRank}'
+
+
+LANE_RANK_WORDS = {'second': 1, 'third': 2, 'fourth': 3}
+
+
+def roadContextFromDescription(description: str) -> Optional[RoadContext]:
+    # 从 processNormalLane 和路口的描述文字中解析 RoadContext，用于没有分区信息的
+    # 旧 memory；无法解析时返回 None
+    if description.startswith("You are driving in an intersection"):
+        return RoadContext(0, 0, True)
+    if description.startswith("You are driving on a road with only one lane"):
+        return RoadContext(1, 0, False)
+    match = re.match(
+        r"You are driving on a road with (\d+) lanes, and you are currently driving in the (leftmost|rightmost|second|third|fourth) lane",
+        description)
+    if match is None:
+        return None
+    lanes, rank = int(match.group(1)), match.group(2)
+    if rank == 'leftmost':
+        return RoadContext(lanes, 0, False)
+    elif rank == 'rightmost':
+        return RoadContext(lanes, lanes - 1, False)
+    return RoadContext(lanes, LANE_RANK_WORDS[rank], False)
+
+
+@dataclass(frozen=True)
+class ScenarioSnapshot:
+    # Everything `describe` derives from one decision frame, built once and
+    # shared by memory retrieval, prompting and the database.
+    decisionFrame: int
+    step: int
+    surroundVehicles: Tuple[IDMVehicle]
+    laneIndex: LaneIndex
+    sideLanes: Tuple[LaneIndex]
+    nextLane: LaneIndex
+    inJunction: bool
+    description: str
+    svState: Optional[SVState] = None
+
+
 class EnvScenario:
     def __init__(
             self, env: AbstractEnv, envType: str,
-            seed: int, database: str = None
+            seed: int, database: str = None, asyncWrites: bool = False,
+            trajectoryFormat: str = None
     ) -> None:
         self.env = env
         self.envType = envType
@@ -59,14 +174,20 @@ class EnvScenario:
                 datetime.now(), '%Y-%m-%d_%H-%M-%S'
             ) + '.db'
 
-        if os.path.exists(self.database):
-            os.remove(self.database)
+        for path in (self.database, self.database + '-wal', self.database + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
 
-        self.dbBridge = DBBridge(self.database, env)
+        self.dbBridge = DBBridge(
+            self.database, env, asyncWrites,
+            trajectoryFormat=trajectoryFormat
+        )
+        self.snapshot: Optional[ScenarioSnapshot] = None
 
         self.dbBridge.createTable()
         self.dbBridge.insertSimINFO(envType, seed)
         self.dbBridge.insertNetwork()
+        self.dbBridge.commit()
 
     def getSurrendVehicles(self, vehicles_count: int) -> List[IDMVehicle]:
         return self.road.close_vehicles_to(
@@ -124,8 +245,9 @@ class EnvScenario:
         # avaliableActionDescription += '\n'
         return avaliableActionDescription
 
-    def processNormalLane(self, lidx: LaneIndex) -> str:
-        sideLanes = self.network.all_side_lanes(lidx)
+    def processNormalLane(self, lidx: LaneIndex, sideLanes: List[LaneIndex] = None) -> str:
+        if sideLanes is None:
+            sideLanes = self.network.all_side_lanes(lidx)
         numLanes = len(sideLanes)
         if numLanes == 1:
             description = "You are driving on a road with only one lane, you can't change lane. "
@@ -167,138 +289,64 @@ class EnvScenario:
         distance = np.linalg.norm(posA - posB)
         return distance
 
-    def getClosestSV(self, SVs: List[IDMVehicle]):
-        if SVs:
-            closestIdex = -1
-            closestDis = 99999999
-            for i, sv in enumerate(SVs):
-                dis = self.getVehDis(sv)
-                if dis < closestDis:
-                    closestDis = dis
-                    closestIdex = i
-            return SVs[closestIdex]
-        else:
-            return None
-
-    def processSingleLaneSVs(self, SingleLaneSVs: List[IDMVehicle]):
-        # 返回当前车道上，前方最近的车辆和后方最近的车辆，如果没有，则为 None
-        if SingleLaneSVs:
-            aheadSVs = []
-            behindSVs = []
-            for sv in SingleLaneSVs:
-                RSStr = self.getSVRelativeState(sv)
-                if RSStr == 'is ahead of you':
-                    aheadSVs.append(sv)
-                else:
-                    behindSVs.append(sv)
-            aheadClosestOne = self.getClosestSV(aheadSVs)
-            behindClosestOne = self.getClosestSV(behindSVs)
-            return aheadClosestOne, behindClosestOne
-        else:
-            return None, None
-
-    def processSVsNormalLane(
-            self, SVs: List[IDMVehicle], currentLaneIndex: LaneIndex
-    ):
-        # 目前 description 中的车辆有些太多了，需要处理一下，只保留最靠近 ego 的几辆车
-        classifiedSVs: Dict[str, List[IDMVehicle]] = {
-            'current lane': [],
-            'left lane': [],
-            'right lane': [],
-            'target lane': []
-        }
-        sideLanes = self.network.all_side_lanes(currentLaneIndex)
-        nextLane = self.network.next_lane(
-            currentLaneIndex, self.ego.route, self.ego.position
+    def classifySVs(
+            self, SVs: List[IDMVehicle], currentLaneIndex: LaneIndex,
+            sideLanes: List[LaneIndex], nextLane: LaneIndex
+    ) -> 'SVState':
+        # 把车辆的位置和车道编号放进数组里，一次性完成车道分类、前后判断和每条车道
+        # 最近车辆的选择
+        roadCodes: Dict[Tuple[str, str], int] = {}
+        egoRoad = roadCodes.setdefault(currentLaneIndex[:2], 0)
+        nextRoad = roadCodes.setdefault(nextLane[:2], len(roadCodes))
+        svRoads = np.array(
+            [roadCodes.setdefault(sv.lane_index[:2], len(roadCodes)) for sv in SVs],
+            dtype=np.int64
         )
-        for sv in SVs:
-            lidx = sv.lane_index
-            if lidx in sideLanes:
-                if lidx == currentLaneIndex:
-                    classifiedSVs['current lane'].append(sv)
-                else:
-                    laneRelative = lidx[2] - currentLaneIndex[2]
-                    if laneRelative == 1:
-                        classifiedSVs['right lane'].append(sv)
-                    elif laneRelative == -1:
-                        classifiedSVs['left lane'].append(sv)
-                    else:
-                        continue
-            elif lidx == nextLane:
-                classifiedSVs['target lane'].append(sv)
-            else:
-                continue
-
-        validVehicles: List[IDMVehicle] = []
-        existVehicles: Dict[str, bool] = {}
-        for k, v in classifiedSVs.items():
-            if v:
-                existVehicles[k] = True
-            else:
-                existVehicles[k] = False
-            ahead, behind = self.processSingleLaneSVs(v)
-            if ahead:
-                validVehicles.append(ahead)
-            if behind:
-                validVehicles.append(behind)
-
-        return validVehicles, existVehicles
-
-    def describeSVNormalLane(self, currentLaneIndex: LaneIndex) -> str:
+        svLanes = np.array([sv.lane_index[2] for sv in SVs], dtype=np.int64)
+        relation = svLaneRelations(
+            svRoads, svLanes, egoRoad, currentLaneIndex[2], len(sideLanes),
+            nextRoad, nextLane[2]
+        )
+        relPositions = svPositions(SVs) - self.ego.position
+        ahead, distance, closest = closestSVsPerLane(
+            relPositions, self.ego.heading, relation
+        )
+        return SVState(relation, ahead, distance, closest)
+
+    def describeSVNormalLane(
+            self, currentLaneIndex: LaneIndex,
+            surroundVehicles: List[IDMVehicle] = None,
+            sideLanes: List[LaneIndex] = None, nextLane: LaneIndex = None,
+            state: 'SVState' = None
+    ) -> str:
         # 当 ego 在 StraightLane 上时，车道信息是重要的，需要处理车道信息
         # 首先判断车辆是不是和车辆在同一条 road 上
         #   如果在同一条 road 上，则判断在哪条 lane 上
         #   如果不在同一条 road 上，则判断是否在 next_lane 上
         #      如果不在 nextLane 上，则直接不考虑这辆车的信息
         #      如果在 nextLane 上，则统计这辆车关于 ego 的相对运动状态
-        sideLanes = self.network.all_side_lanes(currentLaneIndex)
-        nextLane = self.network.next_lane(
-            currentLaneIndex, self.ego.route, self.ego.position
-        )
-        surroundVehicles = self.getSurrendVehicles(10)
-        validVehicles, existVehicles = self.processSVsNormalLane(
-            surroundVehicles, currentLaneIndex
-        )
+        if sideLanes is None:
+            sideLanes = self.network.all_side_lanes(currentLaneIndex)
+        if nextLane is None:
+            nextLane = self.network.next_lane(
+                currentLaneIndex, self.ego.route, self.ego.position
+            )
+        if surroundVehicles is None:
+            surroundVehicles = self.getSurrendVehicles(10)
         if not surroundVehicles:
             SVDescription = "There are no other vehicles driving near you, so you can drive completely according to your own ideas.\n"
             return SVDescription
         else:
+            if state is None:
+                state = self.classifySVs(
+                    surroundVehicles, currentLaneIndex, sideLanes, nextLane
+                )
             SVDescription = ''
-            for sv in surroundVehicles:
-                lidx = sv.lane_index
-                if lidx in sideLanes:
-                    # 车辆和 ego 在同一条 road 上行驶
-                    if lidx == currentLaneIndex:
-                        # 车辆和 ego 在同一条 lane 上行驶
-                        if sv in validVehicles:
-                            SVDescription += f"- Vehicle `{id(sv) % 1000}` is driving on the same lane as you and {self.getSVRelativeState(sv)}. "
-                        else:
-                            continue
-                    else:
-                        laneRelative = lidx[2] - currentLaneIndex[2]
-                        if laneRelative == 1:
-                            # laneRelative = 1 表示车辆在 ego 的右侧车道上行驶
-                            if sv in validVehicles:
-                                SVDescription += f"- Vehicle `{id(sv) % 1000}` is driving on the lane to your right and {self.getSVRelativeState(sv)}. "
-                            else:
-                                continue
-                        elif laneRelative == -1:
-                            # laneRelative = -1 表示车辆在 ego 的左侧车道上行驶
-                            if sv in validVehicles:
-                                SVDescription += f"- Vehicle `{id(sv) % 1000}` is driving on the lane to your left and {self.getSVRelativeState(sv)}. "
-                            else:
-                                continue
-                        else:
-                            # laneRelative 是其他的值表示在更远的车道上，不需要考虑
-                            continue
-                elif lidx == nextLane:
-                    # 车辆在 ego 的 nextLane 上行驶
-                    if sv in validVehicles:
-                        SVDescription += f"- Vehicle `{id(sv) % 1000}` is driving on your target lane and {self.getSVRelativeState(sv)}. "
-                    else:
-                        continue
-                else:
-                    continue
+            # 只描述每条车道上前后最近的车辆，顺序与 surroundVehicles 保持一致
+            for i in np.flatnonzero(state.closest):
+                sv = surroundVehicles[i]
+                relativeState = 'is ahead of you' if state.ahead[i] else 'is behind of you'
+                SVDescription += f"- Vehicle `{id(sv) % 1000}` {SV_LANE_PHRASES[state.relation[i]]} and {relativeState}. "
                 if self.envType == 'intersection-v1':
                     SVDescription += f"The position of it is `({sv.position[0]:.2f}, {sv.position[1]:.2f})`, speed is {sv.speed:.2f} m/s, acceleration is {sv.action['acceleration']:.2f} m/s^2.\n"
                 else:
@@ -331,13 +379,19 @@ class EnvScenario:
         else:
             return False
 
-    def describeSVJunctionLane(self, currentLaneIndex: LaneIndex) -> str:
+    def describeSVJunctionLane(
+            self, currentLaneIndex: LaneIndex,
+            surroundVehicles: List[IDMVehicle] = None,
+            nextLane: LaneIndex = None
+    ) -> str:
         # 当 ego 在交叉口内部时，车道的信息不再重要，只需要判断车辆和 ego 的相对位置
         # 但是需要判断交叉口内部所有车道关于 ego 的位置
-        nextLane = self.network.next_lane(
-            currentLaneIndex, self.ego.route, self.ego.position
-        )
-        surroundVehicles = self.getSurrendVehicles(6)
+        if nextLane is None:
+            nextLane = self.network.next_lane(
+                currentLaneIndex, self.ego.route, self.ego.position
+            )
+        if surroundVehicles is None:
+            surroundVehicles = self.getSurrendVehicles(6)
         if not surroundVehicles:
             SVDescription = "There are no other vehicles driving near you, so you can drive completely according to your own ideas.\n"
             return SVDescription
@@ -369,25 +423,74 @@ class EnvScenario:
                 'There are no other vehicles driving near you, so you can drive completely according to your own ideas.\n'
                 return SVDescription
 
-    def describe(self, decisionFrame: int) -> str:
+    def getSnapshot(self, decisionFrame: int) -> ScenarioSnapshot:
+        # The snapshot stays valid until `env.step` advances the simulation,
+        # so repeated calls within one decision frame are cache hits and the
+        # frame's vehicles are written to the database only once.
+        step = self.env.unwrapped.steps
+        if self.snapshot is not None \
+                and self.snapshot.decisionFrame == decisionFrame \
+                and self.snapshot.step == step:
+            return self.snapshot
+
         surroundVehicles = self.getSurrendVehicles(10)
         self.dbBridge.insertVehicle(decisionFrame, surroundVehicles)
         currentLaneIndex: LaneIndex = self.ego.lane_index
-        if self.isInJunction(self.ego):
+        sideLanes = self.network.all_side_lanes(currentLaneIndex)
+        nextLane = self.network.next_lane(
+            currentLaneIndex, self.ego.route, self.ego.position
+        )
+        inJunction = self.isInJunction(self.ego)
+        svState = None
+        if inJunction:
             roadCondition = "You are driving in an intersection, you can't change lane. "
             roadCondition += f"Your current position is `({self.ego.position[0]:.2f}, {self.ego.position[1]:.2f})`, speed is {self.ego.speed:.2f} m/s, and acceleration is {self.ego.action['acceleration']:.2f} m/s^2.\n"
-            SVDescription = self.describeSVJunctionLane(currentLaneIndex)
+            # the five closest vehicles are the head of the sorted ten, as
+            # getSurrendVehicles(6) returned them
+            SVDescription = self.describeSVJunctionLane(
+                currentLaneIndex, surroundVehicles[:5], nextLane)
         else:
-            roadCondition = self.processNormalLane(currentLaneIndex)
-            SVDescription = self.describeSVNormalLane(currentLaneIndex)
+            roadCondition = self.processNormalLane(currentLaneIndex, sideLanes)
+            svState = self.classifySVs(
+                surroundVehicles, currentLaneIndex, sideLanes, nextLane)
+            SVDescription = self.describeSVNormalLane(
+                currentLaneIndex, surroundVehicles, sideLanes, nextLane,
+                svState)
+
+        self.snapshot = ScenarioSnapshot(
+            decisionFrame=decisionFrame,
+            step=step,
+            surroundVehicles=tuple(surroundVehicles),
+            laneIndex=currentLaneIndex,
+            sideLanes=tuple(sideLanes),
+            nextLane=nextLane,
+            inJunction=inJunction,
+            description=roadCondition + SVDescription,
+            svState=svState,
+        )
+        return self.snapshot
 
-        return roadCondition + SVDescription
+    def describe(self, decisionFrame: int) -> str:
+        return self.getSnapshot(decisionFrame).description
+
+    def roadContext(self, decisionFrame: int) -> RoadContext:
+        snapshot = self.getSnapshot(decisionFrame)
+        if snapshot.inJunction:
+            return RoadContext(0, 0, True)
+        return RoadContext(len(snapshot.sideLanes), snapshot.laneIndex[2], False)
 
     def promptsCommit(
         self, decisionFrame: int, vectorID: str, done: bool,
-        description: str, fewshots: str, thoughtsAndAction: str
+        description: str, fewshots: str, thoughtsAndAction: str,
+        stepStats: dict = None
     ):
         self.dbBridge.insertPrompts(
             decisionFrame, vectorID, done, description,
-            fewshots, thoughtsAndAction
+            fewshots, thoughtsAndAction, stepStats
         )
+        # one commit per decision frame for its vehicles and prompts
+        self.dbBridge.commit()
+
+    def close(self):
+        # flushes pending writes, also when the episode ended with an error
+        self.dbBridge.close()
@@ -0,0 +1,58 @@
+import json
+import os
+from array import array
+from typing import List, NamedTuple, Optional, Union
+
+
+class FrameRecord(NamedTuple):
+    # What reflection and `DrivingMemory.addMemory` need from one decision
+    # frame; the live `EnvScenario` itself is never copied.
+    frame: int
+    sce_descrip: str
+    human_question: str
+    response: str
+    action: Union[int, str]
+    # numeric scenario vector, only kept when the memory uses `sce_encode`
+    sce_vector: Optional[List[float]] = None
+    # 'llm' or 'consensus'; consensus responses are not reasoning to learn from
+    decisionSource: Optional[str] = None
+
+
+class FrameRecordLog:
+    """Append-only sequence of `FrameRecord` for one episode.
+
+    With `spillPath` set, records are written to that file as JSON lines and
+    only their byte offsets stay in memory, so long episodes keep a flat
+    memory footprint. Indexing reads the record back from disk.
+    """
+
+    def __init__(self, spillPath: str = None) -> None:
+        self.spillPath = spillPath
+        self.records = []
+        self.offsets = array('q')
+        self.file = open(spillPath, 'w+b') if spillPath else None
+
+    def append(self, record: FrameRecord):
+        if self.file is None:
+            self.records.append(record)
+        else:
+            self.file.seek(0, os.SEEK_END)
+            self.offsets.append(self.file.tell())
+            self.file.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    def __len__(self) -> int:
+        return len(self.records) if self.file is None else len(self.offsets)
+
+    def __getitem__(self, i: int) -> FrameRecord:
+        if self.file is None:
+            return self.records[i]
+        self.file.seek(self.offsets[i])
+        return FrameRecord(*json.loads(self.file.readline()))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.spillPath)
+            self.file = None
+            self.offsets = array('q')
+        self.records = []
@@ -0,0 +1,130 @@
+"""Numeric scenario encoding for the `sce_encode` memory mode.
+
+A scenario becomes a fixed-length vector: the ego speed and lane rank, plus
+the gap to and relative speed of the closest vehicle ahead of and behind the
+ego in the current, left and right lanes. The live `EnvScenario` snapshot
+and the `vehINFO` rows of a result database give the same vector for the
+same frame, because both go through `svLaneRelations` and
+`closestSVsPerLane`.
+
+Features are scaled so that one unit is about equally important everywhere.
+This lets the memory index use plain L2 distance.
+"""
+import sqlite3
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dilu.scenario.envScenario import (
+    EnvScenario, SVState, closestSVsPerLane, svLaneRelations
+)
+
+
+SPEED_SCALE = 5.0   # m/s
+GAP_SCALE = 10.0    # m
+GAP_FREE = 100.0    # m, gap used when a lane has no vehicle on that side
+LANE_SIDES = (('current', 0, 0), ('left', 1, -1), ('right', 2, 1))
+FEATURE_NAMES = ('ego_speed', 'lane_rank') + tuple(
+    f"{lane}_{side}_{field}"
+    for lane, _, _ in LANE_SIDES
+    for side in ('ahead', 'behind')
+    for field in ('gap', 'rel_speed')
+)
+
+
+def encodeSVState(
+        egoSpeed: float, egoLane: int, numSideLanes: int,
+        state: SVState, svSpeeds: np.ndarray
+) -> np.ndarray:
+    vector = np.zeros(len(FEATURE_NAMES), dtype=np.float32)
+    vector[0] = egoSpeed / SPEED_SCALE
+    vector[1] = egoLane
+    col = 2
+    for _, relation, offset in LANE_SIDES:
+        laneExists = 0 <= egoLane + offset < numSideLanes
+        for isAhead in (True, False):
+            # a missing lane reads as a vehicle right next to the ego, an
+            # empty lane as a free gap
+            gap, relSpeed = 0.0, 0.0
+            if laneExists:
+                pick = np.flatnonzero(
+                    state.closest & (state.relation == relation)
+                    & (state.ahead == isAhead)
+                )
+                if len(pick):
+                    gap = min(float(state.distance[pick[0]]), GAP_FREE)
+                    relSpeed = float(svSpeeds[pick[0]]) - egoSpeed
+                else:
+                    gap = GAP_FREE
+            vector[col] = gap / GAP_SCALE
+            vector[col + 1] = relSpeed / SPEED_SCALE
+            col += 2
+    return vector
+
+
+def encodeScenario(sce: EnvScenario, decisionFrame: int) -> np.ndarray:
+    snapshot = sce.getSnapshot(decisionFrame)
+    surroundVehicles = list(snapshot.surroundVehicles)
+    state = snapshot.svState
+    if state is None:
+        # the junction snapshot does not classify vehicles by lane
+        state = sce.classifySVs(
+            surroundVehicles, snapshot.laneIndex,
+            list(snapshot.sideLanes), snapshot.nextLane
+        )
+    return encodeSVState(
+        sce.ego.speed, snapshot.laneIndex[2], len(snapshot.sideLanes),
+        state, np.array([sv.speed for sv in surroundVehicles], dtype=float)
+    )
+
+
+def encodeVehRows(
+        rows: List[Tuple], laneCounts: Dict[Tuple[str, str], int]
+) -> np.ndarray:
+    """Encode one decision frame from its `vehINFO` rows.
+
+    `rows` are `(vehicleID, posx, posy, speed, heading, laneIndexO,
+    laneIndexD, laneIndexI)` with the ego as vehicle `'ego'`, and
+    `laneCounts` maps each road to its number of lanes from `networkINFO`.
+    """
+    ego = next(row for row in rows if row[0] == 'ego')
+    others = [row for row in rows if row[0] != 'ego']
+    egoRoad = (ego[5], ego[6])
+    svRoads = np.array(
+        [0 if (row[5], row[6]) == egoRoad else 1 for row in others], dtype=np.int64)
+    svLanes = np.array([row[7] for row in others], dtype=np.int64)
+    numSideLanes = laneCounts.get(egoRoad, ego[7] + 1)
+    relation = svLaneRelations(svRoads, svLanes, 0, ego[7], numSideLanes)
+    relPositions = np.array(
+        [(row[1], row[2]) for row in others], dtype=float
+    ).reshape(-1, 2) - np.array([ego[1], ego[2]])
+    ahead, distance, closest = closestSVsPerLane(relPositions, ego[4], relation)
+    return encodeSVState(
+        ego[3], ego[7], numSideLanes,
+        SVState(relation, ahead, distance, closest),
+        np.array([row[3] for row in others], dtype=float)
+    )
+
+
+def encodeResultDB(database: str) -> Dict[int, np.ndarray]:
+    """Scenario vectors of every decision frame stored in a result database."""
+    conn = sqlite3.connect(database)
+    try:
+        laneCounts: Dict[Tuple[str, str], int] = {}
+        for laneO, laneD, lanes in conn.execute(
+            "SELECT laneIndexO, laneIndexD, COUNT(*) FROM networkINFO GROUP BY laneIndexO, laneIndexD;"
+        ):
+            laneCounts[(laneO, laneD)] = lanes
+        frames: Dict[int, List[Tuple]] = {}
+        for decisionFrame, *row in conn.execute(
+            """SELECT decisionFrame, vehicleID, posx, posy, speed, heading,
+            laneIndexO, laneIndexD, laneIndexI FROM vehINFO ORDER BY rowid;"""
+        ):
+            frames.setdefault(decisionFrame, []).append(tuple(row))
+    finally:
+        conn.close()
+    return {
+        decisionFrame: encodeVehRows(rows, laneCounts)
+        for decisionFrame, rows in frames.items()
+        if any(row[0] == 'ego' for row in rows)
+    }
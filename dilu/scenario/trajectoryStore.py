@@ -0,0 +1,132 @@
+"""Columnar copy of an episode's `vehINFO` rows for bulk analysis.
+
+`npy` writes a directory with one contiguous array per field and a
+`meta.json`, which `loadTrajectory` memory-maps without copying. `parquet`
+writes a single Parquet file (needs `pyarrow`). In both formats the lane
+origin/destination names are dictionary-encoded and the ego vehicle has
+vehicle id -1.
+"""
+import json
+import os
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+FLOAT_FIELDS = (
+    'length', 'width', 'posx', 'posy', 'speed',
+    'acceleration', 'heading', 'steering'
+)
+INT_FIELDS = ('decisionFrame', 'vehicleID', 'laneIndexO', 'laneIndexD', 'laneIndexI')
+
+
+def trajectoryPath(database: str, trajectoryFormat: str) -> str:
+    stem = os.path.splitext(database)[0]
+    if trajectoryFormat == 'parquet':
+        return stem + '_traj.parquet'
+    return stem + '_traj'
+
+
+class TrajectoryWriter:
+    def __init__(self, path: str, trajectoryFormat: str = 'npy') -> None:
+        if trajectoryFormat not in ('npy', 'parquet'):
+            raise ValueError(
+                "Unknown trajectory format: should be npy or parquet")
+        if trajectoryFormat == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "Parquet trajectory export needs pyarrow, please install it with `pip install pyarrow`.")
+        self.path = path
+        self.trajectoryFormat = trajectoryFormat
+        self.columns: Dict[str, array] = {
+            field: array('f') for field in FLOAT_FIELDS}
+        self.columns.update({field: array('i') for field in INT_FIELDS})
+        self.laneNames: Dict[str, int] = {}
+
+    def laneCode(self, name: str) -> int:
+        if name not in self.laneNames:
+            self.laneNames[name] = len(self.laneNames)
+        return self.laneNames[name]
+
+    def append(self, rows: List[Tuple]):
+        # rows are laid out like the vehINFO insert in DBBridge
+        c = self.columns
+        for (decisionFrame, vehicleID, length, width, posx, posy, speed,
+             acceleration, heading, steering, laneO, laneD, laneI) in rows:
+            c['decisionFrame'].append(decisionFrame)
+            c['vehicleID'].append(-1 if vehicleID == 'ego' else vehicleID)
+            c['length'].append(length)
+            c['width'].append(width)
+            c['posx'].append(posx)
+            c['posy'].append(posy)
+            c['speed'].append(speed)
+            c['acceleration'].append(acceleration)
+            c['heading'].append(heading)
+            c['steering'].append(steering)
+            c['laneIndexO'].append(self.laneCode(laneO))
+            c['laneIndexD'].append(self.laneCode(laneD))
+            c['laneIndexI'].append(laneI)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            field: np.frombuffer(values, dtype=np.float32 if values.typecode == 'f' else np.int32)
+            for field, values in self.columns.items()
+        }
+
+    def write(self):
+        if not len(self.columns['decisionFrame']):
+            return
+        laneDictionary = sorted(self.laneNames, key=self.laneNames.get)
+        if self.trajectoryFormat == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            columns = self.arrays()
+            dictionary = pa.array(laneDictionary, type=pa.string())
+            table = pa.table({
+                field: (
+                    pa.DictionaryArray.from_arrays(columns[field], dictionary)
+                    if field in ('laneIndexO', 'laneIndexD') else columns[field]
+                )
+                for field in INT_FIELDS[:2] + FLOAT_FIELDS + INT_FIELDS[2:]
+            })
+            table = table.replace_schema_metadata(
+                {'dilu_trajectory_version': str(FORMAT_VERSION)})
+            pq.write_table(table, self.path)
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            for field, values in self.arrays().items():
+                np.save(os.path.join(self.path, field + '.npy'), values)
+            with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+                json.dump({
+                    'version': FORMAT_VERSION,
+                    'rows': len(self.columns['decisionFrame']),
+                    'fields': list(self.columns),
+                    'laneDictionary': laneDictionary,
+                }, f)
+
+
+def loadTrajectory(path: str) -> Dict:
+    """Load a trajectory written by `TrajectoryWriter`.
+
+    A `npy` directory gives a dict of read-only memory-mapped arrays plus the
+    `laneDictionary` list; a Parquet file gives a memory-mapped
+    `pyarrow.Table`.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(path, memory_map=True)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] > FORMAT_VERSION:
+        raise ValueError(
+            f"Trajectory format version {meta['version']} is newer than supported {FORMAT_VERSION}.")
+    trajectory = {
+        field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+        for field in meta['fields']
+    }
+    trajectory['laneDictionary'] = meta['laneDictionary']
+    return trajectory
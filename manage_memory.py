@@ -0,0 +1,221 @@
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import time
+
+import yaml
+from rich import print
+
+from dilu.driver_agent.cassette import normalizeText
+from dilu.driver_agent.localEmbeddings import idfFile
+from dilu.driver_agent.llmFactory import buildEmbeddings, buildLocalEmbeddings, setupLLMEnv
+from dilu.driver_agent.memorySnapshot import MemorySnapshot, exportSnapshot
+from dilu.driver_agent.vectorStore import DrivingMemory
+from dilu.scenario.scenarioVector import encodeResultDB
+
+
+def descriptionKey(sce_descrip: str) -> str:
+    # memories store the description without quotes, see addMemory
+    return normalizeText(sce_descrip.replace("'", ''))
+
+
+def resultFrames(database: str):
+    conn = sqlite3.connect(database)
+    rows = conn.execute(
+        "SELECT decisionFrame, description FROM promptsINFO ORDER BY decisionFrame;"
+    ).fetchall()
+    conn.close()
+    for decisionFrame, description in rows:
+        match = re.search(
+            r"#### Driving scenario description:(.*?)####",
+            description or '', re.DOTALL)
+        if match:
+            yield decisionFrame, match.group(1).strip()
+
+
+def backfill(config, args):
+    source = DrivingMemory(
+        'sce_language', args.source, config['memory_backend'])
+    target = DrivingMemory('sce_encode', args.target)
+    vectors = {}
+    databases = sorted(set(
+        path for pattern in args.results for path in glob.glob(pattern)))
+    for database in databases:
+        frameVectors = encodeResultDB(database)
+        for decisionFrame, sce_descrip in resultFrames(database):
+            if decisionFrame in frameVectors:
+                vectors.setdefault(
+                    descriptionKey(sce_descrip), frameVectors[decisionFrame])
+    print(f"Encoded {len(vectors)} scenarios from {len(databases)} result databases.")
+
+    items = source.collection.get(include=['documents', 'metadatas'])
+    known = set(target.collection.get()['ids'])
+    ids, embeddings, metadatas, documents = [], [], [], []
+    missing = 0
+    for id, document, metadata in zip(items['ids'], items['documents'], items['metadatas']):
+        vector = vectors.get(descriptionKey(document))
+        if vector is None:
+            missing += 1
+        elif id not in known:
+            ids.append(id)
+            embeddings.append(vector)
+            metadatas.append(metadata)
+            documents.append(document)
+    target.collection.add(
+        ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+    print(f"[green]Backfilled {len(ids)} memory items[/green], {missing} items have no matching frame in the result databases. Now the database has ",
+          target.collection.count(), " items.")
+
+
+def compact(config, args):
+    memory = DrivingMemory(
+        config['memory_encode_type'], args.memory, config['memory_backend'])
+    memory.compact(
+        args.capacity if args.capacity is not None else config['memory_capacity'],
+        args.radius if args.radius is not None else config['memory_dedup_radius'])
+
+
+def partition(config, args):
+    memory = DrivingMemory(
+        config['memory_encode_type'], args.memory, config['memory_backend'])
+    memory.tagPartitions()
+
+
+def export(config, args):
+    memory = DrivingMemory(
+        config['memory_encode_type'], args.memory, config['memory_backend'])
+    manifest = exportSnapshot(memory, args.output)
+    print(f"[green]Exported {manifest['count']} memory items[/green] to {args.output}.")
+
+
+def load(config, args):
+    snapshot = MemorySnapshot(args.input, verify=not args.no_verify)
+    print(f"Opened snapshot {args.input} with {snapshot.count()} items in {snapshot.load_seconds * 1000:.1f} ms.")
+    memory = DrivingMemory(
+        snapshot.encode_type, args.memory, args.backend or config['memory_backend'])
+    if memory.embedding_model != snapshot.embedding_model:
+        # mixed vectors of two models cannot be queried with either of them
+        if not args.force:
+            raise ValueError(
+                f"The snapshot was embedded with {snapshot.embedding_model}, but this memory uses "
+                f"{memory.embedding_model}. Re-embed one of them, or pass --force to import anyway.")
+        print(f"[yellow]The snapshot was embedded with {snapshot.embedding_model}, but this memory uses {memory.embedding_model}.[/yellow]")
+    memory.combineMemory(snapshot, args.policy)
+
+
+def reembed(config, args):
+    backend = args.embedding or os.environ["EMBEDDING_BACKEND"]
+    embedding = buildLocalEmbeddings(backend, fitting=args.fit) \
+        if backend != 'openai' else buildEmbeddings()
+    # the source is only read, never queried, so its embedding model does not matter
+    source = DrivingMemory('sce_language', args.source, config['memory_backend'],
+                           embedding=embedding, check_embedding=False)
+    total = source.collection.count()
+    if args.fit:
+        if backend != 'hashing' or not os.environ["EMBEDDING_MODEL_PATH"]:
+            raise ValueError("--fit needs EMBEDDING_BACKEND 'hashing' and an EMBEDDING_MODEL_PATH to write.")
+        embedding.fit(source.collection.get(include=['documents'])['documents'])
+        embedding.save(os.environ["EMBEDDING_MODEL_PATH"])
+        print(f"Fitted IDF weights on {total} documents, saved to {idfFile(os.environ['EMBEDDING_MODEL_PATH'])}.")
+    target = DrivingMemory(
+        'sce_language', args.target, args.backend or config['memory_backend'], embedding=embedding)
+    known = set(target.collection.get()['ids'])
+    if not known:
+        target.markEmbeddingModel()
+    startTime = time.perf_counter()
+    added = 0
+    for offset in range(0, total, args.batch_size):
+        page = source.collection.get(
+            limit=args.batch_size, offset=offset, include=['documents', 'metadatas'])
+        keep = [i for i, id in enumerate(page['ids']) if id not in known]
+        if not keep:
+            continue
+        documents = [page['documents'][i] for i in keep]
+        target.collection.add(
+            ids=[page['ids'][i] for i in keep],
+            embeddings=embedding.embed_documents(documents),
+            metadatas=[page['metadatas'][i] for i in keep],
+            documents=documents)
+        added += len(keep)
+    seconds = time.perf_counter() - startTime
+    print(f"[green]Re-embedded {added} memory items with {target.embedding_model}[/green] in {seconds:.1f} s "
+          f"({added / max(seconds, 1e-9):.0f} items/s). Now the database has ", target.collection.count(), " items.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Maintenance commands for DiLu memory databases.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backfillParser = subparsers.add_parser(
+        'backfill', help="Build a sce_encode memory from a sce_language memory and the result databases its items came from.")
+    backfillParser.add_argument("-s", "--source", type=str, default='memories/20_mem',
+                                help="Path to the sce_language memory.")
+    backfillParser.add_argument("-t", "--target", type=str, required=True,
+                                help="Path to the sce_encode memory to write.")
+    backfillParser.add_argument("-r", "--results", type=str, nargs='+', required=True,
+                                help="Result databases (glob patterns) holding the source episodes.")
+    backfillParser.set_defaults(func=backfill)
+
+    compactParser = subparsers.add_parser(
+        'compact', help="Merge near-duplicate memories and evict cold ones.")
+    compactParser.add_argument("-m", "--memory", type=str, default='memories/20_mem',
+                               help="Path to the memory to compact.")
+    compactParser.add_argument("-c", "--capacity", type=int, default=None,
+                               help="Max items to keep, defaults to memory_capacity in config.yaml.")
+    compactParser.add_argument("--radius", type=float, default=None,
+                               help="Squared L2 duplicate radius, defaults to memory_dedup_radius in config.yaml.")
+    compactParser.set_defaults(func=compact)
+
+    partitionParser = subparsers.add_parser(
+        'partition', help="Tag the items stored before partitioning with their road-context partition.")
+    partitionParser.add_argument("-m", "--memory", type=str, default='memories/20_mem',
+                                 help="Path to the memory to tag.")
+    partitionParser.set_defaults(func=partition)
+
+    exportParser = subparsers.add_parser(
+        'export', help="Write a memory to a portable, versioned snapshot directory.")
+    exportParser.add_argument("-m", "--memory", type=str, default='memories/20_mem',
+                              help="Path to the memory to export.")
+    exportParser.add_argument("-o", "--output", type=str, required=True,
+                              help="Snapshot directory to write.")
+    exportParser.set_defaults(func=export)
+
+    importParser = subparsers.add_parser(
+        'import', help="Merge a snapshot into a memory, creating it if needed.")
+    importParser.add_argument("-i", "--input", type=str, required=True,
+                              help="Snapshot directory to read.")
+    importParser.add_argument("-m", "--memory", type=str, required=True,
+                              help="Path to the memory to import into.")
+    importParser.add_argument("-b", "--backend", type=str, default=None,
+                              help="'chroma' or 'local', defaults to memory_backend in config.yaml.")
+    importParser.add_argument("-p", "--policy", type=str, default='skip',
+                              help="Conflict policy for items already in the memory: 'skip', 'newest' or 'mistake-correction'.")
+    importParser.add_argument("--no-verify", action='store_true',
+                              help="Skip the snapshot checksum check.")
+    importParser.add_argument("--force", action='store_true',
+                              help="Import a snapshot embedded with another model than the memory.")
+    importParser.set_defaults(func=load)
+
+    reembedParser = subparsers.add_parser(
+        'reembed', help="Copy a sce_language memory to a new one embedded with another embedding backend.")
+    reembedParser.add_argument("-s", "--source", type=str, default='memories/20_mem',
+                               help="Path to the memory to read.")
+    reembedParser.add_argument("-t", "--target", type=str, required=True,
+                               help="Path to the memory to write.")
+    reembedParser.add_argument("-e", "--embedding", type=str, default=None,
+                               help="'openai', 'hashing' or 'onnx', defaults to EMBEDDING_BACKEND in config.yaml.")
+    reembedParser.add_argument("-b", "--backend", type=str, default=None,
+                               help="'chroma' or 'local', defaults to memory_backend in config.yaml.")
+    reembedParser.add_argument("--fit", action='store_true',
+                               help="Fit the 'hashing' IDF weights on the source documents and write them to EMBEDDING_MODEL_PATH.")
+    reembedParser.add_argument("--batch-size", type=int, default=5000,
+                               help="Items embedded and written at a time.")
+    reembedParser.set_defaults(func=reembed)
+
+    args = parser.parse_args()
+    config = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)
+    setupLLMEnv(config)
+    args.func(config, args)
@@ -1,5 +1,9 @@
+import asyncio
 import copy
 import random
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import yaml
 import os
@@ -9,9 +13,13 @@ import gymnasium as gym
 from gymnasium.wrappers import RecordVideo
 
 from dilu.scenario.envScenario import EnvScenario
+from dilu.scenario.frameRecord import FrameRecord, FrameRecordLog
+from dilu.scenario.scenarioVector import encodeScenario
 from dilu.driver_agent.driverAgent import DriverAgent
-from dilu.driver_agent.vectorStore import DrivingMemory
-from dilu.driver_agent.reflectionAgent import ReflectionAgent
+from dilu.driver_agent.vectorStore import HIT_FLUSH_EVERY, DrivingMemory, MemoryItem
+from dilu.driver_agent.reflectionAgent import REFLECTION_POLICIES, ReflectionAgent, acceptsMemory
+from dilu.driver_agent.llmFactory import setupLLMEnv, llmCacheStats, embeddingCacheStats, clientStats
+from dilu.driver_agent.clientPool import clientPool
 
 
 test_list_seed = [5838, 2421, 7294, 9650, 4176, 6382, 8765, 1348,
@@ -19,19 +27,7 @@ test_list_seed = [5838, 2421, 7294, 9650, 4176, 6382, 8765, 1348,
 
 
 def setup_env(config):
-    if config['OPENAI_API_TYPE'] == 'azure':
-        os.environ["OPENAI_API_TYPE"] = config['OPENAI_API_TYPE']
-        os.environ["OPENAI_API_VERSION"] = config['AZURE_API_VERSION']
-        os.environ["OPENAI_API_BASE"] = config['AZURE_API_BASE']
-        os.environ["OPENAI_API_KEY"] = config['AZURE_API_KEY']
-        os.environ["AZURE_CHAT_DEPLOY_NAME"] = config['AZURE_CHAT_DEPLOY_NAME']
-        os.environ["AZURE_EMBED_DEPLOY_NAME"] = config['AZURE_EMBED_DEPLOY_NAME']
-    elif config['OPENAI_API_TYPE'] == 'openai':
-        os.environ["OPENAI_API_TYPE"] = config['OPENAI_API_TYPE']
-        os.environ["OPENAI_API_KEY"] = config['OPENAI_KEY']
-        os.environ["OPENAI_CHAT_MODEL"] = config['OPENAI_CHAT_MODEL']
-    else:
-        raise ValueError("Unknown OPENAI_API_TYPE, should be azure or openai")
+    setupLLMEnv(config)
 
     # environment setting
     env_config = {
@@ -64,6 +60,598 @@ def setup_env(config):
     return env_config
 
 
+
+
+def load_memory(config, memory_path, write_hits=True):
+    # without `write_hits`, retrieval counts are collected for another
+    # process to write, see `_run_worker_episode`
+    return DrivingMemory(
+        config["memory_encode_type"], memory_path, config["memory_backend"],
+        capacity=config["memory_capacity"],
+        dedup_radius=config["memory_dedup_radius"],
+        track_hits=config["memory_track_hits"],
+        hit_flush_every=HIT_FLUSH_EVERY if write_hits else None,
+        partitioned=config["memory_partitioned"],
+        partition_min=config["memory_partition_min"],
+        reuse_radius=config["memory_reuse_radius"]
+    )
+
+
+def log_memory_load(config, memory):
+    with open(config["result_folder"] + "/" + 'log.txt', 'a') as f:
+        f.write("Memory load | Path: {} | Items: {} | Time: {:.1f} ms \n".format(
+            memory.db_path, memory.collection.count(), memory.load_seconds * 1000))
+
+
+def reuse_line(name, stats):
+    distances = stats["refresh_distances"]
+    return "{} | Lookups: {} | Reused: {} | Reuse rate: {:.2%} | Refreshes: {} | Refresh distance mean: {:.4f} max: {:.4f} \n".format(
+        name, stats["lookups"], stats["reused"], stats["reuse_rate"], len(distances),
+        float(np.mean(distances)) if distances else 0.0, max(distances, default=0.0))
+
+
+def log_memory_reuse(log_path, episode, stats):
+    if stats is None:
+        return
+    line = reuse_line("Memory reuse | Simulation {}".format(episode), stats)
+    with open(log_path, 'a') as f:
+        f.write(line)
+    print("[cyan]" + line + "[/cyan]")
+
+
+def log_step_stats(log_path, episode, step_stats):
+    if not step_stats:
+        return
+    # consensus steps send no prompt
+    prompt_tokens = [stats["promptTokens"] for stats in step_stats
+                     if stats.get("decisionSource") != "consensus"] or [0]
+    decided = [stats for stats in step_stats if "decisionSeconds" in stats]
+    with open(log_path, 'a') as f:
+        f.write("Prompt tokens | Simulation {} | Steps: {} | Mean: {:.0f} | Max: {} \n".format(
+            episode, len(prompt_tokens), float(np.mean(prompt_tokens)), max(prompt_tokens)))
+        if decided:
+            f.write("Decision stream | Simulation {} | Mean time to decision: {:.2f} s | Consensus steps: {} | Early stops: {} | Completion tokens: {} | Saved tokens (bound): {} \n".format(
+                episode, float(np.mean([stats["decisionSeconds"] for stats in decided])),
+                sum(1 for stats in decided if stats["decisionSource"] == "consensus"),
+                sum(1 for stats in decided if stats["savedTokensBound"]),
+                sum(stats["completionTokens"] for stats in decided),
+                sum(stats["savedTokensBound"] for stats in decided)))
+
+
+def parser_line(name, stats):
+    return "{} | {} \n".format(
+        name, " | ".join("{}: {}".format(tier, count) for tier, count in stats.items()))
+
+
+def make_episode(config, env_config, episode, seed):
+    # setup highway-env
+    envType = 'highway-v0'
+    env = gym.make(envType, render_mode="rgb_array")
+    env.configure(env_config[envType])
+    result_prefix = f"highway_{episode}"
+    env = RecordVideo(env, config["result_folder"], name_prefix=result_prefix)
+    env.unwrapped.set_record_video_wrapper(env)
+    obs, info = env.reset(seed=seed)
+    env.render()
+
+    # scenario and driver agent setting
+    database_path = config["result_folder"] + "/" + result_prefix + ".db"
+    sce = EnvScenario(env, envType, seed, database_path,
+                      config.get("db_async_writes", False),
+                      config.get("trajectory_export"))
+    return env, obs, sce, result_prefix
+
+
+def decision_inputs(sce, agent_memory, frame, few_shot_num, previous_action, consensus_min_similarity=None):
+    """The prompt inputs of a decision frame, and the action all retrieved
+    memories agree on if `consensus_min_similarity` is given and met."""
+    print("[cyan]Retreive similar memories...[/cyan]")
+    fewshot_results = agent_memory.retriveMemory(
+        sce, frame, few_shot_num, with_scores=True) if few_shot_num > 0 else []
+    fewshot_messages = []
+    fewshot_answers = []
+    fewshot_actions = []
+    fewshot_scores = []
+    for fewshot_result, score in fewshot_results:
+        fewshot_messages.append(
+            fewshot_result["human_question"])
+        fewshot_answers.append(fewshot_result["LLM_response"])
+        fewshot_actions.append(fewshot_result["action"])
+        fewshot_scores.append(score)
+        mode_action = max(
+            set(fewshot_actions), key=fewshot_actions.count)
+        mode_action_count = fewshot_actions.count(mode_action)
+    if few_shot_num == 0:
+        print("[yellow]Now in the zero-shot mode, no few-shot memories.[/yellow]")
+    else:
+        print("[green4]Successfully find[/green4]", len(
+            fewshot_actions), "[green4]similar memories![/green4]")
+
+    consensus = None
+    if consensus_min_similarity is not None and fewshot_actions \
+            and mode_action_count == few_shot_num \
+            and min(fewshot_scores) >= consensus_min_similarity \
+            and mode_action in sce.env.get_available_actions():
+        consensus = (mode_action, min(fewshot_scores))
+
+    sce_descrip = sce.describe(frame)
+    avail_action = sce.availableActionsDescription()
+    print('[cyan]Scenario description: [/cyan]\n', sce_descrip)
+    # print('[cyan]Available actions: [/cyan]\n',avail_action)
+    return dict(
+        scenario_description=sce_descrip, available_actions=avail_action,
+        previous_decisions=previous_action,
+        fewshot_messages=fewshot_messages,
+        driving_intensions="Drive safely and avoid collisons",
+        fewshot_answers=fewshot_answers,
+    ), consensus
+
+
+def confirm_memory(config, comments, question):
+    if config["reflection_policy"] == 'interactive':
+        return input(question).strip().upper() == 'Y'
+    return acceptsMemory(config["reflection_policy"], comments)
+
+
+def commit_step(env, sce, frame, action, human_question, fewshot_answer, response, step_stats=None):
+    obs, reward, done, info, _ = env.step(action)
+
+    env.render()
+    sce.promptsCommit(frame, None, done, human_question,
+                      fewshot_answer, response, step_stats)
+    env.unwrapped.automatic_rendering_callback = env.video_recorder.capture_frame()
+
+    print("--------------------")
+    return obs, done
+
+
+def run_episode(config, env_config, episode, seed, agent_memory, log_path, updated_memory=None):
+    REFLECTION = config["reflection_module"]
+    few_shot_num = config["few_shot_num"]
+    consensus_min_similarity = config["consensus_min_similarity"] \
+        if config["consensus_fast_path"] else None
+
+    env, obs, sce, result_prefix = make_episode(
+        config, env_config, episode, seed)
+    DA = DriverAgent(sce, verbose=True,
+                     token_budget=config["prompt_token_budget"],
+                     budget_policy=config["prompt_budget_policy"])
+    if REFLECTION:
+        RA = ReflectionAgent(verbose=True)
+
+    response = "Not available"
+    action = "Not available"
+    docs = FrameRecordLog(
+        config["result_folder"] + "/" + result_prefix + "_frames.jsonl"
+        if config.get("spill_frame_records", False) else None)
+    collision_frame = -1
+    already_decision_steps = 0
+
+    try:
+        for i in range(0, config["simulation_duration"]):
+            obs = np.array(obs, dtype=float)
+
+            inputs, consensus = decision_inputs(
+                sce, agent_memory, i, few_shot_num, action, consensus_min_similarity)
+            sce_descrip = inputs["scenario_description"]
+            if consensus is not None:
+                action, response, human_question, fewshot_answer = DA.consensus_decision(
+                    *consensus, **inputs)
+            else:
+                action, response, human_question, fewshot_answer = DA.few_shot_decision(
+                    **inputs)
+            docs.append(FrameRecord(
+                frame=i,
+                sce_descrip=sce_descrip,
+                human_question=human_question,
+                response=response,
+                action=action,
+                sce_vector=encodeScenario(sce, i).tolist()
+                if config["memory_encode_type"] == "sce_encode" else None,
+                decisionSource=DA.step_stats[-1].get("decisionSource"),
+            ))
+
+            obs, done = commit_step(env, sce, i, action, human_question,
+                                    fewshot_answer, response, DA.step_stats[-1])
+            already_decision_steps += 1
+
+            if done:
+                print("[red]Simulation crash after running steps: [/red] ", i)
+                collision_frame = i
+                break
+    finally:
+
+        with open(log_path, 'a') as f:
+            f.write(
+                "Simulation {} | Seed {} | Steps: {} | File prefix: {} \n".format(episode, seed, already_decision_steps, result_prefix))
+        memory_reuse = agent_memory.reuseStats(sce)
+        log_memory_reuse(log_path, episode, memory_reuse)
+        log_step_stats(log_path, episode, DA.step_stats)
+        parser_stats = DA.output_parser.stats()
+        with open(log_path, 'a') as f:
+            f.write(parser_line("Action parser | Simulation {}".format(episode), parser_stats))
+
+        if REFLECTION:
+            print("[yellow]Now running reflection agent...[/yellow]")
+            if collision_frame != -1: # End with collision
+                for i in range(collision_frame, -1, -1):
+                    # not decelearate, and decided by the LLM rather than memory consensus
+                    if docs[i].action != 4 and docs[i].decisionSource != "consensus":
+                        corrected_response = RA.reflection(
+                            docs[i].human_question, docs[i].response)
+
+                        if confirm_memory(config, "mistake-correction", "[yellow]Do you want to add this new memory item to update memory module? (Y/N): "):
+                            updated_memory.addMemory(
+                                docs[i].sce_descrip,
+                                docs[i].human_question,
+                                corrected_response,
+                                docs[i].action,
+                                docs[i],
+                                comments="mistake-correction"
+                            )
+                            print("[green] Successfully add a new memory item to update memory module.[/green]. Now the database has ",
+                                updated_memory.collection.count(), " items.")
+                        else:
+                            print("[blue]Ignore this new memory item[/blue]")
+                        break
+            else:
+                if config["reflection_policy"] == 'interactive':
+                    print("[yellow]Do you want to add[/yellow]",len(docs)//5, "[yellow]new memory item to update memory module?[/yellow]",end="")
+                if confirm_memory(config, "no-mistake-direct", "(Y/N): "):
+                    items = [
+                        MemoryItem(
+                            docs[i].sce_descrip,
+                            docs[i].human_question,
+                            docs[i].response,
+                            docs[i].action,
+                            "no-mistake-direct",
+                            docs[i].sce_vector
+                        )
+                        for i in range(0, len(docs))
+                        if i % 5 == 1 and docs[i].decisionSource != "consensus"
+                    ]
+                    counts = updated_memory.addMemories(items)
+                    print("[green] Successfully add[/green] ",counts["added"]," [green]new memory item to update memory module.[/green]. Now the database has ",
+                                updated_memory.collection.count(), " items.")
+                else:
+                    print("[blue]Ignore these new memory items[/blue]")
+
+
+        print("==========Simulation {} Done==========".format(episode))
+        summary = cache_summary()
+        if summary:
+            print("[cyan]" + summary + "[/cyan]")
+        try:
+            docs.close()
+            sce.close()
+        finally:
+            # a failed database flush must not leak the viewer and video recorder
+            env.close()
+
+    return {
+        "episode": episode,
+        "seed": seed,
+        "steps": already_decision_steps,
+        "collision_frame": collision_frame,
+        "file_prefix": result_prefix,
+        "memory_reuse": memory_reuse,
+        "parser_stats": parser_stats,
+        "error": None,
+    }
+
+
+async def run_episode_async(config, env_config, episode, seed, agent_memory, log_path, llm_semaphore, memory_executor, finished_envs):
+    """Asyncio flavour of `run_episode` without the interactive reflection.
+
+    Only the LLM request is awaited; memory retrieval goes through a
+    single-thread executor so the shared memory store is never queried
+    concurrently, and the simulation itself runs on the event loop thread.
+    Closing a highway-env viewer shuts pygame down for every episode in the
+    process, so only the video is finalized here and the env is handed back
+    through `finished_envs` to be closed once all episodes are done.
+    """
+    few_shot_num = config["few_shot_num"]
+    loop = asyncio.get_running_loop()
+    consensus_min_similarity = config["consensus_min_similarity"] \
+        if config["consensus_fast_path"] else None
+
+    env, obs, sce, result_prefix = make_episode(
+        config, env_config, episode, seed)
+    DA = DriverAgent(sce, verbose=True,
+                     token_budget=config["prompt_token_budget"],
+                     budget_policy=config["prompt_budget_policy"])
+
+    action = "Not available"
+    collision_frame = -1
+    already_decision_steps = 0
+
+    try:
+        for i in range(0, config["simulation_duration"]):
+            inputs, consensus = await loop.run_in_executor(
+                memory_executor, decision_inputs,
+                sce, agent_memory, i, few_shot_num, action, consensus_min_similarity)
+            if consensus is not None:
+                action, response, human_question, fewshot_answer = DA.consensus_decision(
+                    *consensus, **inputs)
+            else:
+                async with llm_semaphore:
+                    action, response, human_question, fewshot_answer = await DA.afew_shot_decision(
+                        **inputs)
+
+            obs, done = commit_step(env, sce, i, action, human_question,
+                                    fewshot_answer, response, DA.step_stats[-1])
+            already_decision_steps += 1
+
+            if done:
+                print("[red]Simulation {} crash after running steps: [/red] ".format(episode), i)
+                collision_frame = i
+                break
+    finally:
+        with open(log_path, 'a') as f:
+            f.write(
+                "Simulation {} | Seed {} | Steps: {} | File prefix: {} \n".format(episode, seed, already_decision_steps, result_prefix))
+        memory_reuse = agent_memory.reuseStats(sce)
+        log_memory_reuse(log_path, episode, memory_reuse)
+        log_step_stats(log_path, episode, DA.step_stats)
+        parser_stats = DA.output_parser.stats()
+        with open(log_path, 'a') as f:
+            f.write(parser_line("Action parser | Simulation {}".format(episode), parser_stats))
+        print("==========Simulation {} Done==========".format(episode))
+        try:
+            sce.close()
+        finally:
+            env.close_video_recorder()
+            finished_envs.append(env)
+
+    return {
+        "episode": episode,
+        "seed": seed,
+        "steps": already_decision_steps,
+        "collision_frame": collision_frame,
+        "file_prefix": result_prefix,
+        "memory_reuse": memory_reuse,
+        "parser_stats": parser_stats,
+        "error": None,
+    }
+
+
+async def run_async(config, env_config, seeds, agent_memory):
+    """Run all episodes in one event loop, capping in-flight LLM requests."""
+    config = dict(config, reflection_module=False)
+    # Several viewers cannot share one pygame display, so draw offscreen.
+    env_config = copy.deepcopy(env_config)
+    for envType in env_config:
+        env_config[envType]["offscreen_rendering"] = True
+    llm_semaphore = asyncio.Semaphore(config["llm_concurrency"])
+    memory_executor = ThreadPoolExecutor(max_workers=1)
+    log_path = config["result_folder"] + "/" + 'log.txt'
+    finished_envs = []
+    # all episodes share the kept-alive connections of one aiohttp session
+    async with clientPool().aioSession():
+        outcomes = await asyncio.gather(*[
+            run_episode_async(config, env_config, episode, seed, agent_memory,
+                              log_path, llm_semaphore, memory_executor,
+                              finished_envs)
+            for episode, seed in enumerate(seeds)
+        ], return_exceptions=True)
+    memory_executor.shutdown()
+    for env in finished_envs:
+        env.close()
+
+    results = []
+    for episode, (seed, outcome) in enumerate(zip(seeds, outcomes)):
+        if isinstance(outcome, BaseException):
+            print("[red]Simulation {} failed:[/red] {!r}".format(episode, outcome))
+            outcome = {
+                "episode": episode,
+                "seed": seed,
+                "steps": None,
+                "collision_frame": None,
+                "file_prefix": f"highway_{episode}",
+                "error": "".join(traceback.format_exception(
+                    type(outcome), outcome, outcome.__traceback__)),
+            }
+        results.append(outcome)
+    return results
+
+
+# Each worker process loads its own memory once and reuses it for every
+# episode it is handed by the pool.
+_worker_memory = None
+
+
+def _init_worker(config):
+    global _worker_memory
+    import warnings
+    warnings.filterwarnings("ignore")
+    setup_env(config)
+    # workers share the store, so they return their hit counts and only the
+    # parent process writes them
+    _worker_memory = load_memory(config, config["memory_path"], write_hits=False)
+
+
+def _run_worker_episode(config, env_config, episode, seed):
+    log_path = os.path.join(
+        config["result_folder"], f"log_worker_{episode}.txt")
+    stats = process_stats()
+    try:
+        result = run_episode(config, env_config, episode, seed,
+                             _worker_memory, log_path)
+    except Exception:
+        result = {
+            "episode": episode,
+            "seed": seed,
+            "steps": None,
+            "collision_frame": None,
+            "file_prefix": f"highway_{episode}",
+            "error": traceback.format_exc(),
+        }
+    result["memory_hits"] = _worker_memory.takeHits()
+    result["process_stats"] = stats_delta(stats, process_stats())
+    return result
+
+
+def flush_worker_hits(config, results):
+    if not config["memory_track_hits"]:
+        return
+    memory = load_memory(config, config["memory_path"])
+    for result in results:
+        memory.addHits(result.get("memory_hits") or {})
+    memory.flushHits()
+
+
+def run_parallel(config, env_config, seeds):
+    """Spread episodes over a process pool.
+
+    Every episode writes its own database, video and worker log; a worker
+    that raises only fails its own episode, and a worker that dies hard gets
+    its pending episodes resubmitted to a fresh pool once.
+    """
+    # workers have no updated memory to reflect into
+    config = dict(config, reflection_module=False)
+    workers = config["episode_workers"]
+    pending = {episode: seed for episode, seed in enumerate(seeds)}
+    attempts = {episode: 0 for episode in pending}
+    results = {}
+    while pending:
+        broken = []
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(config,)
+        ) as executor:
+            futures = {
+                executor.submit(_run_worker_episode, config, env_config, episode, seed): episode
+                for episode, seed in pending.items()
+            }
+            for future in as_completed(futures):
+                episode = futures[future]
+                try:
+                    results[episode] = future.result()
+                except BrokenProcessPool:
+                    broken.append(episode)
+                    continue
+                if results[episode]["error"]:
+                    print("[red]Simulation {} failed:[/red]\n{}".format(
+                        episode, results[episode]["error"]))
+                else:
+                    print("[green]Simulation {} finished in worker.[/green]".format(episode))
+        retry = {}
+        for episode in broken:
+            attempts[episode] += 1
+            if attempts[episode] > 1:
+                results[episode] = {
+                    "episode": episode,
+                    "seed": pending[episode],
+                    "steps": None,
+                    "collision_frame": None,
+                    "file_prefix": f"highway_{episode}",
+                    "error": "worker process terminated abruptly",
+                }
+            else:
+                retry[episode] = pending[episode]
+        if retry:
+            print("[yellow]Worker pool broke, resubmitting[/yellow]", len(retry), "[yellow]episodes.[/yellow]")
+        pending = retry
+    return [results[episode] for episode in sorted(results)]
+
+
+def merge_logs(config, results):
+    result_folder = config["result_folder"]
+    with open(result_folder + "/" + 'log.txt', 'a') as f:
+        for result in results:
+            worker_log = os.path.join(
+                result_folder, "log_worker_{}.txt".format(result["episode"]))
+            if os.path.exists(worker_log):
+                with open(worker_log) as wf:
+                    f.write(wf.read())
+                os.remove(worker_log)
+            if result["error"]:
+                f.write("Simulation {} | Seed {} | Failed: {} \n".format(
+                    result["episode"], result["seed"],
+                    result["error"].strip().splitlines()[-1]))
+    write_summary(config, results)
+
+
+def process_stats():
+    """Cache and connection counters of this process, None for what is not in use."""
+    return {
+        "llm_cache": llmCacheStats(),
+        "embedding_cache": embeddingCacheStats(),
+        "connections": clientStats(),
+    }
+
+
+def stats_delta(before, after):
+    # counters are per process, a worker reports what one episode added
+    return {
+        name: None if counters is None else {
+            key: value - ((before.get(name) or {}).get(key, 0))
+            for key, value in counters.items() if key != "hit_rate"}
+        for name, counters in after.items()
+    }
+
+
+def sum_stats(all_stats):
+    total = {}
+    for stats in all_stats:
+        for name, counters in stats.items():
+            if counters is None:
+                continue
+            total.setdefault(name, {})
+            for key, value in counters.items():
+                if key != "hit_rate":
+                    total[name][key] = total[name].get(key, 0) + value
+    return total
+
+
+def cache_summary(stats=None):
+    stats = process_stats() if stats is None else stats
+    summary = ""
+    for name, key in (("LLM cache", "llm_cache"), ("Embedding cache", "embedding_cache")):
+        counters = stats.get(key)
+        if counters is not None:
+            lookups = counters["hits"] + counters["misses"]
+            summary += "{} | Hits: {} | Misses: {} | Hit rate: {:.2%} \n".format(
+                name, counters["hits"], counters["misses"],
+                counters["hits"] / lookups if lookups else 0.0)
+    counters = stats.get("connections")
+    if counters is not None and counters["requests"]:
+        summary += "LLM connections | Requests: {} | New connections: {} | Reused: {} | Retries: {} | Timeouts: {} | Failures: {} \n".format(
+            counters["requests"], counters["connections"], counters["reused"],
+            counters["retries"], counters["timeouts"], counters["failures"])
+    return summary
+
+
+def write_summary(config, results):
+    finished = [r for r in results if not r["error"]]
+    collided = [r for r in finished if r["collision_frame"] != -1]
+    failed = [r for r in results if r["error"]]
+    avg_steps = sum(r["steps"] for r in finished) / \
+        len(finished) if finished else 0
+    summary = "Summary | Episodes: {} | Finished: {} | Collisions: {} | Failed: {} | Avg steps: {:.2f} \n".format(
+        len(results), len(finished), len(collided), len(failed), avg_steps)
+    # worker processes report their own counters, this process only has
+    # what it used itself
+    summary += cache_summary(sum_stats(
+        [process_stats()] + [r["process_stats"] for r in results if r.get("process_stats")]))
+    parser_stats = [r["parser_stats"] for r in finished if r.get("parser_stats")]
+    if parser_stats:
+        summary += parser_line("Action parser", {
+            tier: sum(stats[tier] for stats in parser_stats) for tier in parser_stats[0]})
+    reuse = [r["memory_reuse"] for r in finished if r.get("memory_reuse")]
+    if reuse:
+        lookups = sum(stats["lookups"] for stats in reuse)
+        reused = sum(stats["reused"] for stats in reuse)
+        summary += reuse_line("Memory reuse", {
+            "lookups": lookups,
+            "reused": reused,
+            "reuse_rate": reused / lookups if lookups else 0.0,
+            "refresh_distances": [d for stats in reuse for d in stats["refresh_distances"]],
+        })
+    with open(config["result_folder"] + "/" + 'log.txt', 'a') as f:
+        f.write(summary)
+    print("[cyan]" + summary + "[/cyan]")
+
+
 if __name__ == '__main__':
     import warnings
     warnings.filterwarnings("ignore")
@@ -81,145 +669,53 @@ if __name__ == '__main__':
         f.write("memory_path {} | result_folder {} | few_shot_num: {} | lanes_count: {} \n".format(
             memory_path, result_folder, few_shot_num, env_config['highway-v0']['lanes_count']))
 
-    agent_memory = DrivingMemory(db_path=memory_path)
-    if REFLECTION:
-        updated_memory = DrivingMemory(db_path=memory_path + "_updated")
-        updated_memory.combineMemory(agent_memory)
-
-    episode = 0
-    while episode < config["episodes_num"]:
-        # setup highway-env
-        envType = 'highway-v0'
-        env = gym.make(envType, render_mode="rgb_array")
-        env.configure(env_config[envType])
-        result_prefix = f"highway_{episode}"
-        env = RecordVideo(env, result_folder, name_prefix=result_prefix)
-        env.unwrapped.set_record_video_wrapper(env)
-        seed = random.choice(test_list_seed)
-        obs, info = env.reset(seed=seed)
-        env.render()
-
-        # scenario and driver agent setting
-        database_path = result_folder + "/" + result_prefix + ".db"
-        sce = EnvScenario(env, envType, seed, database_path)
-        DA = DriverAgent(sce, verbose=True)
-        if REFLECTION:
-            RA = ReflectionAgent(verbose=True)
+    seeds = [random.choice(test_list_seed)
+             for _ in range(config["episodes_num"])]
 
-        response = "Not available"
-        action = "Not available"
-        docs = []
-        collision_frame = -1
+    if REFLECTION and config["reflection_policy"] not in REFLECTION_POLICIES:
+        raise ValueError(
+            f"Unknown reflection policy: should be one of {', '.join(REFLECTION_POLICIES)}")
+    if config["consensus_fast_path"] and config["memory_encode_type"] == "sce_encode":
+        # scenario vectors are not unit length, so 1 - d / 2 is no similarity
+        print("[yellow]The consensus fast path needs sce_language memories, it is turned off.[/yellow]")
+        config["consensus_fast_path"] = False
+    INTERACTIVE = REFLECTION and config["reflection_policy"] == 'interactive'
+    if config.get("episode_workers", 1) > 1 and INTERACTIVE:
+        print("[yellow]Reflection mode asks for confirmation interactively, running episodes serially.[/yellow]")
+        config["episode_workers"] = 1
 
-        try:
-            already_decision_steps = 0
-            for i in range(0, config["simulation_duration"]):
-                obs = np.array(obs, dtype=float)
-
-                print("[cyan]Retreive similar memories...[/cyan]")
-                fewshot_results = agent_memory.retriveMemory(
-                    sce, i, few_shot_num) if few_shot_num > 0 else []
-                fewshot_messages = []
-                fewshot_answers = []
-                fewshot_actions = []
-                for fewshot_result in fewshot_results:
-                    fewshot_messages.append(
-                        fewshot_result["human_question"])
-                    fewshot_answers.append(fewshot_result["LLM_response"])
-                    fewshot_actions.append(fewshot_result["action"])
-                    mode_action = max(
-                        set(fewshot_actions), key=fewshot_actions.count)
-                    mode_action_count = fewshot_actions.count(mode_action)
-                if few_shot_num == 0:
-                    print("[yellow]Now in the zero-shot mode, no few-shot memories.[/yellow]")
-                else:
-                    print("[green4]Successfully find[/green4]", len(
-                        fewshot_actions), "[green4]similar memories![/green4]")
+    if config.get("async_episodes", False) and INTERACTIVE:
+        print("[yellow]Reflection mode asks for confirmation interactively, running episodes serially.[/yellow]")
+        config["async_episodes"] = False
 
-                sce_descrip = sce.describe(i)
-                avail_action = sce.availableActionsDescription()
-                print('[cyan]Scenario description: [/cyan]\n', sce_descrip)
-                # print('[cyan]Available actions: [/cyan]\n',avail_action)
-                action, response, human_question, fewshot_answer = DA.few_shot_decision(
-                    scenario_description=sce_descrip, available_actions=avail_action,
-                    previous_decisions=action,
-                    fewshot_messages=fewshot_messages,
-                    driving_intensions="Drive safely and avoid collisons",
-                    fewshot_answers=fewshot_answers,
-                )
-                docs.append({
-                    "sce_descrip": sce_descrip,
-                    "human_question": human_question,
-                    "response": response,
-                    "action": action,
-                    "sce": copy.deepcopy(sce)
-                })
-
-                obs, reward, done, info, _ = env.step(action)
-                already_decision_steps += 1
-
-                env.render()
-                sce.promptsCommit(i, None, done, human_question,
-                                  fewshot_answer, response)
-                env.unwrapped.automatic_rendering_callback = env.video_recorder.capture_frame()
-
-                print("--------------------")
-
-                if done:
-                    print("[red]Simulation crash after running steps: [/red] ", i)
-                    collision_frame = i
-                    break
-        finally:
+    if REFLECTION and (config.get("episode_workers", 1) > 1 or config.get("async_episodes", False)):
+        print("[yellow]Parallel episodes do not reflect, run `python run_reflection.py` on their results.[/yellow]")
+        config["reflection_module"] = False
 
-            with open(result_folder + "/" + 'log.txt', 'a') as f:
-                f.write(
-                    "Simulation {} | Seed {} | Steps: {} | File prefix: {} \n".format(episode, seed, already_decision_steps, result_prefix))
-                
-            if REFLECTION:
-                print("[yellow]Now running reflection agent...[/yellow]")
-                if collision_frame != -1: # End with collision
-                    for i in range(collision_frame, -1, -1):
-                        if docs[i]["action"] != 4:  # not decelearate
-                            corrected_response = RA.reflection(
-                                docs[i]["human_question"], docs[i]["response"])
-                            
-                            choice = input("[yellow]Do you want to add this new memory item to update memory module? (Y/N): ").strip().upper()
-                            if choice == 'Y':
-                                updated_memory.addMemory(
-                                    docs[i]["sce_descrip"],
-                                    docs[i]["human_question"],
-                                    corrected_response,
-                                    docs[i]["action"],
-                                    docs[i]["sce"],
-                                    comments="mistake-correction"
-                                )
-                                print("[green] Successfully add a new memory item to update memory module.[/green]. Now the database has ", len(
-                                    updated_memory.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
-                            else:
-                                print("[blue]Ignore this new memory item[/blue]")
-                            break
-                else:
-                    print("[yellow]Do you want to add[/yellow]",len(docs)//5, "[yellow]new memory item to update memory module?[/yellow]",end="")
-                    choice = input("(Y/N): ").strip().upper()
-                    if choice == 'Y':
-                        cnt = 0
-                        for i in range(0, len(docs)):
-                            if i % 5 == 1:
-                                updated_memory.addMemory(
-                                    docs[i]["sce_descrip"],
-                                    docs[i]["human_question"],
-                                    docs[i]["response"],
-                                    docs[i]["action"],
-                                    docs[i]["sce"],
-                                    comments="no-mistake-direct"
-                                )
-                                cnt +=1
-                        print("[green] Successfully add[/green] ",cnt," [green]new memory item to update memory module.[/green]. Now the database has ", len(
-                                    updated_memory.scenario_memory._collection.get(include=['embeddings'])['embeddings']), " items.")
-                    else:
-                        print("[blue]Ignore these new memory items[/blue]")
-            
-
-            print("==========Simulation {} Done==========".format(episode))
-            episode += 1
-            env.close()
+    if config.get("async_episodes", False):
+        agent_memory = load_memory(config, memory_path)
+        log_memory_load(config, agent_memory)
+        results = asyncio.run(
+            run_async(config, env_config, seeds, agent_memory))
+        agent_memory.flushHits()
+        merge_logs(config, results)
+    elif config.get("episode_workers", 1) > 1:
+        results = run_parallel(config, env_config, seeds)
+        flush_worker_hits(config, results)
+        merge_logs(config, results)
+    else:
+        agent_memory = load_memory(config, memory_path)
+        log_memory_load(config, agent_memory)
+        updated_memory = None
+        if REFLECTION:
+            updated_memory = load_memory(config, memory_path + "_updated")
+            updated_memory.combineMemory(
+                agent_memory, config["memory_merge_policy"])
+
+        results = []
+        for episode, seed in enumerate(seeds):
+            results.append(run_episode(
+                config, env_config, episode, seed, agent_memory,
+                result_folder + "/" + 'log.txt', updated_memory))
+        agent_memory.flushHits()
+        write_summary(config, results)
@@ -0,0 +1,204 @@
+"""Batch reflection over the result databases of finished runs.
+
+`run_dilu.py` reflects inline at the end of every serial episode. This
+script does the same work afterwards and without supervision: it reads the
+decision frames from the `promptsINFO` table of many result databases,
+reflects on the last non-decelerating decision before every collision with
+concurrent LLM requests, and adds the memory items accepted by the
+reflection policy to the updated memory in one batch.
+
+    python run_reflection.py -r 'results/*.db' -p corrections
+"""
+import argparse
+import asyncio
+import glob
+import re
+import sqlite3
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import yaml
+from rich import print
+
+from dilu.driver_agent.clientPool import clientPool
+from dilu.driver_agent.llmFactory import setupLLMEnv
+from dilu.driver_agent.outputAgent import parseLocally
+from dilu.driver_agent.reflectionAgent import REFLECTION_POLICIES, ReflectionAgent, acceptsMemory
+from dilu.driver_agent.vectorStore import DrivingMemory, MemoryItem
+from dilu.scenario.frameRecord import FrameRecord
+from dilu.scenario.scenarioVector import encodeResultDB
+
+
+DIRECT_EVERY = 5  # collision-free episodes contribute every fifth frame, as in run_dilu.py
+
+
+class ResultEpisode(NamedTuple):
+    database: str
+    frames: List[FrameRecord]
+    collided: bool
+
+
+def readResultDB(database: str, withVectors: bool = False) -> ResultEpisode:
+    conn = sqlite3.connect(database)
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(promptsINFO);")}
+        # databases written before decisionSource was recorded lack the column
+        source = "decisionSource" if "decisionSource" in columns else "NULL"
+        rows = conn.execute(
+            f"""SELECT decisionFrame, done, description, thoughtsAndAction, {source}
+            FROM promptsINFO ORDER BY decisionFrame;"""
+        ).fetchall()
+    finally:
+        conn.close()
+    vectors = encodeResultDB(database) if withVectors else {}
+    frames, collided = [], False
+    for decisionFrame, done, description, response, decisionSource in rows:
+        collided = collided or bool(done)
+        match = re.search(
+            r"#### Driving scenario description:(.*?)####",
+            description or '', re.DOTALL)
+        action, _ = parseLocally(response or '')
+        if match is None or action is None:
+            continue
+        vector = vectors.get(decisionFrame)
+        frames.append(FrameRecord(
+            frame=decisionFrame,
+            sce_descrip=match.group(1).strip(),
+            human_question=description,
+            response=response,
+            action=action,
+            sce_vector=vector.tolist() if vector is not None else None,
+            decisionSource=decisionSource,
+        ))
+    return ResultEpisode(database, frames, collided)
+
+
+def reflectionCandidate(episode: ResultEpisode) -> Optional[FrameRecord]:
+    """The last LLM decision before the collision that did not decelerate."""
+    for record in reversed(episode.frames):
+        if record.action != 4 and record.decisionSource != 'consensus':
+            return record
+    return None
+
+
+def directItems(episode: ResultEpisode) -> List[MemoryItem]:
+    return [
+        MemoryItem(record.sce_descrip, record.human_question, record.response,
+                   record.action, "no-mistake-direct", record.sce_vector)
+        for record in episode.frames
+        if record.frame % DIRECT_EVERY == 1 and record.decisionSource != 'consensus'
+    ]
+
+
+async def reflectLimited(RA: ReflectionAgent, semaphore: asyncio.Semaphore,
+                         record: FrameRecord) -> str:
+    async with semaphore:
+        return await RA.areflection(record.human_question, record.response)
+
+
+async def reflectAll(RA: ReflectionAgent, records: List[FrameRecord],
+                     concurrency: int) -> List:
+    semaphore = asyncio.Semaphore(concurrency)
+    async with clientPool().aioSession():
+        return await asyncio.gather(*[
+            reflectLimited(RA, semaphore, record) for record in records
+        ], return_exceptions=True)
+
+
+def accepted(policy: str, comments: str, description: str) -> bool:
+    if policy != 'interactive':
+        return acceptsMemory(policy, comments)
+    print(description)
+    choice = input("[yellow]Do you want to add this to update memory module? (Y/N): ").strip().upper()
+    return choice == 'Y'
+
+
+def main(config, args):
+    # explicit zeros on the command line override the config too
+    policy = args.policy if args.policy is not None else config['reflection_policy']
+    concurrency = args.concurrency if args.concurrency is not None else config['reflection_concurrency']
+    retries = args.retries if args.retries is not None else config['reflection_retries']
+    if policy not in REFLECTION_POLICIES:
+        raise ValueError(
+            f"Unknown reflection policy: should be one of {', '.join(REFLECTION_POLICIES)}")
+    if concurrency < 1:
+        raise ValueError("Reflection concurrency should be at least 1")
+    if retries < 0:
+        raise ValueError("Reflection retries should be 0 or more")
+    start_time = time.time()
+    databases = sorted(set(
+        path for pattern in args.results for path in glob.glob(pattern)))
+    withVectors = config['memory_encode_type'] == 'sce_encode'
+    episodes = [readResultDB(database, withVectors) for database in databases]
+
+    # identical frames in several databases are reflected on only once
+    candidates: Dict[Tuple[str, str], FrameRecord] = {}
+    direct = []
+    for episode in episodes:
+        if episode.collided:
+            record = reflectionCandidate(episode)
+            if record is not None:
+                candidates.setdefault((record.human_question, record.response), record)
+        else:
+            direct.extend(directItems(episode))
+    collisions = sum(episode.collided for episode in episodes)
+    print(f"Read {len(databases)} result databases, {collisions} ended with a collision.")
+
+    records = list(candidates.values())
+    items, failed = [], 0
+    if records:
+        # transient failures are retried by the reflection model itself
+        RA = ReflectionAgent(verbose=True, retries=retries)
+        print(f"Self-reflection is running on {len(records)} frames, make take time...")
+        responses = asyncio.run(reflectAll(RA, records, concurrency))
+        for record, response in zip(records, responses):
+            if isinstance(response, Exception):
+                failed += 1
+                print(f"[red]Reflection on frame {record.frame} failed:[/red]", repr(response))
+            elif accepted(policy, "mistake-correction", "corrected_memory: " + response):
+                items.append(MemoryItem(
+                    record.sce_descrip, record.human_question, response,
+                    record.action, "mistake-correction", record.sce_vector))
+    if direct and accepted(policy, "no-mistake-direct",
+                           f"{len(direct)} frames of collision-free episodes as new memory items."):
+        items.extend(direct)
+
+    counts = {'added': 0, 'updated': 0}
+    if items:
+        updated_memory = DrivingMemory(
+            config['memory_encode_type'], args.memory or config['memory_path'] + "_updated",
+            config['memory_backend'], capacity=config['memory_capacity'],
+            dedup_radius=config['memory_dedup_radius'], track_hits=False)
+        if not args.no_combine:
+            updated_memory.combineMemory(DrivingMemory(
+                config['memory_encode_type'], config['memory_path'],
+                config['memory_backend'], track_hits=False), config['memory_merge_policy'])
+        counts = updated_memory.addMemories(items)
+
+    summary = "Reflection | Databases: {} | Collisions: {} | Reflected: {} | Failed: {} | Added: {} | Updated: {} | Time: {:.1f}s \n".format(
+        len(databases), collisions, len(records) - failed, failed,
+        counts['added'], counts['updated'], time.time() - start_time)
+    with open(config['result_folder'] + "/" + 'log.txt', 'a') as f:
+        f.write(summary)
+    print("[cyan]" + summary + "[/cyan]")
+
+
+if __name__ == '__main__':
+    config = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)
+    parser = argparse.ArgumentParser(description="Reflect on the collisions of finished runs and update the memory.")
+    parser.add_argument('-r', '--results', nargs='+',
+                        default=[config['result_folder'] + '/*.db'],
+                        help="result database files or glob patterns")
+    parser.add_argument('-m', '--memory',
+                        help="memory to update, memory_path + '_updated' by default")
+    parser.add_argument('-p', '--policy', choices=REFLECTION_POLICIES,
+                        help="overrides reflection_policy")
+    parser.add_argument('-c', '--concurrency', type=int,
+                        help="overrides reflection_concurrency")
+    parser.add_argument('--retries', type=int,
+                        help="overrides reflection_retries")
+    parser.add_argument('--no-combine', action='store_true',
+                        help="do not copy memory_path into the updated memory first")
+    args = parser.parse_args()
+    setupLLMEnv(config)
+    main(config, args)
@@ -0,0 +1,67 @@
+import pytest
+
+from dilu.driver_agent.decisionStream import SCAN_OVERLAP, DecisionStreamParser
+
+
+REASONING = (
+    "Great, I can make my decision now.\n"
+    "Final Answer: Deceleration\n\n"
+)
+DECISION = "Response to user:#### 4"
+TAIL = "\nI decelerate because the front car is too close."
+ANSWER = REASONING + DECISION + TAIL
+
+
+def feedAll(parser: DecisionStreamParser, pieces) -> list:
+    return [parser.feed(piece) for piece in pieces]
+
+
+@pytest.mark.parametrize("split", range(1, len(ANSWER)))
+def test_decision_split_into_two_chunks(split):
+    parser = DecisionStreamParser()
+    decided = feedAll(parser, [ANSWER[:split], ANSWER[split:]])
+    # the id is only complete once the character after it has arrived
+    assert decided == [split > len(REASONING + DECISION), True]
+    assert parser.response == REASONING + DECISION
+
+
+def test_decision_streamed_character_by_character():
+    parser = DecisionStreamParser()
+    decided = feedAll(parser, ANSWER)
+    assert decided.index(True) == len(REASONING + DECISION)
+    assert parser.response == REASONING + DECISION
+
+
+def test_decision_split_after_long_reasoning():
+    parser = DecisionStreamParser()
+    reasoning = "- The distance is safe. " * (4 * SCAN_OVERLAP)
+    pieces = [reasoning, "Response to us", "er:###", "# `4", "`", TAIL]
+    assert feedAll(parser, pieces) == [False, False, False, False, True, True]
+    assert parser.response == reasoning + "Response to user:#### `4"
+
+
+def test_multi_digit_id_split_across_chunks():
+    parser = DecisionStreamParser()
+    assert feedAll(parser, ["Response to user:#### 1", "2", "\n"]) == [False, False, True]
+    assert parser.response == "Response to user:#### 12"
+
+
+def test_no_trailing_text_after_the_id():
+    # a stream that ends right after the id never completes the decision
+    # line, the caller then parses the whole response
+    parser = DecisionStreamParser()
+    assert feedAll(parser, [REASONING, DECISION]) == [False, False]
+    assert not parser.decided
+    assert parser.response == REASONING + DECISION
+
+
+def test_no_delimiter():
+    parser = DecisionStreamParser()
+    assert feedAll(parser, [REASONING, "Response to user: 4", TAIL]) == [False, False, False]
+    assert parser.response == REASONING + "Response to user: 4" + TAIL
+
+
+def test_feed_after_decision_keeps_response():
+    parser = DecisionStreamParser()
+    assert feedAll(parser, [DECISION + "\n", "Response to user:#### 1\n"]) == [True, True]
+    assert parser.response == DECISION
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from langchain.chat_models.fake import FakeListChatModel
+
+from dilu.driver_agent.outputAgent import OutputParser, parseLocally
+
+
+# Reasoning tails of answers stored in memories/20_mem
+IDLE_REASONING = (
+    "The distance 31.21 m is larger than my preferred car following distance 30 m, "
+    "and my speed is higher than the front car on the current lane. "
+    "So I can maintain my current speed.\n"
+    "Great, I can make my decision now."
+)
+DECELERATE_REASONING = (
+    "If I choose idle, the distance between me and car `216` will be further smaller, "
+    "so I should not idle.\n"
+    "- In order to keep a preferred distance with the front car, I can only decelerate. "
+    "Deceleration is a feasible action.\n"
+    "Great, I can make my decision now."
+)
+RIGHT_REASONING = (
+    "- Besides deceleration, I can also try to change lanes. Since there is no vehicle "
+    "in my left lane, I can change lanes to the right. Changing lanes to the right is a feasible action.\n"
+    "Great, I can make my decision now."
+)
+
+PARSE_CASES = [
+    # answers as stored
+    (IDLE_REASONING + " Decision: IDLE\n\nResponse to user:#### 1", 1, 'delimiter'),
+    (DECELERATE_REASONING + "\nFinal Answer: Deceleration\n\nResponse to user:#### 4", 4, 'delimiter'),
+    (RIGHT_REASONING + " Decision: Turn-right\n\nResponse to user:#### 2", 2, 'delimiter'),
+    # backticks around the id
+    (DECELERATE_REASONING + "\nResponse to user:#### `4`", 4, 'delimiter'),
+    # an explanation after the id, or no delimiter at all
+    (RIGHT_REASONING + " Decision: Turn-right\n\nResponse to user:#### 2 (Turn-right)", 2, 'regex'),
+    (DECELERATE_REASONING + "\nFinal Answer: Deceleration\n\nResponse to user: 4", 4, 'regex'),
+    (IDLE_REASONING + "\nAction_id: 1", 1, 'regex'),
+    # the action named instead of its id
+    (DECELERATE_REASONING + "\nFinal Answer: Deceleration\n\nResponse to user:#### Deceleration", 4, 'name'),
+    (DECELERATE_REASONING + "\nFinal Answer: Deceleration", 4, 'name'),
+    (RIGHT_REASONING + " Decision: Turn-right", 2, 'name'),
+    (IDLE_REASONING + "\nResponse to user:#### IDLE", 1, 'name'),
+    # no decision line, only the reasoning names an action
+    (IDLE_REASONING, 1, 'last_mentioned'),
+    (RIGHT_REASONING, 2, 'last_mentioned'),
+    # nothing to go by
+    ("Response to user:#### N/A", None, 'failed'),
+    ("", None, 'failed'),
+]
+
+
+@pytest.mark.parametrize("response, action, tier", PARSE_CASES)
+def test_parse_locally(response, action, tier):
+    assert parseLocally(response) == (action, tier)
+
+
+@pytest.mark.parametrize("response, action, tier", [
+    case for case in PARSE_CASES if case[1] is not None])
+def test_parser_counts_local_tiers(response, action, tier):
+    parser = OutputParser()
+    assert parser.parse(response) == action
+    assert parser.stats()[tier] == 1
+    assert sum(parser.stats().values()) == 1
+
+
+def test_parser_asks_llm_when_local_tiers_fail():
+    parser = OutputParser(FakeListChatModel(responses=["#### 4"]))
+    assert parser.parse("Response to user:#### N/A") == 4
+    assert parser.stats()['llm'] == 1
+
+
+def test_parser_raises_when_llm_cannot_tell():
+    parser = OutputParser(FakeListChatModel(responses=["I cannot tell."]))
+    with pytest.raises(ValueError):
+        parser.parse("Response to user:#### N/A")
+    assert parser.stats()['failed'] == 1
+
+
+def test_parser_raises_without_llm():
+    parser = OutputParser()
+    with pytest.raises(ValueError):
+        parser.parse("Response to user:#### N/A")
+    assert parser.stats()['failed'] == 1
+
+
+def test_aparse_asks_llm():
+    parser = OutputParser(FakeListChatModel(responses=["#### 0"]))
+    assert asyncio.run(parser.aparse("Response to user:#### N/A")) == 0
+    assert parser.stats()['llm'] == 1
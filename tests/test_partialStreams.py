@@ -0,0 +1,111 @@
+"""Streams closed early by the decision parser, for the response cache and
+the recording cassette."""
+import asyncio
+
+import pytest
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.schema import HumanMessage
+
+from dilu.driver_agent.cacheStore import LRUCacheStore
+from dilu.driver_agent.cassette import Cassette, CassetteChatModel
+from dilu.driver_agent.decisionStream import DecisionStreamParser
+from dilu.driver_agent.responseCache import CachedChatModel
+
+
+ANSWER = (
+    "- In order to keep a preferred distance with the front car, I can only decelerate.\n"
+    "Great, I can make my decision now.\n"
+    "Final Answer: Deceleration\n\n"
+    "Response to user:#### 4\n"
+    "I decelerate because the front car is too close."
+)
+MESSAGES = [HumanMessage(content="#### Driving scenario description:\nYou are driving on a road with 4 lanes.")]
+
+
+def cachedModel(tmp_path):
+    llm = CachedChatModel(
+        inner=FakeListChatModel(responses=[ANSWER]),
+        store=LRUCacheStore(str(tmp_path / "cache.db"), "responses"))
+    return llm, lambda: llm._lookup(llm._key(MESSAGES))
+
+
+def cassetteModel(tmp_path):
+    llm = CassetteChatModel(
+        cassette=Cassette(str(tmp_path / "cassette.db")), mode='record',
+        inner=FakeListChatModel(responses=[ANSWER]))
+    return llm, lambda: llm.cassette.getChat(llm._key(MESSAGES))
+
+
+MODELS = pytest.mark.parametrize("build", [cachedModel, cassetteModel], ids=['cache', 'cassette'])
+
+
+def streamUntil(llm, decided: bool = True, chunks: int = None) -> str:
+    """Stream `MESSAGES` and return the text received before closing the
+    stream, once the decision is parsed or after `chunks` chunks."""
+    parser, text = DecisionStreamParser(), ""
+    stream = llm.stream(MESSAGES)
+    for i, chunk in enumerate(stream, 1):
+        text += chunk.content
+        if (parser.feed(chunk.content) and decided) or i == chunks:
+            break
+    stream.close()
+    return text
+
+
+async def astreamUntil(llm, decided: bool = True, chunks: int = None) -> str:
+    parser, text, i = DecisionStreamParser(), "", 0
+    stream = llm.astream(MESSAGES)
+    async for chunk in stream:
+        i += 1
+        text += chunk.content
+        if (parser.feed(chunk.content) and decided) or i == chunks:
+            break
+    await stream.aclose()
+    # the wrapped generator is finalized by the event loop
+    await asyncio.sleep(0)
+    return text
+
+
+@MODELS
+def test_closed_after_decision_stores_partial_answer(tmp_path, build):
+    llm, stored = build(tmp_path)
+    streamed = streamUntil(llm)
+    assert streamed.endswith("Response to user:#### 4\n")
+    assert stored() == streamed
+
+
+@MODELS
+def test_closed_before_decision_stores_nothing(tmp_path, build):
+    llm, stored = build(tmp_path)
+    streamUntil(llm, decided=False, chunks=20)
+    assert stored() is None
+
+
+@MODELS
+def test_full_stream_stores_whole_answer(tmp_path, build):
+    llm, stored = build(tmp_path)
+    assert streamUntil(llm, decided=False) == ANSWER
+    assert stored() == ANSWER
+
+
+@MODELS
+def test_async_closed_after_decision_stores_partial_answer(tmp_path, build):
+    llm, stored = build(tmp_path)
+    streamed = asyncio.run(astreamUntil(llm))
+    assert streamed.endswith("Response to user:#### 4\n")
+    assert stored() == streamed
+
+
+@MODELS
+def test_async_closed_before_decision_stores_nothing(tmp_path, build):
+    llm, stored = build(tmp_path)
+    asyncio.run(astreamUntil(llm, decided=False, chunks=20))
+    assert stored() is None
+
+
+def test_cached_partial_answer_is_replayed(tmp_path):
+    llm, _ = cachedModel(tmp_path)
+    streamed = streamUntil(llm)
+    # a second stream is served from the cache, not by the inner model
+    llm.inner.responses = ["Response to user:#### 1\n"]
+    assert streamUntil(llm, decided=False) == streamed
@@ -0,0 +1,117 @@
+import pytest
+
+from dilu.driver_agent.promptBudget import (
+    CUT_MARKER,
+    MESSAGE_OVERHEAD,
+    PromptBudget,
+    shareBudget,
+)
+
+
+QUESTION = (
+    "#### Driving scenario description:\n"
+    "You are driving on a road with 4 lanes, and you are currently driving in the second lane from the left. "
+    "Your current position is `(312.45, 4.00)`, speed is 25.00 m/s, acceleration is 0.00 m/s^2, "
+    "and lane position is 312.45 m.\n"
+    "#### Driving Intentions:\nYour driving intention is to drive safely and avoid collisions.\n"
+    "#### Available actions:\nIDLE, Turn-left, Turn-right, Acceleration, Deceleration\n"
+)
+STEP = (
+    "- I need to observe the car in front of me on the current lane, which is car `216`. "
+    "The distance between me and car `216` is 30.13 m, and the difference in speed is -2.97 m/s. "
+    "So I should not accelerate.\n"
+)
+LONG_ANSWER = (
+    "Well, I have 5 actions to choose from. Now, I would like to know which action is possible.\n"
+    + STEP * 8
+    + "Great, I can make my decision now.\nFinal Answer: Deceleration\n\nResponse to user:#### 4"
+)
+SHORT_ANSWER = "Great, I can make my decision now. Decision: IDLE\n\nResponse to user:#### 1"
+FIXED = 400
+
+
+def promptTokens(budget: PromptBudget, questions, answers) -> int:
+    count = budget.counter.count
+    return FIXED + sum(
+        count(q) + count(a) + 2 * MESSAGE_OVERHEAD for q, a in zip(questions, answers))
+
+
+def examples(n: int):
+    questions = [QUESTION + f"Example {i}." for i in range(n)]
+    answers = [SHORT_ANSWER if i == 0 else LONG_ANSWER for i in range(n)]
+    return questions, answers
+
+
+def test_prompt_within_budget_is_unchanged():
+    budget = PromptBudget(10 ** 6)
+    questions, answers = examples(3)
+    assert budget.fit(FIXED, questions, answers) == (questions, answers, {'cut': 0, 'dropped': 0})
+
+
+@pytest.mark.parametrize("policy", ['truncate', 'summarize'])
+def test_cut_answers_fit_and_keep_their_decision(policy):
+    budget = PromptBudget(0, policy)
+    questions, answers = examples(3)
+    full = promptTokens(budget, questions, answers)
+    answerTokens = sum(budget.counter.count(a) for a in answers)
+    budget.budget = full - answerTokens // 2
+    fitted, cut, stats = budget.fit(FIXED, questions, answers)
+    assert fitted == questions
+    assert stats == {'cut': 2, 'dropped': 0}
+    assert promptTokens(budget, fitted, cut) <= budget.budget
+    # the short answer stays whole
+    assert cut[0] == SHORT_ANSWER
+    for answer in cut[1:]:
+        assert answer.endswith("Response to user:#### 4")
+        assert len(answer) < len(LONG_ANSWER)
+
+
+def test_truncate_keeps_start_of_reasoning():
+    budget = PromptBudget(0, 'truncate')
+    questions, answers = examples(2)
+    budget.budget = promptTokens(budget, questions, answers) - 100
+    _, cut, _ = budget.fit(FIXED, questions, answers)
+    assert cut[1].startswith("Well, I have 5 actions to choose from.")
+    assert CUT_MARKER in cut[1]
+
+
+def test_summarize_keeps_step_conclusions():
+    budget = PromptBudget(0, 'summarize')
+    questions, answers = examples(2)
+    budget.budget = promptTokens(budget, questions, answers) - 100
+    _, cut, _ = budget.fit(FIXED, questions, answers)
+    assert cut[1].splitlines()[0] == "- So I should not accelerate."
+    assert "Final Answer: Deceleration" in cut[1]
+    assert CUT_MARKER not in cut[1]
+
+
+def test_drop_removes_last_examples_whole():
+    budget = PromptBudget(0, 'drop')
+    questions, answers = examples(4)
+    budget.budget = promptTokens(budget, questions[:2], answers[:2])
+    fitted, kept, stats = budget.fit(FIXED, questions, answers)
+    assert (fitted, kept) == (questions[:2], answers[:2])
+    assert stats == {'cut': 0, 'dropped': 2}
+
+
+@pytest.mark.parametrize("policy", ['truncate', 'summarize', 'drop'])
+def test_examples_dropped_when_questions_alone_do_not_fit(policy):
+    budget = PromptBudget(FIXED + 10, policy)
+    questions, answers = examples(3)
+    fitted, kept, stats = budget.fit(FIXED, questions, answers)
+    assert (fitted, kept) == ([], [])
+    assert stats['dropped'] == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        PromptBudget(1000, 'shorten')
+
+
+@pytest.mark.parametrize("lengths, budget, shares", [
+    ([10, 10], 100, [10, 10]),
+    ([10, 100, 200], 110, [10, 50, 50]),
+    ([100, 200], 60, [30, 30]),
+])
+def test_share_budget(lengths, budget, shares):
+    assert shareBudget(lengths, budget) == shares
@@ -0,0 +1,100 @@
+"""Episode orchestration of run_dilu: parallel and async episodes never
+reflect, and worker processes report their cache and connection counters."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import run_dilu
+
+
+class NoHitsMemory:
+    def takeHits(self):
+        return {}
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        "episode_workers": 2,
+        "llm_concurrency": 2,
+        "reflection_module": True,
+        "reflection_policy": 'accept',
+        "result_folder": str(tmp_path),
+        "memory_path": str(tmp_path / "memory"),
+    }
+
+
+def episodeResult(config, episode, seed, reflected):
+    reflected.append(config["reflection_module"])
+    return {"episode": episode, "seed": seed, "steps": 1, "collision_frame": -1,
+            "file_prefix": f"highway_{episode}", "error": None}
+
+
+def test_workers_do_not_reflect(config, monkeypatch):
+    reflected = []
+    # threads share the patched module, worker processes would not
+    monkeypatch.setattr(run_dilu, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(run_dilu, "setup_env", lambda config: None)
+    monkeypatch.setattr(run_dilu, "load_memory", lambda *args, **kwargs: NoHitsMemory())
+    monkeypatch.setattr(
+        run_dilu, "run_episode",
+        lambda config, env_config, episode, seed, memory, log_path, updated_memory=None:
+            episodeResult(config, episode, seed, reflected))
+    results = run_dilu.run_parallel(config, {}, [5838, 2421])
+    assert reflected == [False, False]
+    assert [result["error"] for result in results] == [None, None]
+    assert config["reflection_module"]
+
+
+def test_async_episodes_do_not_reflect(config, monkeypatch):
+    reflected = []
+
+    async def runEpisodeAsync(config, env_config, episode, seed, *args):
+        return episodeResult(config, episode, seed, reflected)
+
+    monkeypatch.setattr(run_dilu, "run_episode_async", runEpisodeAsync)
+    results = asyncio.run(run_dilu.run_async(config, {}, [5838, 2421], None))
+    assert reflected == [False, False]
+    assert [result["error"] for result in results] == [None, None]
+
+
+def cacheStats(hits, misses, requests):
+    return {
+        "llm_cache": {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses)},
+        "embedding_cache": None,
+        "connections": {"requests": requests, "connections": 1, "reused": requests - 1,
+                        "retries": 0, "timeouts": 0, "failures": 0},
+    }
+
+
+def test_worker_reports_counters_of_its_episode(config, monkeypatch):
+    counters = iter([cacheStats(4, 2, 10), cacheStats(9, 3, 16)])
+    monkeypatch.setattr(run_dilu, "process_stats", lambda: next(counters))
+    monkeypatch.setattr(run_dilu, "_worker_memory", NoHitsMemory())
+    monkeypatch.setattr(
+        run_dilu, "run_episode",
+        lambda config, env_config, episode, seed, memory, log_path:
+            episodeResult(config, episode, seed, []))
+    result = run_dilu._run_worker_episode(config, {}, 0, 5838)
+    assert result["process_stats"] == {
+        "llm_cache": {"hits": 5, "misses": 1},
+        "embedding_cache": None,
+        "connections": {"requests": 6, "connections": 0, "reused": 6,
+                        "retries": 0, "timeouts": 0, "failures": 0},
+    }
+
+
+def test_summary_adds_up_worker_counters(config, monkeypatch):
+    monkeypatch.setattr(run_dilu, "process_stats", lambda: {
+        "llm_cache": None, "embedding_cache": None, "connections": None})
+    results = []
+    for episode, (hits, misses) in enumerate([(5, 1), (2, 2)]):
+        result = episodeResult(config, episode, 5838, [])
+        result["process_stats"] = run_dilu.stats_delta({}, cacheStats(hits, misses, 8))
+        results.append(result)
+    run_dilu.write_summary(config, results)
+    with open(config["result_folder"] + "/log.txt") as f:
+        log = f.read()
+    assert "LLM cache | Hits: 7 | Misses: 3 | Hit rate: 70.00%" in log
+    assert "LLM connections | Requests: 16 | New connections: 2 | Reused: 14" in log
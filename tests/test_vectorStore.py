@@ -0,0 +1,54 @@
+import pytest
+from langchain.embeddings import FakeEmbeddings
+
+from dilu.driver_agent.vectorStore import DrivingMemory
+
+
+SCENE_A = "You are driving on a road with 4 lanes, and you are currently driving in the second lane from the left."
+SCENE_B = "You are driving on a road with 3 lanes, and you are currently driving in the rightmost lane."
+
+
+class UnorderedStore:
+    """Store that answers `get(ids=...)` like Chroma: repeated ids once, in
+    its own order rather than the requested one."""
+
+    def __init__(self, store) -> None:
+        self.store = store
+
+    def get(self, ids=None, **kwargs):
+        if ids is None:
+            return self.store.get(**kwargs)
+        return self.store.get(ids=sorted(set(ids)), **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def memory(path) -> DrivingMemory:
+    return DrivingMemory('sce_language', str(path), 'local', embedding=FakeEmbeddings(size=8))
+
+
+def add(memory, ids, documents, created):
+    memory.collection.add(
+        ids=ids, embeddings=[[0.1 * i] * 8 for i in range(len(ids))],
+        documents=documents,
+        metadatas=[{'created_at': c, 'comments': 'no-mistake-direct'} for c in created])
+
+
+@pytest.mark.parametrize("order", [[0, 1, 2], [2, 0, 1]])
+def test_merge_compares_with_the_matching_target(tmp_path, order):
+    target = memory(tmp_path / "target")
+    add(target, ['a-target', 'b-target'], [SCENE_A, SCENE_B], [10, 1])
+    target.collection = UnorderedStore(target.collection)
+    source = memory(tmp_path / "source")
+    rows = [('a-1', SCENE_A, 5), ('a-2', SCENE_A, 6), ('b-1', SCENE_B, 3)]
+    rows = [rows[i] for i in order]
+    add(source, *map(list, zip(*rows)))
+
+    target.combineMemory(source, 'newest')
+
+    stored = target.collection.get(ids=['a-target', 'b-target'], include=['metadatas'])
+    created = dict(zip(stored['ids'], (m['created_at'] for m in stored['metadatas'])))
+    # the newer stored A is kept, the older stored B is replaced
+    assert created == {'a-target': 10, 'b-target': 3}
+    assert target.collection.count() == 2
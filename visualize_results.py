@@ -5,23 +5,14 @@ import gradio as gr
 import yaml
 import argparse
 from dilu.scenario.envScenarioReplay import EnvScenarioReplay
+from dilu.scenario.frameRecord import FrameRecord
+from dilu.scenario.scenarioVector import encodeResultDB
 from dilu.driver_agent.vectorStore import DrivingMemory
+from dilu.driver_agent.llmFactory import setupLLMEnv
 
 
 config = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)
-if config['OPENAI_API_TYPE'] == 'azure':
-    os.environ["OPENAI_API_TYPE"] = config['OPENAI_API_TYPE']
-    os.environ["OPENAI_API_VERSION"] = config['AZURE_API_VERSION']
-    os.environ["OPENAI_API_BASE"] = config['AZURE_API_BASE']
-    os.environ["OPENAI_API_KEY"] = config['AZURE_API_KEY']
-    os.environ["AZURE_CHAT_DEPLOY_NAME"] = config['AZURE_CHAT_DEPLOY_NAME']
-    os.environ["AZURE_EMBED_DEPLOY_NAME"] = config['AZURE_EMBED_DEPLOY_NAME']
-elif config['OPENAI_API_TYPE'] == 'openai':
-    os.environ["OPENAI_API_TYPE"] = config['OPENAI_API_TYPE']
-    os.environ["OPENAI_API_KEY"] = config['OPENAI_KEY']
-    os.environ["OPENAI_CHAT_MODEL"] = config['OPENAI_CHAT_MODEL']
-else:
-    raise ValueError("Unknown OPENAI_API_TYPE, should be azure or openai")
+setupLLMEnv(config)
 
 
 TAMDTemplate = """
@@ -111,8 +102,13 @@ def commitExperience(decisionFrame: int, expertExperience: str):
         else:
             raise gr.Error(
                 "Plase make sure the last line contains 'Response to user:####'.")
+        sce_vector = None
+        if vector_memory.encode_type == 'sce_encode':
+            sce_vector = encodeResultDB(esr.database)[decisionFrame].tolist()
         vector_memory.addMemory(
-            sce_descrip, framePrompts.description, expertExperience, action)
+            sce_descrip, framePrompts.description, expertExperience, action,
+            FrameRecord(decisionFrame, sce_descrip, framePrompts.description,
+                        expertExperience, action, sce_vector))
 
         esr.editTA(decisionFrame, expertExperience)
         gr.Info('The Thoughts and Actions has been edited and committed.')
@@ -137,7 +133,12 @@ if __name__ == '__main__':
 
     esr = EnvScenarioReplay(args.result_db_path)
     minFrame, maxFrame = esr.getMinMaxFrame()
-    vector_memory = DrivingMemory(db_path=args.mem_path)
+    vector_memory = DrivingMemory(
+        config['memory_encode_type'], args.mem_path, config['memory_backend'],
+        capacity=config['memory_capacity'],
+        dedup_radius=config['memory_dedup_radius'],
+        partitioned=config['memory_partitioned'],
+        partition_min=config['memory_partition_min'])
 
     with gr.Blocks(theme=gr.themes.Base(text_size=gr.themes.sizes.text_lg)) as demo:
         with gr.Row(visible=True, variant='panel'):